@@ -1,30 +1,81 @@
-from fastapi import FastAPI, Request, HTTPException, Response
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Response, UploadFile, File, Form
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
 import asyncio
-import json
+import secrets
+import time
+import uuid
+import zipfile
 from contextlib import asynccontextmanager
 from typing import List, Dict, Any, Optional, Union
 
 from general_functions import check_ollama_connection, get_mood_from_text, ask_ollama
+from model_router import model_router
+from ollama_scheduler import ollama_scheduler
 from project_service import project_service
+from bundle_service import bundle_service
 from vault_service import vault_service
 from knowledge_base_service import kb_service
+from link_service import link_service
 from web_search_service import web_search_service
+from indexing_service import indexing_service, ACTIVE_STATUSES
+from vault_watcher import vault_watcher
+from grammar_review_service import grammar_review_service, build_grammar_prompt
+from fact_check_service import fact_check_service
+from response_cache import response_cache
+from metrics import REGISTRY, HTTP_REQUEST_SECONDS
+from tracing import tracer
+from session_service import session_service, SESSION_HEADER, SESSION_COOKIE
+from ndjson import dumps_line, ChunkCoalescer
+from circuit_breaker import breaker_monitor, breaker_states, ollama_breaker, CircuitOpenError
+from mood_service import StreamingMoodAnalyzer, MOOD_STREAM
+from conversation_service import conversation_service
+from generation_store import generation_store
+from storage import state_path
+from diagnostics import sampling_profiler, memory_tracker, loop_monitor, inflight_tasks, describe_task
 
 # Load environment variables
 load_dotenv()
 
+# Fact-check prompts longer than this go through the map-reduce pipeline instead of one generation
+FACT_CHECK_PIPELINE_CHARS = int(os.getenv("FACT_CHECK_PIPELINE_CHARS", 2000))
+
+# Tasks whose reply restates or judges the exact input: a near-duplicate's cached reply would be wrong
+EXACT_CACHE_TASKS = ("#task:fix_grammar", "#task:fact_check")
+
+# Vault retrieval started with the prompt and injected into the context (saves a tool round-trip)
+RAG_PREFETCH = os.getenv("RAG_PREFETCH", "false").lower() in ("1", "true", "yes")
+RAG_PREFETCH_TOKENS = int(os.getenv("RAG_PREFETCH_TOKENS", 600))
+RAG_PREFETCH_TIMEOUT = float(os.getenv("RAG_PREFETCH_TIMEOUT", 2))
+
+# Diagnostics under /admin need this token (X-Luna-Admin-Token); without one they don't exist
+ADMIN_TOKEN = os.getenv("LUNA_ADMIN_TOKEN", "")
+DIAG_LOOP_MONITOR = os.getenv("DIAG_LOOP_MONITOR", "false").lower() in ("1", "true", "yes")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Initialize DB
-    await kb_service.init_db()
+    # Startup: scope the DB to the current vault. Dependencies are checked in the
+    # background, so the API is up even while Chroma, Ollama or the mood model aren't
+    kb_service.set_active_vault(vault_service.vault_path)
+    breaker_monitor.start(check_now=True)
+    # Pick up indexing jobs interrupted by the last shutdown
+    indexing_service.resume_pending()
+    vault_watcher.start()
+    if DIAG_LOOP_MONITOR:
+        loop_monitor.start()
     yield
     # Shutdown: Clean up
+    await loop_monitor.stop()
+    await breaker_monitor.stop()
+    await vault_watcher.stop()
+    await indexing_service.shutdown()
     await kb_service.close()
+    await web_search_service.close()
+    tracer.close()
 
 app = FastAPI(title="Luna API", lifespan=lifespan)
 
@@ -35,12 +86,68 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", SESSION_HEADER],
+)
+
+@app.middleware("http")
+async def bind_session(request: Request, call_next):
+    """
+    Resolves the client's session (header, else cookie) to its active project so each
+    session works on its own vault. State lives in SQLite, shared by all worker processes.
+    """
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    issued = not session_service.is_valid_id(session_id)
+    if issued:
+        session_id = session_service.new_id()
+    request.state.session_id = session_id
+
+    vault_service.refresh_default()
+    session = None if issued else session_service.get(session_id)
+    session_service.activate(session["vault_path"] if session else None)
+
+    response = await call_next(request)
+    if issued:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="lax")
+        response.headers[SESSION_HEADER] = session_id
+    return response
+
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    # Honour an ID set by a proxy or the client so logs and traces can be correlated
+    request_id = request.headers.get("X-Request-ID") or tracer.new_request_id()
+    request.state.request_id = request_id
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template so path parameters don't explode the series count
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=path, method=request.method, status=str(status))
+
+REGISTRY.gauge(
+    "luna_indexing_jobs_active", "Vault indexing jobs queued or running.",
+    callback=lambda: {(): sum(1 for job in indexing_service.jobs.values() if job.status in ACTIVE_STATUSES)}
+)
+REGISTRY.gauge(
+    "luna_event_loop_lag_seconds", "How late the event loop ran the monitor's last heartbeat (only while monitoring).",
+    callback=lambda: {(): loop_monitor.lag_last} if loop_monitor.enabled else {}
 )
 
 # Models
 class ProjectCreate(BaseModel):
     name: str
     history: List[Dict[str, Any]] = []
+    conversation_id: Optional[str] = None  # Summarize the server-side log instead of `history`
     config: Dict[str, Any] = {}
     trigger_init: bool = False
     description: Optional[str] = None
@@ -48,11 +155,23 @@ class ProjectCreate(BaseModel):
 class ProjectUpdate(BaseModel):
     config: Dict[str, Any] = {}
     history: List[Dict[str, Any]] = []
+    conversation_id: Optional[str] = None
     description: Optional[str] = None
 
 class ChatRequest(BaseModel):
     prompt: str
     history: List[Dict[str, Any]] = []
+    conversation_id: Optional[str] = None  # History comes from the server-side log; `history` is ignored
+    prefetch: Optional[bool] = None  # Overrides RAG_PREFETCH for this request
+    no_cache: bool = False  # Regenerate #task: prompts even if a cached answer exists
+    timing: bool = False  # Append a `timing` event with per-stage durations to the stream
+    resumable: bool = False  # Keep generating after a disconnect; resume with GET /chat/{generation_id}
+    coalesce: bool = True  # Merge rapid token chunks into fewer NDJSON lines
+    mood_stream: Optional[bool] = None  # Overrides MOOD_STREAM for this request
+
+class ConversationMessage(BaseModel):
+    role: str = "system"
+    content: str
 
 class ConfigUpdate(BaseModel):
     vault_path: str
@@ -66,7 +185,40 @@ class VaultSaveRequest(BaseModel):
 
 class FixGrammarRequest(BaseModel):
     content: str
+    no_cache: bool = False
+
+class FactCheckRequest(BaseModel):
+    content: str
 
+class WatchToggle(BaseModel):
+    enabled: bool
+
+class ReviewRequest(BaseModel):
+    content: Optional[str] = None
+    path: Optional[str] = None
+    no_cache: bool = False
+
+class ReviewResolveRequest(BaseModel):
+    accept: List[int] = []
+    reject: List[int] = []
+    accept_all: bool = False
+
+class ReviewApplyRequest(BaseModel):
+    path: Optional[str] = None
+
+
+def _check_conversation_id(conversation_id: str) -> None:
+    if not conversation_service.is_valid_id(conversation_id):
+        raise HTTPException(status_code=400, detail="Invalid conversation id")
+    # Logs live in the project's folder
+    if not vault_service.vault_path:
+        raise HTTPException(status_code=409, detail="No project is open")
+
+def _conversation_history(conversation_id: Optional[str], history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if conversation_id is None:
+        return history
+    _check_conversation_id(conversation_id)
+    return conversation_service.tail(conversation_id)
 
 @app.get("/projects")
 async def get_projects():
@@ -78,7 +230,7 @@ async def create_project(data: ProjectCreate):
         raise HTTPException(status_code=400, detail="Name is required")
     
     project_data = await project_service.save_project(
-        data.name, data.history, data.config,
+        data.name, _conversation_history(data.conversation_id, data.history), data.config,
         trigger_init=data.trigger_init,
         description=data.description
     )
@@ -87,7 +239,7 @@ async def create_project(data: ProjectCreate):
 @app.patch("/projects/{name}")
 async def update_project_config(name: str, data: ProjectUpdate):
     config = data.config
-    history = data.history
+    history = _conversation_history(data.conversation_id, data.history)
     
     description = config.pop("description", None) or data.description
     
@@ -97,6 +249,9 @@ async def update_project_config(name: str, data: ProjectUpdate):
     
     if description is None:
         description = old.get("description")
+    # The frontend doesn't edit model routes; keep them unless the update sets them
+    if "models" not in config and old.get("config", {}).get("models"):
+        config["models"] = old["config"]["models"]
 
     project_data = await project_service.save_project(name, history, config, description=description)
     return {"status": "updated", "project": project_data}
@@ -107,13 +262,47 @@ async def remove_project(name: str, delete_files: bool = False):
         return {"status": "deleted"}
     raise HTTPException(status_code=404, detail="Project not found")
 
+@app.get("/projects/{name}/export")
+async def export_project_bundle(name: str):
+    """Downloads the project as a bundle: project file, vault and prebuilt index."""
+    bundle_path = state_path("bundles", f"{uuid.uuid4().hex}.zip")
+    try:
+        await bundle_service.export_project(name, bundle_path)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception:
+        if os.path.exists(bundle_path):
+            os.remove(bundle_path)
+        raise
+    return FileResponse(
+        bundle_path, media_type="application/zip", filename=f"{name}.luna.zip",
+        background=BackgroundTask(os.remove, bundle_path)
+    )
+
+@app.post("/projects/import")
+async def import_project_bundle(bundle: UploadFile = File(...), vault_path: str = Form(...), name: Optional[str] = Form(None)):
+    """Restores a bundle into `vault_path`; its notes are searchable without re-indexing."""
+    try:
+        # The upload is spooled to a temporary file, so the bundle is read from disk
+        result = await bundle_service.import_project(bundle.file, vault_path, name)
+    except FileExistsError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except (ValueError, zipfile.BadZipFile) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "imported", **result}
+
 @app.post("/projects/{name}/load")
-async def load_project_route(name: str):
+async def load_project_route(name: str, request: Request):
     project_data = project_service.load_project(name)
     if project_data:
         vp = project_data.get("config", {}).get("vault_path")
         if vp:
+            # Active for this session; also becomes the default for clients without one
+            session_service.set(request.state.session_id, vp, name)
+            session_service.activate(vp)
             vault_service.set_vault_path(vp)
+            # Switching is instant: each project keeps its own collections
+            kb_service.set_active_vault(vp)
         return project_data
     raise HTTPException(status_code=404, detail="Project not found")
 
@@ -124,34 +313,227 @@ async def health_check():
     ollama_status = await check_ollama_connection()
     return {
         "status": "online",
-        "ollama": "connected" if ollama_status else "disconnected"
+        "ollama": "connected" if ollama_status else "disconnected",
+        "breakers": breaker_states()
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of latency, token and queue metrics."""
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/traces")
+async def list_traces(limit: int = 20):
+    """Stage totals of the most recent traced requests."""
+    return tracer.recent(limit)
+
+@app.get("/traces/{request_id}")
+async def get_trace(request_id: str):
+    trace = tracer.get(request_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace.summary()
+
+@app.get("/cache")
+async def response_cache_stats():
+    return await asyncio.to_thread(response_cache.stats)
+
+@app.delete("/cache")
+async def clear_response_cache():
+    await asyncio.to_thread(response_cache.clear)
+    return {"status": "cleared"}
+
+@app.get("/models/routes")
+async def get_model_routes():
+    """Model and options per task for the session's project, with the model each resolves to."""
+    return await model_router.describe()
+
+@app.get("/ollama/queue")
+async def ollama_queue_stats():
+    """Per-lane concurrency, queue depth and queue-wait statistics."""
+    return ollama_scheduler.stats()
+
+# Diagnostics. Each worker process profiles and tracks only itself, hence the pid in every answer.
+
+def _require_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(request.headers.get("X-Luna-Admin-Token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, hz: float = 100, idle: bool = False):
+    """
+    Samples every thread's stack for `seconds` (at most 60) and returns collapsed stacks,
+    ready for flamegraph.pl or speedscope. Idle threads are left out unless `idle`.
+    """
+    _require_admin(request)
+    if sampling_profiler.busy:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        folded = await asyncio.to_thread(sampling_profiler.profile, seconds, hz, idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(folded, headers={"X-Luna-Pid": str(os.getpid())})
+
+@app.post("/admin/memory/start")
+async def admin_memory_start(request: Request, frames: int = 25):
+    """Starts tracemalloc (slows allocation-heavy code while on) and takes the baseline snapshot."""
+    _require_admin(request)
+    await asyncio.to_thread(memory_tracker.start, min(max(frames, 1), 100))
+    return {"pid": os.getpid(), "tracing": True}
+
+@app.post("/admin/memory/snapshot")
+async def admin_memory_snapshot(request: Request, limit: int = 25, key: str = "lineno"):
+    """Top allocation growth since the previous snapshot, by lineno, traceback or filename."""
+    _require_admin(request)
+    if key not in ("lineno", "traceback", "filename"):
+        raise HTTPException(status_code=400, detail="key must be lineno, traceback or filename")
+    try:
+        snapshot = await asyncio.to_thread(memory_tracker.snapshot, limit, key)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"pid": os.getpid(), **snapshot}
+
+@app.delete("/admin/memory")
+async def admin_memory_stop(request: Request):
+    _require_admin(request)
+    memory_tracker.stop()
+    return {"pid": os.getpid(), "tracing": False}
+
+@app.get("/admin/loop-monitor")
+async def admin_loop_monitor(request: Request):
+    """Event-loop lag and the stacks of recent callbacks that blocked it."""
+    _require_admin(request)
+    return {"pid": os.getpid(), **loop_monitor.stats()}
+
+@app.post("/admin/loop-monitor")
+async def admin_toggle_loop_monitor(request: Request, enabled: bool = True, slow_callback_ms: Optional[float] = None):
+    _require_admin(request)
+    if enabled:
+        loop_monitor.start(slow_callback_ms)
+    else:
+        await loop_monitor.stop()
+    return {"pid": os.getpid(), **loop_monitor.stats()}
+
+@app.get("/admin/tasks")
+async def admin_tasks(request: Request):
+    """Chat generations and vault syncs running in this process, oldest first, with where each is waiting."""
+    _require_admin(request)
+    syncs = [
+        describe_task(
+            job.task, job.created_at, kind="vault_sync", job_id=job.id, vault_path=job.vault_path,
+            processed=len(job.done_files), total=job.total
+        )
+        for job in indexing_service.jobs.values()
+        if job.task is not None and not job.task.done()
+    ]
+    tasks = sorted(inflight_tasks.list() + syncs, key=lambda t: t["age"], reverse=True)
+    return {"pid": os.getpid(), "tasks": tasks}
+
+def _unavailable(breaker) -> Optional[CircuitOpenError]:
+    if breaker.allow():
+        return None
+    return CircuitOpenError(breaker.name, breaker.retry_in(), breaker.last_error)
+
+def _fail_fast_stream(breaker) -> Optional[StreamingResponse]:
+    """A one-line NDJSON error right away while the dependency's circuit is open."""
+    error = _unavailable(breaker)
+    if error is None:
+        return None
+    return StreamingResponse(iter([dumps_line(error.to_event())]), media_type="application/x-ndjson")
+
+def _ensure_available(breaker) -> None:
+    error = _unavailable(breaker)
+    if error is not None:
+        raise HTTPException(status_code=503, detail=str(error), headers={"Retry-After": str(max(1, round(error.retry_in)))})
+
+def _ensure_lane_capacity(lane: str) -> None:
+    if not ollama_scheduler.has_capacity(lane):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many pending '{lane}' requests. Please retry shortly.",
+            headers={"Retry-After": "2"}
+        )
+
 @app.post("/chat")
 async def chat(chat_request: ChatRequest, request: Request):
     """
     Stream chat response.
     """
+    unavailable = _fail_fast_stream(ollama_breaker)
+    if unavailable is not None:
+        return unavailable
+    _ensure_lane_capacity("chat")
+    if chat_request.resumable and not generation_store.enabled:
+        raise HTTPException(status_code=409, detail="Resumable generations are off (CHAT_RESUMABLE=false)")
     prompt = chat_request.prompt
-    history = chat_request.history
+    conversation_id = chat_request.conversation_id
+    # Logged only once the request is accepted, so a rejected one leaves no unanswered turn
+    history = _conversation_history(conversation_id, chat_request.history)
+    if conversation_id:
+        conversation_service.append(conversation_id, "user", prompt)
+    use_prefetch = chat_request.prefetch if chat_request.prefetch is not None else RAG_PREFETCH
+    # Grammar rewrites don't need lore, and long fact checks retrieve per claim
+    is_pipeline_fact_check = prompt.startswith("#task:fact_check") and len(prompt) > FACT_CHECK_PIPELINE_CHARS
+    use_prefetch = use_prefetch and not prompt.startswith("#task:fix_grammar") and not is_pipeline_fact_check
+    use_mood_stream = chat_request.mood_stream if chat_request.mood_stream is not None else MOOD_STREAM
     
     async def event_generator():
-        event_queue = asyncio.Queue()
-        stop_event = asyncio.Event()
+        # A resumable generation buffers its events (same put() interface as the queue)
+        generation = generation_store.create() if chat_request.resumable else None
+        event_queue = generation if generation is not None else asyncio.Queue()
+        stop_event = generation.stop_event if generation is not None else asyncio.Event()
+        prefetch_task = None
+        # Started before the tasks below so they (and everything they call) join this trace
+        trace = tracer.start_trace(
+            "chat", getattr(request.state, "request_id", None),
+            task=prompt.split(None, 1)[0] if prompt.startswith("#task:") else "chat"
+        )
 
         # Step 1: Mood Analysis Task
         async def run_mood():
             try:
-                mood = await asyncio.to_thread(get_mood_from_text, prompt)
+                with tracer.span("mood"):
+                    mood = await asyncio.to_thread(get_mood_from_text, prompt)
                 await event_queue.put({"type": "mood", "content": mood})
             except Exception:
                 pass
 
+        # Step 2 (long fact checks): per-claim verdicts streamed as report lines
+        async def run_fact_check_pipeline(text: str):
+            try:
+                async for event in fact_check_service.run(text):
+                    if event["type"] == "claim":
+                        await event_queue.put({"type": "thought", "content": f"Luna verificando: {event['claim']}"})
+                    elif event["type"] == "verdict":
+                        sources = ", ".join(s for s in event.get("sources", []) if s)
+                        line = f"- **[{event['verdict']}]** {event['claim']}"
+                        if event.get("explanation"):
+                            line += f" — {event['explanation']}"
+                        if sources:
+                            line += f" ({sources})"
+                        await event_queue.put({"type": "chunk", "content": line + "\n"})
+                    elif event["type"] == "done" and event.get("partial"):
+                        await event_queue.put({"type": "chunk", "content": (
+                            f"\n_Fact check incomplete: {event['failed_segments']} segment(s) could not be read "
+                            f"and {event['failed_claims']} claim(s) could not be verified._\n"
+                        )})
+            except Exception as e:
+                await event_queue.put({"type": "error", "content": str(e)})
+            finally:
+                await event_queue.put({"type": "done"})
+
         # Step 2: Ollama Request Task
         async def run_ollama():
+            if is_pipeline_fact_check:
+                await run_fact_check_pipeline(prompt[len("#task:fact_check"):].strip())
+                return
+
             tool_handlers = {
                 "search_vault": kb_service.search,
-                "web_search": web_search_service.web_search
+                "web_search": web_search_service.web_search,
+                "fetch_page": web_search_service.fetch_page
             }
 
             task_prompt = ""
@@ -161,7 +543,7 @@ async def chat(chat_request: ChatRequest, request: Request):
                     "1. Analyze the user's text. "
                     "2. Identify every factual claim. "
                     "3. First, use the `search_vault` tool to find evidence in the local knowledge base. "
-                    "4. For scientific or factual claims that need external verification, use the `web_search` tool to verify against current knowledge. "
+                    "4. For scientific or factual claims that need external verification, use the `web_search` tool to verify against current knowledge, and `fetch_page` when a snippet is not conclusive. "
                     "5. OUTPUT REPORT: List each claim and mark it [VERIFIED], [CONTRADICTED], or [NO EVIDENCE]. "
                     "Include citations from both vault sources and web sources (with URLs).\n\n"
                 )
@@ -175,39 +557,226 @@ async def chat(chat_request: ChatRequest, request: Request):
 
             current_prompt = task_prompt + prompt if task_prompt else prompt
 
+            # Deterministic editor tasks are served from the response cache when possible
+            cache_task = prompt.split(None, 1)[0] if prompt.startswith("#task:") else None
+            route = await model_router.route("grammar" if cache_task == "#task:fix_grammar" else "chat")
+            allow_similar = cache_task not in EXACT_CACHE_TASKS
+            if cache_task and not chat_request.no_cache:
+                cached = await response_cache.lookup(route["model"], cache_task, prompt, allow_similar=allow_similar)
+                if cached is not None:
+                    await event_queue.put({"type": "chunk", "content": cached})
+                    await event_queue.put({"type": "done"})
+                    return
+
+            context_snippets = None
+            if prefetch_task is not None:
+                try:
+                    context_snippets = await prefetch_task
+                except Exception:
+                    context_snippets = None
+
+            # Editor tasks keep the mood of the prompt; conversation follows the reply as it streams
+            mood_analyzer = None
+            if use_mood_stream and not cache_task:
+                async def emit_mood(mood: str):
+                    await event_queue.put({"type": "mood", "content": mood, "source": "response"})
+                mood_analyzer = StreamingMoodAnalyzer(emit_mood)
+
+            full_response = ""
+            failed = False
+            finish_mood = False
             try:
-                async for event_type, content in ask_ollama(current_prompt, history, stop_event, tool_handlers):
+                async for event_type, content in ask_ollama(
+                    current_prompt, history, stop_event, tool_handlers, context_snippets=context_snippets, **route
+                ):
+                    if event_type == "chunk":
+                        full_response += content
+                        if mood_analyzer is not None:
+                            mood_analyzer.feed(content)
+                    elif event_type == "error":
+                        failed = True
                     await event_queue.put({"type": event_type, "content": content})
+                if cache_task and not failed and not stop_event.is_set():
+                    await response_cache.store(route["model"], cache_task, prompt, full_response, allow_similar=allow_similar)
+                finish_mood = mood_analyzer is not None and not failed and not stop_event.is_set()
             except Exception as e:
                 await event_queue.put({"type": "error", "content": str(e)})
             finally:
+                if mood_analyzer is not None and not finish_mood:
+                    mood_analyzer.cancel()
                 await event_queue.put({"type": "done"})
+            if finish_mood:
+                # The last pass over the reply's tail arrives after "done", so it doesn't hold up the reply
+                try:
+                    await mood_analyzer.finish()
+                finally:
+                    mood_analyzer.cancel()
 
-        # Launch tasks
+        # Launch tasks (prefetch runs alongside mood analysis, before the first generation)
         asyncio.create_task(run_mood())
+        if use_prefetch:
+            prefetch_task = asyncio.create_task(
+                kb_service.prefetch_context(prompt, RAG_PREFETCH_TOKENS, RAG_PREFETCH_TIMEOUT)
+            )
         ollama_task = asyncio.create_task(run_ollama())
+        inflight_tasks.add(
+            ollama_task, "chat", request_id=getattr(request.state, "request_id", None),
+            prompt=prompt[:80], generation=generation.id if generation is not None else None
+        )
 
+        source = event_queue
+        if generation is not None:
+            generation.tasks = [task for task in (ollama_task, prefetch_task) if task is not None]
+            await generation.put({"type": "generation", "id": generation.id})
+            source = generation.subscribe()
+            if conversation_id:
+                # Logged when the generation ends, whether or not a client is still attached
+                def log_reply(_):
+                    if generation.length:
+                        conversation_service.append(conversation_id, "assistant", generation.text())
+                ollama_task.add_done_callback(log_reply)
+
+        coalescer = ChunkCoalescer(window=None if chat_request.coalesce else 0)
+        reply_parts = []
         try:
-            while True:
+            finished = False
+            while not finished:
                 if await request.is_disconnected():
-                    stop_event.set()
-                    ollama_task.cancel()
+                    if generation is None:
+                        stop_event.set()
+                        ollama_task.cancel()
                     break
                 
+                due_in = coalescer.timeout()
                 try:
-                    item = await asyncio.wait_for(event_queue.get(), timeout=0.1)
-                    yield json.dumps(item) + "\n"
-                    if item.get("type") in ["done", "error"]:
-                        break
+                    item = await asyncio.wait_for(source.get(), timeout=0.1 if due_in is None else due_in)
                 except asyncio.TimeoutError:
+                    # Buffered chunks are due (or nothing arrived): write what we have
+                    for line in coalescer.flush():
+                        yield line
                     continue
+
+                # Take whatever else is already queued so a burst becomes one write
+                items = [item]
+                while not source.empty() and items[-1].get("type") not in ("done", "error"):
+                    items.append(source.get_nowait())
+
+                lines = []
+                for item in items:
+                    lines += coalescer.push(item)
+                    if conversation_id and generation is None and item.get("type") == "chunk":
+                        reply_parts.append(item.get("content", ""))
+                    if item.get("type") in ("done", "error"):
+                        finished = item["type"]
+                        tracer.finish_trace(trace)
+                        if chat_request.timing and trace is not None:
+                            lines.append(dumps_line({"type": "timing", **trace.summary()}))
+                        break
+                if lines:
+                    yield b"".join(lines)
+            if finished == "done":
+                # Trailing mood from the reply's last pass (see run_ollama), bounded by its timeout
+                await asyncio.wait({ollama_task})
+                while not source.empty():
+                    item = source.get_nowait()
+                    if item.get("type") == "mood":
+                        yield dumps_line(item)
         except asyncio.CancelledError:
-            stop_event.set()
-            ollama_task.cancel()
+            if generation is None:
+                stop_event.set()
+                ollama_task.cancel()
             raise
+        finally:
+            tracer.finish_trace(trace)
+            if generation is not None:
+                generation.unsubscribe(source)
+            # Whatever reached the client (also a stopped, partial reply) becomes part of the log
+            if conversation_id and reply_parts:
+                conversation_service.append(conversation_id, "assistant", "".join(reply_parts))
+
+    return StreamingResponse(event_generator(), media_type="application/x-ndjson")
+
+@app.get("/chat/{generation_id}")
+async def resume_chat(generation_id: str, request: Request, offset: int = 0):
+    """
+    Reattaches to a resumable generation. `offset` is the number of reply characters
+    the client already has; chunks are merged on the wire, so characters (not
+    tokens) are the unit both sides agree on.
+    """
+    generation = generation_store.get(generation_id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
+
+    async def event_generator():
+        source = generation.subscribe(max(0, offset))
+        coalescer = ChunkCoalescer()
+        try:
+            while True:
+                if await request.is_disconnected():
+                    break
+                due_in = coalescer.timeout()
+                try:
+                    item = await asyncio.wait_for(source.get(), timeout=0.1 if due_in is None else due_in)
+                except asyncio.TimeoutError:
+                    for line in coalescer.flush():
+                        yield line
+                    continue
+                lines = coalescer.push(item)
+                if lines:
+                    yield b"".join(lines)
+                if item.get("type") in ("done", "error"):
+                    break
+        finally:
+            generation.unsubscribe(source)
 
     return StreamingResponse(event_generator(), media_type="application/x-ndjson")
 
+# Conversation Routes
+
+@app.get("/conversations")
+async def list_conversations():
+    return conversation_service.list_conversations()
+
+@app.post("/conversations")
+async def create_conversation():
+    return {"id": conversation_service.new_id()}
+
+@app.get("/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str, limit: int = 50):
+    _check_conversation_id(conversation_id)
+    return {"id": conversation_id, "messages": conversation_service.tail(conversation_id, limit)}
+
+@app.post("/conversations/{conversation_id}/messages")
+async def append_conversation_message(conversation_id: str, message: ConversationMessage):
+    """Adds a message without generating a reply (e.g. the project summary as context)."""
+    _check_conversation_id(conversation_id)
+    if message.role not in ("user", "assistant", "system"):
+        raise HTTPException(status_code=400, detail="Invalid role")
+    return conversation_service.append(conversation_id, message.role, message.content)
+
+@app.get("/conversations/{conversation_id}/export")
+async def export_conversation(conversation_id: str):
+    """The full log as Markdown, streamed from disk."""
+    _check_conversation_id(conversation_id)
+    if not conversation_service.exists(conversation_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    # Resolved now: the generator runs in a worker thread
+    vault_path = vault_service.vault_path
+
+    def markdown():
+        for message in conversation_service.iter_messages(conversation_id, vault_path):
+            yield f"**{message.get('role', 'user')}**: {message.get('content', '')}\n\n"
+
+    return StreamingResponse(markdown(), media_type="text/markdown")
+
+@app.delete("/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    _check_conversation_id(conversation_id)
+    if conversation_service.delete(conversation_id):
+        return {"status": "deleted"}
+    raise HTTPException(status_code=404, detail="Conversation not found")
+
 @app.post("/stop")
 async def stop_generation():
     # Global stop is deprecated in favor of per-request cancellation via disconnect
@@ -220,11 +789,14 @@ async def get_config():
     return {"vault_path": vault_service.vault_path}
 
 @app.post("/config")
-async def update_config(data: ConfigUpdate):
+async def update_config(data: ConfigUpdate, request: Request):
     if not data.vault_path:
         raise HTTPException(status_code=400, detail="Path required")
     
+    session_service.set(request.state.session_id, data.vault_path)
+    session_service.activate(data.vault_path)
     if vault_service.set_vault_path(data.vault_path):
+        kb_service.set_active_vault(data.vault_path)
         return {"status": "updated", "vault_path": data.vault_path}
     raise HTTPException(status_code=500, detail="Failed to save")
 
@@ -265,40 +837,272 @@ async def create_vault_file_route(data: VaultPathRequest):
         return {"status": "created", "path": result}
     raise HTTPException(status_code=400, detail=result)
 
+@app.post("/fact-check")
+async def fact_check_route(data: FactCheckRequest):
+    """Map-reduce fact check streamed as NDJSON: claim, verdict, ..., done."""
+    unavailable = _fail_fast_stream(ollama_breaker)
+    if unavailable is not None:
+        return unavailable
+    _ensure_lane_capacity("chat")
+
+    async def generate_verdicts():
+        async for event in fact_check_service.run(data.content):
+            yield dumps_line(event)
+
+    return StreamingResponse(generate_verdicts(), media_type="application/x-ndjson")
+
 @app.post("/vault/fix-grammar")
 async def fix_grammar_route(data: FixGrammarRequest):
-    prompt = (
-        "Correct the grammar, spelling, and punctuation of the following text. "
-        "Maintain the original tone and style. "
-        "IMPORTANT: RETURN ONLY THE CORRECTED TEXT. DO NOT EXPLAIN OR ADD CONVERSATIONAL FILLER.\n\n"
-        "### TEXT TO CORRECT:\n"
-        f"{data.content}"
-    )
+    route = await model_router.route("grammar")
+    if not data.no_cache:
+        cached = await response_cache.lookup(route["model"], "grammar", data.content)
+        if cached is not None:
+            return {"original": data.content, "fixed": cached, "cached": True}
+
+    # Only paragraphs the local pre-pass flags go to the model
+    segments, skipped = await grammar_review_service.plan(data.content)
+    if not segments:
+        return {"original": data.content, "fixed": data.content, "skipped": skipped}
 
-    corrected_text = ""
+    _ensure_available(ollama_breaker)
+    _ensure_lane_capacity("grammar")
+
+    parts = []
+    position = 0
+    failed = False
     try:
-        async for event_type, content in ask_ollama(prompt, []):
-            if event_type == "chunk":
-                corrected_text += content
-        
-        return {"original": data.content, "fixed": corrected_text}
+        for start, end in segments:
+            segment = data.content[start:end]
+            corrected_text = ""
+            segment_failed = False
+            async for event_type, content in ask_ollama(build_grammar_prompt(segment), [], lane="grammar", **route):
+                if event_type == "chunk":
+                    corrected_text += content
+                elif event_type == "error":
+                    segment_failed = True
+            failed = failed or segment_failed
+            parts.append(data.content[position:start])
+            # A failed segment stays as written rather than half-corrected
+            parts.append(segment if segment_failed or not corrected_text.strip() else corrected_text.strip())
+            position = end
+        parts.append(data.content[position:])
+        fixed = "".join(parts)
+
+        if not failed:
+            await response_cache.store(route["model"], "grammar", data.content, fixed)
+        return {"original": data.content, "fixed": fixed, "skipped": skipped}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/vault/sync")
 async def sync_vault_route():
+    """
+    Starts (or joins) a background indexing job for the active vault and streams its progress.
+    Closing the stream only detaches the client; the job keeps running.
+    """
     vault_path = vault_service.vault_path
     if not vault_path:
         raise HTTPException(status_code=400, detail="Vault path not set")
 
-    async def generate_progress():
-        async for progress in kb_service.sync_vault(vault_path):
-            yield json.dumps(progress) + "\n"
-            
-    return StreamingResponse(generate_progress(), media_type="application/x-ndjson")
+    job = indexing_service.start_job(vault_path)
+    return StreamingResponse(_job_progress(job, 0), media_type="application/x-ndjson")
+
+async def _job_progress(job, offset: int):
+    async for progress in job.stream(offset):
+        yield dumps_line(progress)
+
+@app.post("/vault/review")
+async def start_grammar_review(data: ReviewRequest):
+    """
+    Starts a grammar review session and streams word-level hunks as each part of the text is corrected.
+    Send `content` for an unsaved draft, or only `path` to review the file as stored in the vault.
+    """
+    unavailable = _fail_fast_stream(ollama_breaker)
+    if unavailable is not None:
+        return unavailable
+    _ensure_lane_capacity("grammar")
+    content = data.content
+    if content is None:
+        if not data.path:
+            raise HTTPException(status_code=400, detail="Content or path required")
+        try:
+            content = vault_service.read_file(data.path)
+        except ValueError as e:
+            raise HTTPException(status_code=403, detail=str(e))
+        if content is None:
+            raise HTTPException(status_code=404, detail="File not found")
+
+    session = await asyncio.to_thread(grammar_review_service.create_session, content, data.path, not data.no_cache)
+
+    async def generate_hunks():
+        async for event in grammar_review_service.run(session):
+            yield dumps_line(event)
+
+    return StreamingResponse(generate_hunks(), media_type="application/x-ndjson")
+
+@app.post("/vault/review/{session_id}/retry")
+async def retry_grammar_review(session_id: str):
+    """Re-runs the segments of a review session that failed, streaming like /vault/review."""
+    session = await asyncio.to_thread(grammar_review_service.get_session, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Review session not found")
+    if not session.failed:
+        raise HTTPException(status_code=409, detail="No failed segments to retry")
+    unavailable = _fail_fast_stream(ollama_breaker)
+    if unavailable is not None:
+        return unavailable
+    _ensure_lane_capacity("grammar")
+
+    async def generate_hunks():
+        async for event in grammar_review_service.run(session, retry=True):
+            yield dumps_line(event)
+
+    return StreamingResponse(generate_hunks(), media_type="application/x-ndjson")
+
+@app.get("/vault/review/{session_id}")
+async def get_grammar_review(session_id: str):
+    session = await asyncio.to_thread(grammar_review_service.get_session, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Review session not found")
+    return session.to_dict()
+
+@app.post("/vault/review/{session_id}/resolve")
+async def resolve_grammar_review(session_id: str, data: ReviewResolveRequest):
+    accepted: List[int] = []
+
+    def resolve(session):
+        accepted.extend(session.hunks if data.accept_all else data.accept)
+        session.resolve(accepted, data.reject)
+
+    session = await asyncio.to_thread(grammar_review_service.update_session, session_id, resolve)
+    if not session:
+        raise HTTPException(status_code=404, detail="Review session not found")
+    return {"id": session.id, "accepted": accepted, "rejected": data.reject}
+
+@app.post("/vault/review/{session_id}/apply")
+async def apply_grammar_review(session_id: str, data: ReviewApplyRequest):
+    """Applies accepted hunks and writes the result through the vault when a path is known."""
+    session = await asyncio.to_thread(grammar_review_service.get_session, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Review session not found")
+
+    result = session.result()
+    applied = sum(1 for h in session.hunks.values() if h["status"] == "accepted")
+    path = data.path or session.path
+    await asyncio.to_thread(grammar_review_service.discard_session, session_id)
+
+    if not path:
+        return {"status": "applied", "applied": applied, "content": result}
+    try:
+        if not vault_service.save_file(path, result):
+            raise HTTPException(status_code=500, detail="Failed to save file")
+    except ValueError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    return {"status": "saved", "applied": applied, "path": path}
+
+@app.delete("/vault/review/{session_id}")
+async def discard_grammar_review(session_id: str):
+    if await asyncio.to_thread(grammar_review_service.discard_session, session_id):
+        return {"status": "discarded"}
+    raise HTTPException(status_code=404, detail="Review session not found")
+
+@app.get("/vault/watch")
+async def get_vault_watch():
+    return vault_watcher.status()
+
+@app.post("/vault/watch")
+async def set_vault_watch(data: WatchToggle):
+    """Turns auto re-indexing of changed notes on or off."""
+    await vault_watcher.set_enabled(data.enabled)
+    return vault_watcher.status()
+
+@app.post("/vault/sync/jobs")
+async def start_sync_job():
+    vault_path = vault_service.vault_path
+    if not vault_path:
+        raise HTTPException(status_code=400, detail="Vault path not set")
+    return indexing_service.start_job(vault_path).to_dict()
+
+@app.get("/vault/sync/jobs")
+async def list_sync_jobs():
+    return indexing_service.list_jobs()
+
+@app.get("/vault/sync/jobs/{job_id}")
+async def get_sync_job(job_id: str):
+    job = indexing_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/vault/sync/jobs/{job_id}/stream")
+async def stream_sync_job(job_id: str, offset: int = 0):
+    job = indexing_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(_job_progress(job, offset), media_type="application/x-ndjson")
+
+@app.post("/vault/sync/jobs/{job_id}/cancel")
+async def cancel_sync_job(job_id: str):
+    job = indexing_service.cancel_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.post("/vault/sync/jobs/{job_id}/resume")
+async def resume_sync_job(job_id: str):
+    job = indexing_service.resume_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+# Lore entities extracted from World notes at sync time
+@app.get("/vault/entities")
+async def list_entities(type: Optional[str] = None):
+    return kb_service.list_entities(type)
+
+@app.get("/vault/entities/{name}")
+async def get_entity(name: str):
+    entity = kb_service.lookup_entity(name)
+    if not entity:
+        raise HTTPException(status_code=404, detail="Entity not found")
+    return entity
+
+# Wikilink graph (paths are relative to the vault, as in /vault/files)
+@app.get("/vault/links")
+async def get_note_links(path: str):
+    await link_service.load()
+    return link_service.links(path)
+
+@app.get("/vault/backlinks")
+async def get_backlinks(path: str):
+    await link_service.load()
+    return {"path": path, "backlinks": link_service.backlinks(path)}
+
+@app.get("/vault/links/unresolved")
+async def get_unresolved_links():
+    await link_service.load()
+    return link_service.unresolved()
+
+@app.get("/vault/graph")
+async def get_link_neighborhood(path: str, hops: int = 1, max_nodes: int = 200):
+    if not 0 <= hops <= 5:
+        raise HTTPException(status_code=400, detail="hops must be between 0 and 5")
+    await link_service.load()
+    return link_service.neighborhood(path, hops, max(1, min(max_nodes, 1000)))
 
 
 if __name__ == '__main__':
     import uvicorn
     port = int(os.getenv("BACKEND_PORT", 5000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("BACKEND_WORKERS", 1))
+    if workers > 1:
+        # Resumable generations are kept in one worker's memory, so a resume could miss them
+        if (os.getenv("CHAT_RESUMABLE") or "false").lower() in ("1", "true", "yes"):
+            raise SystemExit("CHAT_RESUMABLE=true needs BACKEND_WORKERS=1: generations can't be resumed across workers")
+        os.environ["CHAT_RESUMABLE"] = "false"
+        # Workers import the app themselves; run from backend/ so "app:app" resolves
+        uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import shutil
+import struct
+import asyncio
+import logging
+import zipfile
+from typing import List, Dict, Any, Optional, IO, Union, Tuple
+
+from project_service import project_service
+from knowledge_base_service import kb_service
+from storage import state_path, read_json, write_json_atomic, vault_key
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_FORMAT = "luna-project-bundle"
+BUNDLE_VERSION = 1
+KINDS = ("world", "novel")
+
+
+def _portable(path: str) -> str:
+    return path.replace(os.sep, "/")
+
+
+def _local(path: str) -> str:
+    return path.replace("/", os.sep)
+
+
+class BundleService:
+    """
+    Exports a project as one zip bundle and restores it elsewhere without re-embedding.
+
+    Layout:
+        manifest.json               format, embedding model and dimension, chunk counts
+        project.json                the project file, minus its machine-specific vault path
+        vault/<path>                every file of the vault
+        index/<kind>/<page>.f16     little-endian float16 embeddings, one row per chunk
+        index/<kind>/<page>.jsonl   the chunks of those rows: id, document, metadata
+        entities.json               the lore entity index, so it isn't extracted again
+
+    Chunks are read from and written to Chroma a page at a time, and vault files are
+    copied through file objects, so neither direction holds the whole project in memory.
+    Paths inside the bundle use forward slashes whatever the exporting OS.
+    """
+
+    def __init__(self) -> None:
+        self.page_size = int(os.getenv("BUNDLE_PAGE_SIZE", 512))
+
+    # Export
+
+    async def export_project(self, name: str, dest_path: str) -> Dict[str, Any]:
+        project = project_service.load_project(name)
+        if not project:
+            raise LookupError(f"Project '{name}' not found")
+        vault_path = project["config"]["vault_path"]
+        project_file = f"{name}.json"
+
+        with tracer.span("bundle.export", project=name):
+            with zipfile.ZipFile(dest_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                files = await asyncio.to_thread(self._write_vault, zf, vault_path, project_file)
+                counts, dim = {}, None
+                for kind, col in zip(KINDS, await kb_service.get_collections(vault_path)):
+                    counts[kind], page_dim = await self._write_index(zf, kind, col)
+                    dim = dim or page_dim
+
+                entities = read_json(state_path("entities", f"{vault_key(vault_path)}.json"))
+                if entities:
+                    zf.writestr("entities.json", json.dumps(self._convert_entities(entities, _portable)))
+
+                data = {k: v for k, v in project.items() if k != "config"}
+                data["config"] = {k: v for k, v in project["config"].items() if k != "vault_path"}
+                zf.writestr("project.json", json.dumps(data, indent=4))
+
+                manifest = {
+                    "format": BUNDLE_FORMAT,
+                    "version": BUNDLE_VERSION,
+                    "project": name,
+                    "created": time.time(),
+                    "embedding_model": kb_service.model,
+                    "dim": dim,
+                    "chunks": counts,
+                    "files": files,
+                }
+                zf.writestr("manifest.json", json.dumps(manifest, indent=4))
+        return manifest
+
+    @staticmethod
+    def _write_vault(zf: zipfile.ZipFile, vault_path: str, project_file: str) -> int:
+        count = 0
+        for root, dirs, names in os.walk(vault_path):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            for file_name in names:
+                full_path = os.path.join(root, file_name)
+                rel_path = os.path.relpath(full_path, vault_path)
+                if rel_path == project_file or os.path.islink(full_path):
+                    continue
+                zf.write(full_path, f"vault/{_portable(rel_path)}")
+                count += 1
+        return count
+
+    async def _write_index(self, zf: zipfile.ZipFile, kind: str, col: Any) -> Tuple[int, Optional[int]]:
+        offset, page_no, written, dim = 0, 0, 0, None
+        while True:
+            page = await col.get(include=["embeddings", "documents", "metadatas"], limit=self.page_size, offset=offset)
+            ids = page["ids"]
+            if not len(ids):
+                break
+            offset += len(ids)
+            embeddings = page["embeddings"]
+            rows, vectors = [], []
+            for i, chunk_id in enumerate(ids):
+                vector = embeddings[i] if embeddings is not None else None
+                if vector is None or not len(vector):
+                    continue
+                dim = dim or len(vector)
+                metadata = dict(page["metadatas"][i] or {})
+                if "source" in metadata:
+                    metadata["source"] = _portable(metadata["source"])
+                rows.append({"id": _portable(chunk_id), "document": page["documents"][i], "metadata": metadata})
+                vectors.append(vector)
+            if rows:
+                await asyncio.to_thread(self._write_page, zf, f"index/{kind}/{page_no:05d}", rows, vectors, dim)
+                page_no += 1
+                written += len(rows)
+        return written, dim
+
+    @staticmethod
+    def _write_page(zf: zipfile.ZipFile, stem: str, rows: List[Dict[str, Any]], vectors: List[Any], dim: int) -> None:
+        row_format = struct.Struct(f"<{dim}e")
+        # Float data barely deflates; store it as is
+        with zf.open(zipfile.ZipInfo(f"{stem}.f16"), "w") as f:
+            for vector in vectors:
+                f.write(row_format.pack(*map(float, vector)))
+        zf.writestr(f"{stem}.jsonl", "".join(json.dumps(row) + "\n" for row in rows))
+
+    # Import
+
+    async def import_project(
+        self, bundle: Union[str, IO[bytes]], vault_path: str, name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Restores a bundle into `vault_path` (which must be missing or empty) and registers
+        the project. Its chunks go straight into the vault's collections, so search works
+        right away without calling the embedding model. If any step fails the extracted
+        files, collections and entity index are removed again, so the import can be retried.
+        """
+        with zipfile.ZipFile(bundle) as zf:
+            try:
+                manifest = json.loads(zf.read("manifest.json"))
+            except KeyError:
+                raise ValueError("Not a project bundle: manifest.json is missing")
+            if manifest.get("format") != BUNDLE_FORMAT or manifest.get("version") != BUNDLE_VERSION:
+                raise ValueError("Unsupported bundle format or version")
+            if manifest.get("embedding_model") != kb_service.model:
+                raise ValueError(
+                    f"Bundle was embedded with {manifest.get('embedding_model')}, this server uses {kb_service.model}"
+                )
+            name = name or manifest["project"]
+            if project_service.load_project(name):
+                raise FileExistsError(f"Project '{name}' already exists")
+            if os.path.isdir(vault_path) and os.listdir(vault_path):
+                raise FileExistsError(f"{vault_path} is not empty")
+
+            created = not os.path.isdir(vault_path)
+            entities_path = state_path("entities", f"{vault_key(vault_path)}.json")
+            with tracer.span("bundle.import", project=name):
+                try:
+                    await asyncio.to_thread(self._extract_vault, zf, vault_path)
+                    counts = await self._read_index(zf, vault_path, manifest.get("dim"))
+
+                    if "entities.json" in zf.namelist():
+                        entities = self._convert_entities(json.loads(zf.read("entities.json")), _local)
+                        await asyncio.to_thread(write_json_atomic, entities_path, entities)
+
+                    project = json.loads(zf.read("project.json"))
+                    project.setdefault("config", {})["vault_path"] = vault_path
+                    await asyncio.to_thread(project_service.store_project, name, vault_path, project)
+                except BaseException:
+                    logger.warning(f"Import of '{name}' into {vault_path} failed, rolling it back")
+                    await asyncio.shield(self._rollback(vault_path, created, entities_path))
+                    raise
+
+        return {"project": name, "vault_path": vault_path, "chunks": counts, "files": manifest.get("files", 0)}
+
+    @staticmethod
+    def _extract_vault(zf: zipfile.ZipFile, vault_path: str) -> None:
+        root = os.path.realpath(vault_path)
+        os.makedirs(root, exist_ok=True)
+        for info in zf.infolist():
+            if not info.filename.startswith("vault/") or info.is_dir():
+                continue
+            target = os.path.realpath(os.path.join(root, _local(info.filename[len("vault/"):])))
+            if not target.startswith(root + os.sep):
+                raise ValueError(f"Unsafe path in bundle: {info.filename}")
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zf.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+    async def _rollback(self, vault_path: str, created: bool, entities_path: str) -> None:
+        """Undoes a failed import: the vault goes back to missing or empty, the index to nothing."""
+        try:
+            await self._drop_collections(vault_path)
+        except Exception as e:
+            logger.error(f"Could not drop the collections of {vault_path}: {e}")
+        await asyncio.to_thread(self._clear_vault, vault_path, created)
+        try:
+            os.remove(entities_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _clear_vault(vault_path: str, created: bool) -> None:
+        if created:
+            shutil.rmtree(vault_path, ignore_errors=True)
+            return
+        # The folder was there (empty) before the import: keep it, remove what went in
+        for entry in os.scandir(vault_path):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+    @staticmethod
+    async def _drop_collections(vault_path: str) -> None:
+        client = await kb_service.get_client()
+        for collection_name in kb_service.collection_names(vault_path):
+            try:
+                await client.delete_collection(collection_name)
+            except Exception:
+                pass
+
+    async def _read_index(self, zf: zipfile.ZipFile, vault_path: str, dim: Optional[int]) -> Dict[str, int]:
+        # Replace whatever an earlier index of this path held
+        await self._drop_collections(vault_path)
+        collections = dict(zip(KINDS, await kb_service.get_collections(vault_path)))
+
+        counts = {kind: 0 for kind in KINDS}
+        names = set(zf.namelist())
+        for kind in KINDS:
+            for stem in sorted(n[:-len(".jsonl")] for n in names if n.startswith(f"index/{kind}/") and n.endswith(".jsonl")):
+                ids, documents, metadatas, embeddings = await asyncio.to_thread(self._read_page, zf, stem, dim)
+                if ids:
+                    await collections[kind].add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+                    counts[kind] += len(ids)
+        return counts
+
+    @staticmethod
+    def _read_page(zf: zipfile.ZipFile, stem: str, dim: int) -> Tuple[List[str], List[str], List[Dict[str, Any]], List[List[float]]]:
+        ids, documents, metadatas = [], [], []
+        with zf.open(f"{stem}.jsonl") as f:
+            for line in f:
+                row = json.loads(line)
+                metadata = row["metadata"]
+                if "source" in metadata:
+                    metadata["source"] = _local(metadata["source"])
+                ids.append(_local(row["id"]))
+                documents.append(row["document"])
+                metadatas.append(metadata)
+        row_format = struct.Struct(f"<{dim}e")
+        with zf.open(f"{stem}.f16") as f:
+            raw = f.read(row_format.size * len(ids))
+        if len(raw) != row_format.size * len(ids):
+            raise ValueError(f"Truncated embeddings in {stem}.f16")
+        embeddings = [list(values) for values in row_format.iter_unpack(raw)]
+        return ids, documents, metadatas, embeddings
+
+    @staticmethod
+    def _convert_entities(data: Dict[str, Any], convert) -> Dict[str, Any]:
+        """Rewrites the note paths and chunk ids of an entity index with `convert`."""
+        files = {}
+        for rel_path, entry in data.get("files", {}).items():
+            entities = [{**entity, "chunks": [convert(c) for c in entity.get("chunks", [])]}
+                        for entity in entry.get("entities", [])]
+            files[convert(rel_path)] = {**entry, "entities": entities}
+        return {**data, "files": files}
+
+# Global instance
+bundle_service = BundleService()
@@ -0,0 +1,230 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Callable, Awaitable, Iterator
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, dependency: str, retry_in: float, last_error: Optional[str] = None) -> None:
+        self.dependency = dependency
+        self.retry_in = retry_in
+        self.last_error = last_error
+        super().__init__(f"{dependency} is unavailable; retrying in {retry_in:.0f}s")
+
+    def to_event(self) -> Dict[str, Any]:
+        """Structured NDJSON error event for the streaming endpoints."""
+        return {
+            "type": "error",
+            "content": str(self),
+            "code": "dependency_unavailable",
+            "dependency": self.dependency,
+            "retry_in": round(self.retry_in, 1),
+        }
+
+
+def is_connection_error(error: BaseException) -> bool:
+    """Failures that say the service is unreachable, as opposed to a bad request."""
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return "could not connect" in str(error).lower()
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one dependency (Ollama, Chroma, the mood model).
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail
+    immediately with CircuitOpenError instead of each waiting on its own timeout.
+    While open, the registered `probe` is retried with exponential backoff (with
+    jitter) by BreakerMonitor; the first successful probe closes the circuit. A
+    breaker without a probe lets requests through again once the backoff expires.
+    `probe_timeout` overrides the monitor's for a probe that can take long.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        is_failure: Callable[[BaseException], bool] = is_connection_error,
+        probe_timeout: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.is_failure = is_failure
+        self.probe: Optional[Callable[[], Awaitable[bool]]] = None
+        self.probe_timeout = probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0  # Consecutive openings, drives the backoff
+        self.next_probe = 0.0
+        self.last_error: Optional[str] = None
+        self.changed_at = time.time()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.info(f"Circuit for {self.name}: {self.state} -> {state}")
+            self.state = state
+            self.changed_at = time.time()
+
+    def retry_in(self) -> float:
+        return max(0.0, self.next_probe - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.probe is None and time.monotonic() >= self.next_probe:
+            self._set_state(self.HALF_OPEN)
+        return self.state == self.HALF_OPEN and self.probe is None
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_in(), self.last_error)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.trips = 0
+        self._set_state(self.CLOSED)
+
+    def record_failure(self, error: Any = None) -> None:
+        self.failures += 1
+        self.last_error = str(error) if error is not None else self.last_error
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip()
+
+    def record_error(self, error: BaseException) -> None:
+        """Counts `error` against the dependency only if it looks like an outage."""
+        if self.is_failure(error):
+            self.record_failure(error)
+
+    def trip(self, error: Any = None) -> None:
+        """Opens the circuit now (e.g. a failed health check) and schedules the next probe."""
+        if error is not None:
+            self.last_error = str(error)
+        self.trips += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.trips - 1))
+        self.next_probe = time.monotonic() + backoff * random.uniform(0.8, 1.2)
+        self._set_state(self.OPEN)
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """Fails fast while open; records the outcome of the wrapped call."""
+        self.check()
+        try:
+            yield
+        except Exception as e:
+            self.record_error(e)
+            raise
+        else:
+            if self.state != self.CLOSED or self.failures:
+                self.record_success()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": round(self.retry_in(), 1) if self.state != self.CLOSED else 0,
+            "last_error": self.last_error,
+            "since": self.changed_at,
+        }
+
+
+class BreakerMonitor:
+    """
+    Background task that runs the probes of open breakers when their backoff expires.
+    Each probe runs on its own, so a slow one doesn't hold back the others.
+    """
+
+    TICK = 0.5
+
+    def __init__(self, breakers: Dict[str, CircuitBreaker]) -> None:
+        self.breakers = breakers
+        self.probe_timeout = float(os.getenv("BREAKER_PROBE_TIMEOUT", 5))
+        self._task: Optional[asyncio.Task] = None
+        self._probing: Dict[str, asyncio.Task] = {}
+
+    def start(self, check_now: bool = False) -> None:
+        """With `check_now`, every probe runs once right away (a startup check that doesn't block)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(check_now))
+
+    async def stop(self) -> None:
+        tasks = [task for task in (self._task, *self._probing.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._probing.clear()
+
+    def _launch(self, breaker: CircuitBreaker, initial: bool = False) -> None:
+        task = asyncio.create_task(self.run_probe(breaker, initial))
+        self._probing[breaker.name] = task
+        task.add_done_callback(lambda _: self._probing.pop(breaker.name, None))
+
+    async def _run(self, check_now: bool) -> None:
+        if check_now:
+            for breaker in self.breakers.values():
+                if breaker.probe is not None:
+                    self._launch(breaker, initial=True)
+        while True:
+            for breaker in self.breakers.values():
+                if (
+                    breaker.state == CircuitBreaker.OPEN and breaker.probe is not None
+                    and breaker.name not in self._probing and time.monotonic() >= breaker.next_probe
+                ):
+                    self._launch(breaker)
+            await asyncio.sleep(self.TICK)
+
+    async def run_probe(self, breaker: CircuitBreaker, initial: bool = False) -> bool:
+        if not initial:
+            breaker._set_state(CircuitBreaker.HALF_OPEN)
+        timeout = breaker.probe_timeout if breaker.probe_timeout is not None else self.probe_timeout
+        try:
+            healthy = await asyncio.wait_for(breaker.probe(), timeout)
+        except Exception as e:
+            healthy = False
+            breaker.last_error = str(e) or type(e).__name__
+        if healthy:
+            breaker.record_success()
+        else:
+            breaker.trip()
+        return healthy
+
+
+_threshold = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 3))
+_max_backoff = float(os.getenv("BREAKER_MAX_BACKOFF", 60))
+
+# One breaker per external dependency
+ollama_breaker = CircuitBreaker("ollama", _threshold, max_backoff=_max_backoff)
+chroma_breaker = CircuitBreaker("chroma", _threshold, max_backoff=_max_backoff)
+# Any exception from the classifier counts: it runs in-process. Its probe loads the model,
+# which on a cold start (or the first run, when it is downloaded) takes far longer than a ping
+mood_breaker = CircuitBreaker(
+    "mood_model", _threshold, max_backoff=_max_backoff, is_failure=lambda e: True,
+    probe_timeout=float(os.getenv("MOOD_PROBE_TIMEOUT", 120))
+)
+# No probe: the reranker loads lazily, so it is simply retried once the backoff expires
+rerank_breaker = CircuitBreaker("reranker", _threshold, max_backoff=_max_backoff, is_failure=lambda e: True)
+
+BREAKERS = {b.name: b for b in (ollama_breaker, chroma_breaker, mood_breaker, rerank_breaker)}
+breaker_monitor = BreakerMonitor(BREAKERS)
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    return {name: breaker.to_dict() for name, breaker in BREAKERS.items()}
@@ -0,0 +1,152 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+from storage import state_path
+from ndjson import dumps_line
+from vault_service import vault_service
+from knowledge_base_service import kb_service
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+class ConversationService:
+    """
+    Server-side chat history, one append-only NDJSON log per conversation,
+    grouped by project (vault). Clients send only the new message and the
+    conversation id; the model context comes from an in-memory tail of the log.
+
+    The tail is validated against the log size on every read, so a message
+    appended by another worker is picked up without re-reading the whole file.
+    """
+
+    def __init__(self) -> None:
+        self.tail_size = int(os.getenv("CONVERSATION_TAIL", 50))
+        self.cache_size = int(os.getenv("CONVERSATION_CACHE_SIZE", 64))
+        # log path -> (log size when cached, last `tail_size` messages)
+        self._tails: "OrderedDict[str, Tuple[int, deque]]" = OrderedDict()
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def is_valid_id(conversation_id: Optional[str]) -> bool:
+        return bool(conversation_id and CONVERSATION_ID_RE.match(conversation_id))
+
+    def _folder(self, vault_path: Optional[str] = None) -> str:
+        vault_path = vault_path or vault_service.vault_path
+        if not vault_path:
+            raise LookupError("No project is open; conversations are stored per project")
+        return os.path.dirname(state_path("conversations", kb_service.project_key(vault_path), ""))
+
+    def _log_path(self, conversation_id: str, vault_path: Optional[str] = None) -> str:
+        if not self.is_valid_id(conversation_id):
+            raise ValueError(f"Invalid conversation id: {conversation_id!r}")
+        return os.path.join(self._folder(vault_path), f"{conversation_id}.jsonl")
+
+    def append(self, conversation_id: str, role: str, content: str, vault_path: Optional[str] = None) -> Dict[str, Any]:
+        path = self._log_path(conversation_id, vault_path)
+        message = {"role": role, "content": content, "ts": time.time()}
+        line = dumps_line(message)
+        # A single O_APPEND write, so concurrent writers never interleave within a line
+        with open(path, "ab") as f:
+            start = f.tell()
+            f.write(line)
+            end = f.tell()
+
+        cached = self._tails.get(path)
+        if cached is not None and cached[0] == start:
+            cached[1].append(message)
+            self._tails[path] = (end, cached[1])
+            self._tails.move_to_end(path)
+        else:
+            # Someone else wrote in between: reload on next read
+            self._tails.pop(path, None)
+        return message
+
+    def tail(self, conversation_id: str, limit: Optional[int] = None, vault_path: Optional[str] = None) -> List[Dict[str, Any]]:
+        """The last `limit` messages (at most `tail_size`), oldest first."""
+        path = self._log_path(conversation_id, vault_path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return []
+
+        cached = self._tails.get(path)
+        if cached is None or cached[0] != size:
+            cached = (size, deque(self._read_tail(path, size, self.tail_size), maxlen=self.tail_size))
+            self._tails[path] = cached
+            while len(self._tails) > self.cache_size:
+                self._tails.popitem(last=False)
+        self._tails.move_to_end(path)
+
+        messages = list(cached[1])
+        return messages[-limit:] if limit else messages
+
+    @staticmethod
+    def _read_tail(path: str, size: int, count: int, block: int = 16384) -> List[Dict[str, Any]]:
+        """Parses the last `count` lines of the first `size` bytes, reading backwards in blocks."""
+        data = b""
+        with open(path, "rb") as f:
+            pos = size
+            while pos > 0 and data.count(b"\n") <= count:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = data.splitlines()
+        if pos > 0:
+            lines = lines[1:]  # The first line may be cut
+        messages = []
+        for raw in lines[-count:]:
+            try:
+                messages.append(json.loads(raw))
+            except ValueError:
+                logger.warning(f"Skipping corrupt line in {path}")
+        return messages
+
+    def iter_messages(self, conversation_id: str, vault_path: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Streams the whole log (for summaries and exports) without holding it in memory."""
+        path = self._log_path(conversation_id, vault_path)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            for raw in f:
+                try:
+                    yield json.loads(raw)
+                except ValueError:
+                    continue
+
+    def exists(self, conversation_id: str, vault_path: Optional[str] = None) -> bool:
+        return os.path.exists(self._log_path(conversation_id, vault_path))
+
+    def list_conversations(self, vault_path: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not (vault_path or vault_service.vault_path):
+            return []
+        conversations = []
+        with os.scandir(self._folder(vault_path)) as entries:
+            for entry in entries:
+                if entry.name.endswith(".jsonl"):
+                    stat = entry.stat()
+                    conversations.append({"id": entry.name[:-len(".jsonl")], "updated": stat.st_mtime, "size": stat.st_size})
+        return sorted(conversations, key=lambda c: c["updated"], reverse=True)
+
+    def delete(self, conversation_id: str, vault_path: Optional[str] = None) -> bool:
+        path = self._log_path(conversation_id, vault_path)
+        self._tails.pop(path, None)
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+# Global instance
+conversation_service = ConversationService()
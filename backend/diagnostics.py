@@ -0,0 +1,281 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import tracemalloc
+from collections import Counter, deque
+from typing import List, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Leaf frames of threads that are just waiting (event loop poll, idle executor workers)
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+
+def _frame_label(frame: Any) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _frame_stack(frame: Any, limit: int = 30) -> List[str]:
+    """Frames from the outermost caller to `frame`."""
+    stack = []
+    while frame is not None and len(stack) < limit:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    return stack[::-1]
+
+
+def rss_bytes() -> Optional[int]:
+    """Resident memory of this process, where the OS exposes it cheaply (Linux)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class SamplingProfiler:
+    """
+    Statistical CPU profiler: samples the stack of every thread `hz` times a second
+    for a while and returns them in the collapsed format flamegraph.pl and speedscope
+    read ("thread;outer;...;inner count" per line). Costs nothing unless running.
+    """
+
+    MAX_SECONDS = 60.0
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, seconds: float, hz: float = 100, idle: bool = False) -> str:
+        """Blocks for `seconds` (run it in a thread). Raises RuntimeError if a profile is already running."""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            seconds = min(max(seconds, 0.1), self.MAX_SECONDS)
+            interval = 1.0 / min(max(hz, 1.0), 1000.0)
+            own = threading.get_ident()
+            stacks: Counter = Counter()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    code = frame.f_code
+                    if not idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                        continue
+                    stack = [names.get(ident, str(ident))]
+                    stack += [
+                        label.rsplit(":", 1)[0] + ")"  # Without line numbers, so a function is one box
+                        for label in _frame_stack(frame, limit=200)
+                    ]
+                    stacks[";".join(stack)] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        finally:
+            self._lock.release()
+
+
+class MemoryTracker:
+    """
+    tracemalloc on demand. Each snapshot is compared with the previous one (the first
+    with the moment tracking started), so repeated calls show what keeps growing.
+    Python allocations are only traced between start() and stop().
+    """
+
+    def __init__(self) -> None:
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 25) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._previous = self._take()
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self._previous = None
+
+    @staticmethod
+    def _take() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def snapshot(self, limit: int = 25, key_type: str = "lineno") -> Dict[str, Any]:
+        """Top differences since the last snapshot, by `key_type` (lineno, traceback or filename)."""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Memory tracking is not running")
+        current = self._take()
+        stats = current.compare_to(self._previous, key_type) if self._previous else current.statistics(key_type)
+        self._previous = current
+        traced, peak = tracemalloc.get_traced_memory()
+        return {
+            "rss": rss_bytes(),
+            "traced": traced,
+            "peak": peak,
+            "top": [
+                {
+                    "where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                    "size": stat.size,
+                    "size_diff": getattr(stat, "size_diff", stat.size),
+                    "count": stat.count,
+                    "count_diff": getattr(stat, "count_diff", stat.count),
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+
+class LoopMonitor:
+    """
+    Event-loop lag and blocking callbacks, only while enabled.
+
+    A heartbeat task measures how late each short sleep wakes up (the lag). A watchdog
+    thread notices when the heartbeat stops for longer than `slow_callback` and records
+    the loop thread's stack at that moment, i.e. whatever callback is hogging the loop.
+    This works the same on asyncio's and uvloop's loops.
+    """
+
+    def __init__(self) -> None:
+        self.interval = float(os.getenv("DIAG_LOOP_INTERVAL", 0.1))
+        self.slow_callback = float(os.getenv("DIAG_SLOW_CALLBACK_MS", 100)) / 1000
+        self.enabled = False
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self.samples = 0
+        self.blocked: deque = deque(maxlen=50)
+        self._beat = 0.0
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self, slow_callback_ms: Optional[float] = None) -> None:
+        if slow_callback_ms is not None:
+            self.slow_callback = slow_callback_ms / 1000
+        if self.enabled:
+            return
+        self.enabled = True
+        self.lag_last = self.lag_max = self.lag_total = 0.0
+        self.samples = 0
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Event loop monitor on (slow callbacks >= {self.slow_callback * 1000:.0f} ms)")
+
+    async def stop(self) -> None:
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.to_thread(self._thread.join, 1.0)
+        self._task = self._thread = None
+        logger.info("Event loop monitor off")
+
+    async def _heartbeat(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self._beat = time.monotonic()
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_total += lag
+            self.samples += 1
+
+    def _watchdog(self) -> None:
+        stall: Optional[Dict[str, Any]] = None
+        while not self._stop.wait(self.interval / 2):
+            behind = time.monotonic() - self._beat - self.interval
+            if behind >= self.slow_callback:
+                if stall is None:
+                    frame = sys._current_frames().get(self._loop_thread)
+                    stall = {"at": time.time(), "blocked_for": behind, "stack": _frame_stack(frame) if frame else []}
+                    self.blocked.append(stall)
+                    where = stall["stack"][-1] if stall["stack"] else "unknown"
+                    logger.warning(f"Event loop blocked for {behind * 1000:.0f} ms so far, in {where}")
+                else:
+                    stall["blocked_for"] = behind
+            elif stall is not None:
+                logger.warning(f"Event loop was blocked for {stall['blocked_for'] * 1000:.0f} ms")
+                stall = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "interval": self.interval,
+            "slow_callback_ms": self.slow_callback * 1000,
+            "lag_last": self.lag_last,
+            "lag_max": self.lag_max,
+            "lag_avg": self.lag_total / self.samples if self.samples else 0.0,
+            "samples": self.samples,
+            "blocked": list(self.blocked),
+        }
+
+
+def await_chain(coro: Any, limit: int = 20) -> List[str]:
+    """Where a suspended coroutine is, following what it awaits down to the innermost frame."""
+    frames = []
+    while coro is not None and len(frames) < limit:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(_frame_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return frames
+
+
+def describe_task(task: asyncio.Task, started: float, **info: Any) -> Dict[str, Any]:
+    stack = await_chain(task.get_coro())
+    return {
+        **info,
+        "name": task.get_name(),
+        "age": round(time.time() - started, 3),
+        "awaiting": stack[-1] if stack else None,
+        "stack": stack,
+    }
+
+
+class InflightTasks:
+    """Long-running request work (chat generations) with when it started, for the admin task list."""
+
+    def __init__(self) -> None:
+        self._tasks: Dict[asyncio.Task, Dict[str, Any]] = {}
+
+    def add(self, task: asyncio.Task, kind: str, **info: Any) -> None:
+        self._tasks[task] = {"kind": kind, "started": time.time(), **info}
+        task.add_done_callback(self._discard)
+
+    def _discard(self, task: asyncio.Task) -> None:
+        self._tasks.pop(task, None)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [describe_task(task, **entry) for task, entry in sorted(self._tasks.items(), key=lambda t: t[1]["started"])]
+
+# Global instances
+sampling_profiler = SamplingProfiler()
+memory_tracker = MemoryTracker()
+loop_monitor = LoopMonitor()
+inflight_tasks = InflightTasks()
@@ -0,0 +1,216 @@
+import os
+import re
+import time
+import hashlib
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+from general_functions import generate_json
+from ollama_scheduler import ollama_scheduler, QueueFullError
+from storage import state_path, read_json, update_json
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+ENTITY_TYPES = ("character", "place", "faction", "date")
+
+EXTRACT_SYSTEM = (
+    "You build an index of a fiction writer's worldbuilding notes. "
+    "List the named characters, places, factions (groups, orders, houses, nations) and dates or eras "
+    "mentioned in the text. Use the name as written; put other names for the same entity in aliases. "
+    'Reply with JSON: {"entities": [{"name": "...", "type": "character" | "place" | "faction" | "date", '
+    '"aliases": ["..."], "summary": "one short sentence from the text"}]}. '
+    'Reply {"entities": []} if there are none.'
+)
+
+
+def normalize_name(name: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", name.lower())).strip()
+
+
+class EntityService:
+    """
+    Lore entities (characters, places, factions, dates) of each vault's World notes,
+    with the chunk ids they were found in. Extracted by a small model while a note is
+    indexed, persisted per vault, and served from memory.
+
+    Each note's entry records a hash of its text, so a sync that re-indexes unchanged
+    notes doesn't run extraction again.
+
+    Extraction shares the summary lane with fact checks, so fewer chunks are in flight
+    than the lane queues and a full lane is retried with backoff. A note with chunks
+    that still failed keeps the ones that succeeded and is retried on a later index,
+    not before a backoff, and at most ENTITY_MAX_ATTEMPTS times for the same text.
+    """
+
+    RETRY_BACKOFF = 60.0
+
+    def __init__(self) -> None:
+        self.enabled = os.getenv("ENTITY_INDEX", "true").lower() in ("1", "true", "yes")
+        self.retries = int(os.getenv("ENTITY_RETRIES", 3))
+        self.max_attempts = int(os.getenv("ENTITY_MAX_ATTEMPTS", 5))
+        concurrency = int(os.getenv("ENTITY_CONCURRENCY", 2))
+        lane = ollama_scheduler.lanes.get("summary")
+        if lane is not None and lane.max_queue:
+            concurrency = min(concurrency, max(1, lane.max_queue - 1))
+        self._calls = asyncio.Semaphore(concurrency)
+        # vault key -> (index file mtime, {"files": {rel_path: entry}}, {normalized name: entity})
+        self._indexes: Dict[str, Tuple[float, Dict[str, Any], Dict[str, Dict[str, Any]]]] = {}
+
+    def _path(self, key: str) -> str:
+        return state_path("entities", f"{key}.json")
+
+    def _load(self, key: str) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+        """The vault's index, re-read only when another worker (or run) changed the file."""
+        path = self._path(key)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else 0.0
+        cached = self._indexes.get(key)
+        if cached is None or cached[0] != mtime:
+            data = read_json(path, {"files": {}}) or {"files": {}}
+            cached = (mtime, data, self._build_lookup(data))
+            self._indexes[key] = cached
+        return cached[1], cached[2]
+
+    @staticmethod
+    def _build_lookup(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Merges the per-note entries into one entity per name, reachable by name and aliases."""
+        entities: Dict[str, Dict[str, Any]] = {}
+        lookup: Dict[str, Dict[str, Any]] = {}
+        for rel_path, entry in sorted(data.get("files", {}).items()):
+            for found in entry.get("entities", []):
+                key = normalize_name(found["name"])
+                entity = entities.get(key) or lookup.get(key)
+                if entity is None:
+                    entity = {"name": found["name"], "type": found["type"], "aliases": [],
+                              "summary": found.get("summary", ""), "sources": [], "chunks": []}
+                    entities[key] = entity
+                for alias in found.get("aliases", []):
+                    if alias not in entity["aliases"] and alias != entity["name"]:
+                        entity["aliases"].append(alias)
+                if rel_path not in entity["sources"]:
+                    entity["sources"].append(rel_path)
+                entity["chunks"] += [c for c in found.get("chunks", []) if c not in entity["chunks"]]
+                for name in [entity["name"], *entity["aliases"]]:
+                    lookup.setdefault(normalize_name(name), entity)
+        return lookup
+
+    async def extract(self, text: str, route: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """`route` holds the model arguments of the extraction task (see model_router)."""
+        with tracer.span("entities.extract", chars=len(text)):
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self._calls:
+                        data = await generate_json(
+                            f"### NOTES:\n{text}", system=EXTRACT_SYSTEM, lane="summary", **(route or {})
+                        )
+                    break
+                except QueueFullError:
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+        if data is None:
+            raise RuntimeError("no usable reply from the extraction model")
+        found = []
+        for item in (data or {}).get("entities", []) if isinstance(data, dict) else []:
+            if not isinstance(item, dict):
+                continue
+            name = str(item.get("name", "")).strip()
+            kind = str(item.get("type", "")).lower().strip()
+            if not name or kind not in ENTITY_TYPES:
+                continue
+            aliases = [str(a).strip() for a in item.get("aliases") or [] if str(a).strip()]
+            found.append({"name": name, "type": kind, "aliases": aliases, "summary": str(item.get("summary", "")).strip()})
+        return found
+
+    async def update_file(
+        self, key: str, rel_path: str, text: str, chunks: List[Tuple[str, str]], route: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        Re-extracts a note's entities from its (chunk id, text) pairs unless the note is
+        unchanged since the last extraction, or its last attempt failed too recently.
+        Returns True when extraction ran.
+        """
+        if not self.enabled:
+            return False
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        data, _ = self._load(key)
+        previous = data.get("files", {}).get(rel_path, {})
+        if previous.get("hash") == digest:
+            return False
+        # Chunks that succeeded in an earlier, partly failed attempt at this same text
+        retrying = previous.get("pending") == digest
+        if retrying and time.time() < previous.get("retry_at", 0):
+            return False
+        done: Dict[str, List[Dict[str, Any]]] = previous.get("done", {}) if retrying else {}
+        attempts = previous.get("attempts", 0) + 1 if retrying else 1
+
+        chunk_digests = [hashlib.sha1(chunk.encode("utf-8")).hexdigest() for _, chunk in chunks]
+        todo = [(chunk, chunk_digest) for (_, chunk), chunk_digest in zip(chunks, chunk_digests) if chunk_digest not in done]
+        results = await asyncio.gather(*(self.extract(chunk, route) for chunk, _ in todo), return_exceptions=True)
+        failed = 0
+        for (_, chunk_digest), found in zip(todo, results):
+            if isinstance(found, Exception):
+                logger.error(f"Entity extraction failed for a chunk of {rel_path}: {found}")
+                failed += 1
+            else:
+                done[chunk_digest] = found
+
+        merged: Dict[str, Dict[str, Any]] = {}
+        for (chunk_id, _), chunk_digest in zip(chunks, chunk_digests):
+            for entity in done.get(chunk_digest, []):
+                current = merged.setdefault(normalize_name(entity["name"]), {**entity, "aliases": [], "chunks": []})
+                current["aliases"] += [a for a in entity["aliases"] if a not in current["aliases"]]
+                current["chunks"].append(chunk_id)
+
+        entry: Dict[str, Any] = {"hash": digest, "entities": list(merged.values())}
+        if failed and attempts < self.max_attempts:
+            # Without the hash, the note is extracted again on a later index (only its failed chunks)
+            entry.update(hash=None, pending=digest, done=done, attempts=attempts,
+                         retry_at=time.time() + self.RETRY_BACKOFF * 2 ** (attempts - 1))
+        elif failed:
+            logger.warning(f"Giving up on {failed} chunk(s) of {rel_path} after {attempts} attempts")
+        await asyncio.to_thread(self._write, key, {rel_path: entry})
+        return True
+
+    def remove_file(self, key: str, rel_path: str) -> None:
+        data, _ = self._load(key)
+        if rel_path in data.get("files", {}):
+            self._write(key, {rel_path: None})
+
+    def prune(self, key: str, present: List[str]) -> None:
+        data, _ = self._load(key)
+        present_set = set(present)
+        stale = [rel_path for rel_path in data.get("files", {}) if rel_path not in present_set]
+        if stale:
+            self._write(key, dict.fromkeys(stale))
+
+    def _write(self, key: str, updates: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        """Sets (or, for None, drops) note entries under the file lock, keeping other workers' changes."""
+        def mutate(data):
+            data = data or {"files": {}}
+            files = data.setdefault("files", {})
+            for rel_path, entry in updates.items():
+                if entry is None:
+                    files.pop(rel_path, None)
+                else:
+                    files[rel_path] = entry
+            return data
+        update_json(self._path(key), mutate, default={"files": {}})
+        self._indexes.pop(key, None)
+
+    def lookup(self, key: str, name: str) -> Optional[Dict[str, Any]]:
+        """Exact (normalized) match on an entity name or alias."""
+        _, lookup = self._load(key)
+        return lookup.get(normalize_name(name))
+
+    def list_entities(self, key: str, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        _, lookup = self._load(key)
+        unique = {id(entity): entity for entity in lookup.values()}.values()
+        return sorted(
+            (entity for entity in unique if kind is None or entity["type"] == kind),
+            key=lambda entity: entity["name"].lower()
+        )
+
+# Global instance
+entity_service = EntityService()
@@ -0,0 +1,226 @@
+import os
+import re
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, AsyncGenerator, Callable, Awaitable
+
+from general_functions import generate_json
+from ollama_scheduler import ollama_scheduler, QueueFullError
+from model_router import model_router
+from grammar_review_service import split_segments
+from knowledge_base_service import kb_service
+from web_search_service import web_search_service
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+EXTRACT_SYSTEM = (
+    "You extract checkable factual claims from fiction manuscripts. "
+    "A claim is a single statement about the story world (characters, places, dates, events) "
+    "or about real-world science, history or geography. Ignore opinions, dialogue tics and style. "
+    'Reply with JSON: {"claims": ["claim 1", "claim 2"]}. Reply {"claims": []} if there are none.'
+)
+
+VERIFY_SYSTEM = (
+    "You are a rigorous Fact Checker. Judge the claim ONLY against the evidence given. "
+    'Reply with JSON: {"verdict": "VERIFIED" | "CONTRADICTED" | "NO EVIDENCE", '
+    '"explanation": "one or two sentences", "sources": ["vault" and/or URLs you relied on]}.'
+)
+
+VERDICTS = ("VERIFIED", "CONTRADICTED", "NO EVIDENCE")
+# Reported for claims whose verification could not run (model unavailable, lane kept full)
+UNVERIFIED = "UNVERIFIED"
+
+
+def normalize_claim(claim: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", claim.lower())).strip()
+
+
+def is_near_duplicate(claim: str, seen: List[str], threshold: float = 0.8) -> bool:
+    """Token Jaccard similarity against already accepted (normalized) claims."""
+    tokens = set(claim.split())
+    if not tokens:
+        return True
+    for other in seen:
+        other_tokens = set(other.split())
+        overlap = len(tokens & other_tokens) / len(tokens | other_tokens)
+        if overlap >= threshold:
+            return True
+    return False
+
+
+class LookupCache:
+    """Small LRU of evidence lookups that also shares in-flight requests for the same query."""
+
+    def __init__(self, max_size: int = 256) -> None:
+        self.max_size = max_size
+        self._items: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+
+    async def get(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._items.get(key)
+        if future is not None:
+            self._items.move_to_end(key)
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(factory())
+        self._items[key] = future
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            # Don't keep failures around
+            self._items.pop(key, None)
+            raise
+
+
+class FactCheckService:
+    """
+    Map-reduce fact checking for long texts: the text is split into segments,
+    claims are extracted per segment concurrently, de-duplicated, and each claim
+    is verified against the vault and the web as soon as it is found.
+    Verdicts are yielded in completion order so the first one arrives early.
+
+    It is bulk work, so it runs on a background Ollama lane (FACT_CHECK_LANE) and keeps
+    fewer calls in flight than that lane queues, leaving /chat's lane alone. A full lane
+    is retried with backoff; segments or claims that still fail are reported, and the
+    final event says whether the run is partial.
+    """
+
+    def __init__(self) -> None:
+        self.segment_chars = int(os.getenv("FACT_CHECK_SEGMENT_CHARS", 1500))
+        self.max_claims = int(os.getenv("FACT_CHECK_MAX_CLAIMS", 40))
+        self.use_web = os.getenv("FACT_CHECK_WEB", "true").lower() in ("1", "true", "yes")
+        self.lane = os.getenv("FACT_CHECK_LANE", "summary")
+        self.retries = int(os.getenv("FACT_CHECK_RETRIES", 3))
+        concurrency = int(os.getenv("FACT_CHECK_CONCURRENCY", 4))
+        max_queue = ollama_scheduler.lanes[self.lane].max_queue if self.lane in ollama_scheduler.lanes else 0
+        if max_queue:
+            concurrency = min(concurrency, max(1, max_queue - 1))
+        self._calls = asyncio.Semaphore(concurrency)
+        self.kb_cache = LookupCache()
+        self.web_cache = LookupCache()
+        logger.info("FactCheckService initialized")
+
+    async def _generate(self, prompt: str, system: str) -> Any:
+        """One structured call on the fact-check lane; raises if it never gets through."""
+        route = await model_router.route("fact_check")
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._calls:
+                    data = await generate_json(prompt, system=system, lane=self.lane, **route)
+                break
+            except QueueFullError:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        if data is None:
+            raise RuntimeError("no usable reply from the fact-check model")
+        return data
+
+    async def extract_claims(self, segment: str) -> List[str]:
+        with tracer.span("fact_check.extract", chars=len(segment)):
+            data = await self._generate(f"### TEXT:\n{segment}", EXTRACT_SYSTEM)
+        claims = data.get("claims", []) if isinstance(data, dict) else []
+        return [c.strip() for c in claims if isinstance(c, str) and c.strip()]
+
+    async def gather_evidence(self, claim: str) -> Dict[str, Any]:
+        key = normalize_claim(claim)
+        lookups = [self.kb_cache.get(key, lambda: kb_service.search(claim))]
+        if self.use_web:
+            lookups.append(self.web_cache.get(key, lambda: web_search_service.web_search(claim)))
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+
+        vault = results[0] if not isinstance(results[0], Exception) else []
+        web = results[1] if len(results) > 1 and not isinstance(results[1], Exception) else []
+        return {"vault": vault, "web": web}
+
+    async def verify_claim(self, claim: str) -> Dict[str, Any]:
+        with tracer.span("fact_check.verify"):
+            return await self._verify_claim(claim)
+
+    async def _verify_claim(self, claim: str) -> Dict[str, Any]:
+        evidence = await self.gather_evidence(claim)
+        if not evidence["vault"] and not evidence["web"]:
+            return {"claim": claim, "verdict": "NO EVIDENCE", "explanation": "No vault notes or web results found.", "sources": []}
+
+        evidence_text = "\n".join(f"[vault] {doc}" for doc in evidence["vault"])
+        evidence_text += "\n" + "\n".join(
+            f"[{item.get('url', '')}] {item.get('title', '')}: {item.get('snippet', '')}" for item in evidence["web"]
+        )
+        data = await self._generate(f"### CLAIM:\n{claim}\n\n### EVIDENCE:\n{evidence_text}", VERIFY_SYSTEM)
+        if not isinstance(data, dict):
+            data = {}
+
+        verdict = str(data.get("verdict", "")).upper()
+        return {
+            "claim": claim,
+            "verdict": verdict if verdict in VERDICTS else "NO EVIDENCE",
+            "explanation": data.get("explanation", ""),
+            "sources": data.get("sources") or [item.get("url", "") for item in evidence["web"]],
+        }
+
+    async def run(self, text: str) -> AsyncGenerator[Dict[str, Any], None]:
+        segments = [text[start:end] for start, end in split_segments(text, self.segment_chars)]
+        # Very short fragments (headings, scene breaks) rarely carry claims
+        segments = [s for s in segments if len(s.split()) >= 5]
+        yield {"type": "segments", "count": len(segments)}
+
+        results: asyncio.Queue = asyncio.Queue()
+        seen: List[str] = []
+        tasks: List[asyncio.Task] = []
+        failed = {"segments": 0, "claims": 0}
+
+        async def verify(claim: str):
+            try:
+                await results.put({"type": "verdict", **(await self.verify_claim(claim))})
+            except Exception as e:
+                logger.error(f"Verification failed for '{claim}': {e}")
+                failed["claims"] += 1
+                await results.put({
+                    "type": "verdict", "claim": claim, "verdict": UNVERIFIED, "explanation": str(e), "sources": [], "failed": True
+                })
+
+        async def extract(index: int, segment: str):
+            try:
+                claims = await self.extract_claims(segment)
+            except Exception as e:
+                logger.error(f"Claim extraction failed: {e}")
+                failed["segments"] += 1
+                await results.put({"type": "error", "segment": index, "message": f"Claim extraction failed: {e}"})
+                return
+            for claim in claims:
+                normalized = normalize_claim(claim)
+                if len(seen) >= self.max_claims or is_near_duplicate(normalized, seen):
+                    continue
+                seen.append(normalized)
+                await results.put({"type": "claim", "claim": claim})
+                tasks.append(asyncio.create_task(verify(claim)))
+
+        tasks.extend(asyncio.create_task(extract(i, segment)) for i, segment in enumerate(segments))
+        try:
+            verdicts = 0
+            while True:
+                pending = [t for t in tasks if not t.done()]
+                if not pending and results.empty():
+                    break
+                getter = asyncio.create_task(results.get())
+                done, _ = await asyncio.wait([getter, *pending], return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    event = getter.result()
+                    verdicts += event["type"] == "verdict"
+                    yield event
+                else:
+                    getter.cancel()
+            yield {
+                "type": "done", "claims": len(seen), "verdicts": verdicts,
+                "failed_segments": failed["segments"], "failed_claims": failed["claims"],
+                "partial": bool(failed["segments"] or failed["claims"]),
+            }
+        finally:
+            for task in tasks:
+                task.cancel()
+
+# Global instance
+fact_check_service = FactCheckService()
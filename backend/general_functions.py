@@ -1,9 +1,18 @@
 import httpx
 import json
+import time
 import asyncio
 import logging
+import threading
 from typing import List, Dict, Any, Optional, AsyncGenerator, Union, Tuple
 from transformers import pipeline
+from ollama_scheduler import ollama_scheduler, QueueFullError
+from metrics import (
+    OLLAMA_TTFT_SECONDS, OLLAMA_GENERATION_SECONDS, OLLAMA_TOKENS_PER_SECOND,
+    OLLAMA_TOKENS, TOOL_CALL_SECONDS, MOOD_SECONDS
+)
+from tracing import tracer
+from circuit_breaker import ollama_breaker, mood_breaker
 
 
 import os
@@ -26,10 +35,25 @@ else:
     # Default to ENG model if unknown
     MODEL_NAME = "j-hartmann/emotion-english-distilroberta-base"
 
-emotion_classifier = pipeline(
-    "text-classification",
-    model=MODEL_NAME
-)
+_emotion_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_emotion_classifier():
+    """Loads the emotion model on first use, so startup never waits on the download."""
+    global _emotion_classifier
+    if _emotion_classifier is None:
+        with _classifier_lock:
+            if _emotion_classifier is None:
+                _emotion_classifier = pipeline("text-classification", model=MODEL_NAME)
+    return _emotion_classifier
+
+
+async def probe_mood_model() -> bool:
+    await asyncio.to_thread(get_emotion_classifier)
+    return True
+
+mood_breaker.probe = probe_mood_model
 
 SYSTEM_PROMPT = """
 You are "Luna," an advanced and highly specialized dual-purpose LLM designed to be an expert companion.
@@ -53,14 +77,20 @@ You are "Luna," an advanced and highly specialized dual-purpose LLM designed to
 
 
 async def check_ollama_connection() -> bool:
+    """Pings Ollama. Doubles as the breaker probe: success closes an open circuit."""
     try:
         base_url = OLLAMA_URL.replace("/api/generate", "")
         async with httpx.AsyncClient() as client:
             response = await client.get(base_url, timeout=2)
+            ollama_breaker.record_success()
             return True
-    except:
+    except Exception as e:
+        if ollama_breaker.state == ollama_breaker.CLOSED:
+            ollama_breaker.record_failure(e)
         return False
 
+ollama_breaker.probe = check_ollama_connection
+
 
 
 # Refactored for Web API
@@ -100,17 +130,66 @@ TOOLS_SCHEMA = [
                 "required": ["query"]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "fetch_page",
+            "description": "Read the text of a web page returned by web_search when its snippet is not enough evidence.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "url": {
+                        "type": "string",
+                        "description": "The URL of a web_search result."
+                    }
+                },
+                "required": ["url"]
+            }
+        }
     }
 ]
 
+def record_generation_stats(final_chunk: Dict[str, Any], lane: str) -> None:
+    """Records token counts and decode speed from Ollama's closing stream message."""
+    eval_count = final_chunk.get("eval_count") or 0
+    eval_duration = final_chunk.get("eval_duration") or 0  # nanoseconds
+    tracer.annotate(eval_count=eval_count, prompt_eval_count=final_chunk.get("prompt_eval_count") or 0)
+    if eval_count:
+        OLLAMA_TOKENS.inc(eval_count, lane=lane)
+    if eval_count and eval_duration:
+        OLLAMA_TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9), lane=lane)
+
 async def ask_ollama(
     prompt: str, 
     chat_history: List[Dict[str, Any]], 
     stop_event: Optional[asyncio.Event] = None,
-    tool_handlers: Optional[Dict[str, Any]] = None
+    tool_handlers: Optional[Dict[str, Any]] = None,
+    lane: str = "chat",
+    context_snippets: Optional[List[str]] = None,
+    model: Optional[str] = None,
+    options: Optional[Dict[str, Any]] = None,
+    keep_alive: Optional[str] = None,
+    raise_queue_full: bool = False
 ) -> AsyncGenerator[Tuple[str, str], None]:
-    
+    """
+    Streams a chat completion. `lane` selects the scheduler queue
+    (chat, grammar, summary) the request waits in before reaching Ollama.
+    `context_snippets` are prefetched vault notes injected ahead of the conversation.
+    `model`, `options` and `keep_alive` come from the task's route (see model_router).
+    With `raise_queue_full`, a full lane raises QueueFullError instead of yielding an
+    error, so bulk callers can back off and retry.
+    """
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if context_snippets:
+        notes = "\n\n".join(f"- {snippet}" for snippet in context_snippets)
+        messages.append({
+            "role": "system",
+            "content": (
+                "Relevant notes already retrieved from the author's vault. Use them when they help; "
+                "call `search_vault` only if you need something they don't cover.\n\n" + notes
+            )
+        })
     context_msgs = chat_history[-MAX_HISTORY_MESSAGES:]
     for msg in context_msgs:
         messages.append({"role": "user" if msg.get("role") == "user" else "assistant", 
@@ -120,100 +199,243 @@ async def ask_ollama(
     chat_url = OLLAMA_URL.replace("/api/generate", "/api/chat")
     
     payload = {
-        "model": MODEL,
+        "model": model or MODEL,
         "messages": messages,
         "stream": True,
-        "options": {"temperature": 0.7},
+        "options": options or {"temperature": 0.7},
         "tools": TOOLS_SCHEMA if tool_handlers else None
     }
+    if keep_alive:
+        payload["keep_alive"] = keep_alive
 
     try:
+        ollama_breaker.check()
         async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", chat_url, json=payload) as response:
-                response.raise_for_status()
+            full_tool_calls = []
+
+            # Hold the Ollama slot only while generating, not while tools run
+            with tracer.span("ollama.generate", lane=lane, step="initial"):
+                async with ollama_scheduler.slot(lane):
+                    started = time.perf_counter()
+                    first_token = True
+                    async with client.stream("POST", chat_url, json=payload) as response:
+                        response.raise_for_status()
+
+                        async for line in response.aiter_lines():
+                            if stop_event and stop_event.is_set(): return
+                            if not line: continue
+
+                            try:
+                                chunk = json.loads(line)
+                            except json.JSONDecodeError:
+                                logger.error(f"Malformed JSON from Ollama: {line}")
+                                continue
+
+                            msg_chunk = chunk.get("message", {})
+
+                            # Si Ollama decide usar una herramienta (vía streaming)
+                            if msg_chunk.get("tool_calls"):
+                                full_tool_calls.extend(msg_chunk["tool_calls"])
+
+                            # Si llega contenido de texto, lo enviamos YA al cliente
+                            content = msg_chunk.get("content", "")
+                            if content:
+                                if first_token:
+                                    ttft = time.perf_counter() - started
+                                    OLLAMA_TTFT_SECONDS.observe(ttft, lane=lane, step="initial")
+                                    tracer.annotate(ttft_ms=round(ttft * 1000, 1))
+                                    first_token = False
+                                yield ("chunk", content)
+
+                            if chunk.get("done"):
+                                record_generation_stats(chunk, lane)
+                                break
+                    OLLAMA_GENERATION_SECONDS.observe(time.perf_counter() - started, lane=lane, step="initial")
+                    ollama_breaker.record_success()
+
+            # Si hubo llamadas a herramientas, procesarlas y RECURSAR una sola vez
+            if full_tool_calls:
+                messages.append({"role": "assistant", "tool_calls": full_tool_calls})
                 
-                full_tool_calls = []
-                
-                async for line in response.aiter_lines():
-                    if stop_event and stop_event.is_set(): return
-                    if not line: continue
-
-                    try:
-                        chunk = json.loads(line)
-                    except json.JSONDecodeError:
-                        logger.error(f"Malformed JSON from Ollama: {line}")
-                        continue
-
-                    msg_chunk = chunk.get("message", {})
-
-                    # Si Ollama decide usar una herramienta (vía streaming)
-                    if msg_chunk.get("tool_calls"):
-                        full_tool_calls.extend(msg_chunk["tool_calls"])
-
-                    # Si llega contenido de texto, lo enviamos YA al cliente
-                    content = msg_chunk.get("content", "")
-                    if content:
-                        yield ("chunk", content)
-
-                    if chunk.get("done"):
-                        break
-
-                # Si hubo llamadas a herramientas, procesarlas y RECURSAR una sola vez
-                if full_tool_calls:
-                    messages.append({"role": "assistant", "tool_calls": full_tool_calls})
-                    
-                    for tool_call in full_tool_calls:
-                        func_name = tool_call["function"]["name"]
-                        args = tool_call["function"]["arguments"]
-                        yield ("thought", f"Luna consultando {func_name}...")
-
-                        if tool_handlers and func_name in tool_handlers:
-                            # Tool handlers might be sync or async. Let's assume they can be both.
+                for tool_call in full_tool_calls:
+                    func_name = tool_call["function"]["name"]
+                    args = tool_call["function"]["arguments"]
+                    yield ("thought", f"Luna consultando {func_name}...")
+
+                    if tool_handlers and func_name in tool_handlers:
+                        # Tool handlers might be sync or async. Let's assume they can be both.
+                        with TOOL_CALL_SECONDS.time(tool=func_name), \
+                                tracer.span(f"tool.{func_name}", arguments=json.dumps(args)[:200]):
                             if asyncio.iscoroutinefunction(tool_handlers[func_name]):
                                 result = await tool_handlers[func_name](**args)
                             else:
                                 result = tool_handlers[func_name](**args)
 
-                            messages.append({
-                                "role": "tool",
-                                "content": json.dumps(result),
-                                "name": func_name
-                            })
+                        messages.append({
+                            "role": "tool",
+                            "content": json.dumps(result),
+                            "name": func_name
+                        })
 
-                    # Segunda llamada para procesar los resultados de la herramienta
-                    async for event_type, content in ask_ollama_final_step(messages, stop_event):
-                        yield event_type, content
+                # Segunda llamada para procesar los resultados de la herramienta
+                final_payload = {k: v for k, v in payload.items() if k not in ("messages", "tools")}
+                async for event_type, content in ask_ollama_final_step(messages, stop_event, lane=lane, payload=final_payload):
+                    yield event_type, content
 
     except Exception as e:
+        if raise_queue_full and isinstance(e, QueueFullError):
+            raise
+        ollama_breaker.record_error(e)
         yield ("error", str(e))
 
-async def ask_ollama_final_step(messages: List[Dict[str, Any]], stop_event: Optional[asyncio.Event] = None) -> AsyncGenerator[Tuple[str, str], None]:
-    # Función auxiliar para el streaming final tras la herramienta
+async def ask_ollama_final_step(
+    messages: List[Dict[str, Any]],
+    stop_event: Optional[asyncio.Event] = None,
+    lane: str = "chat",
+    payload: Optional[Dict[str, Any]] = None
+) -> AsyncGenerator[Tuple[str, str], None]:
+    # Función auxiliar para el streaming final tras la herramienta (mismo modelo y opciones)
     chat_url = OLLAMA_URL.replace("/api/generate", "/api/chat")
-    payload = {"model": MODEL, "messages": messages, "stream": True}
+    payload = {"model": MODEL, **(payload or {}), "messages": messages, "stream": True}
 
     try:
         async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", chat_url, json=payload) as response:
-                async for line in response.aiter_lines():
-                    if stop_event and stop_event.is_set(): return
-                    if line:
-                        try:
-                            chunk = json.loads(line)
-                        except json.JSONDecodeError:
-                            logger.error(f"Malformed JSON from Ollama: {line}")
-                            continue
-                        content = chunk.get("message", {}).get("content", "")
-                        if content: yield ("chunk", content)
+            with tracer.span("ollama.generate", lane=lane, step="final"):
+                async with ollama_scheduler.slot(lane):
+                    started = time.perf_counter()
+                    first_token = True
+                    async with client.stream("POST", chat_url, json=payload) as response:
+                        async for line in response.aiter_lines():
+                            if stop_event and stop_event.is_set(): return
+                            if line:
+                                try:
+                                    chunk = json.loads(line)
+                                except json.JSONDecodeError:
+                                    logger.error(f"Malformed JSON from Ollama: {line}")
+                                    continue
+                                content = chunk.get("message", {}).get("content", "")
+                                if content:
+                                    if first_token:
+                                        ttft = time.perf_counter() - started
+                                        OLLAMA_TTFT_SECONDS.observe(ttft, lane=lane, step="final")
+                                        tracer.annotate(ttft_ms=round(ttft * 1000, 1))
+                                        first_token = False
+                                    yield ("chunk", content)
+                                if chunk.get("done"):
+                                    record_generation_stats(chunk, lane)
+                    OLLAMA_GENERATION_SECONDS.observe(time.perf_counter() - started, lane=lane, step="final")
     except Exception as e:
+        ollama_breaker.record_error(e)
         yield ("error", str(e))
 
 
+async def generate_json(
+    prompt: str,
+    system: Optional[str] = None,
+    lane: str = "chat",
+    options: Optional[Dict[str, Any]] = None,
+    model: Optional[str] = None,
+    keep_alive: Optional[str] = None
+) -> Any:
+    """
+    Single non-streaming completion constrained to JSON output (Ollama `format: json`).
+    Used by pipelines that need structured results rather than prose. Returns None on failure,
+    except that a full lane raises QueueFullError so bulk callers can back off and retry.
+    """
+    chat_url = OLLAMA_URL.replace("/api/generate", "/api/chat")
+    messages = []
+    if system:
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": prompt})
+    payload = {
+        "model": model or MODEL,
+        "messages": messages,
+        "stream": False,
+        "format": "json",
+        "options": options or {"temperature": 0}
+    }
+    if keep_alive:
+        payload["keep_alive"] = keep_alive
+
+    try:
+        with tracer.span("ollama.generate_json", lane=lane):
+            # A full queue is backpressure, not an Ollama failure: keep it out of the breaker
+            async with ollama_scheduler.slot(lane):
+                with ollama_breaker.guard():
+                    async with httpx.AsyncClient(timeout=None) as client:
+                        response = await client.post(chat_url, json=payload)
+                        response.raise_for_status()
+            data = response.json()
+            record_generation_stats(data, lane)
+        content = data.get("message", {}).get("content", "")
+        return json.loads(content) if content else None
+    except QueueFullError:
+        raise
+    except json.JSONDecodeError:
+        logger.error("Model returned invalid JSON for structured prompt")
+        return None
+    except Exception as e:
+        logger.error(f"Structured generation error: {e}")
+        return None
+
+
+# Classifier labels mapped to the avatar moods the frontend knows
+EMOTION_MOODS = {
+    "joy": "happy",
+    "sadness": "sad",
+    "anger": "angry",
+    "fear": "scared",
+    "surprise": "surprised",
+    "disgust": "scared",  # Fallback for disgust
+}
+
+
+def classifier_token_limit() -> int:
+    """Content tokens per classifier call: the model's real limit minus special tokens."""
+    tokenizer = get_emotion_classifier().tokenizer
+    limit = tokenizer.model_max_length
+    if not limit or limit > 100_000:  # Unset limits come back as a huge sentinel
+        limit = 512
+    return limit - tokenizer.num_special_tokens_to_add()
+
+
+def split_for_classifier(text: str, max_tokens: Optional[int] = None) -> List[str]:
+    """Splits text into pieces that each fit the classifier, cutting on token boundaries."""
+    limit = max_tokens or classifier_token_limit()
+    encoding = get_emotion_classifier().tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = encoding["offset_mapping"]
+    if len(offsets) <= limit:
+        return [text]
+    return [
+        text[offsets[i][0]:offsets[min(i + limit, len(offsets)) - 1][1]]
+        for i in range(0, len(offsets), limit)
+    ]
+
+
+def classify_emotion(text: str) -> Optional[str]:
+    """
+    Top emotion label for `text` of any length. Long text is classified in
+    token-limit chunks and the per-label scores are averaged, weighted by chunk length.
+    """
+    with mood_breaker.guard():
+        chunks = [c for c in split_for_classifier(text) if c.strip()]
+        if not chunks:
+            return None
+        with MOOD_SECONDS.time():
+            results = get_emotion_classifier()(chunks, top_k=None, truncation=True)
+
+    totals: Dict[str, float] = {}
+    for chunk, scores in zip(chunks, results):
+        for entry in scores:
+            totals[entry["label"]] = totals.get(entry["label"], 0.0) + entry["score"] * len(chunk)
+    return max(totals, key=totals.get) if totals else None
+
 
 def get_mood_from_text(text: str) -> str:
     """
     Analyzes the text using the loaded emotion_classifier and returns 
-    one of the three supported moods: 'happy', 'sad', 'neutral'.
+    one of the supported moods ('happy', 'sad', 'angry', 'scared', 'surprised', 'neutral').
+    The whole text is considered, not just its opening.
     """
     if not text:
         return "neutral"
@@ -223,29 +445,7 @@ def get_mood_from_text(text: str) -> str:
         return "thinking"
 
     try:
-        # The classifier returns a list of dicts, e.g. [{'label': 'joy', 'score': 0.95}]
-        results = emotion_classifier(text[:512]) 
-        
-        if not results:
-            return "neutral"
-            
-        top_emotion = results[0]['label']
-        
-        if top_emotion == "joy":
-            return "happy"
-        elif top_emotion == "sadness":
-            return "sad"
-        elif top_emotion == "anger":
-            return "angry"
-        elif top_emotion == "fear":
-            return "scared"
-        elif top_emotion == "surprise":
-            return "surprised"
-        elif top_emotion == "disgust":
-            return "scared" # Fallback for disgust
-        else:
-            return "neutral"
-            
+        return EMOTION_MOODS.get(classify_emotion(text), "neutral")
     except Exception as e:
         print(f"Error in mood analysis: {e}")
         return "neutral"
@@ -0,0 +1,146 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Generation:
+    """
+    Events of one /chat generation, buffered so that a client that drops the
+    stream can reconnect and continue where it left off.
+
+    Producers `put` events exactly as they would into the chat event queue. Every
+    event is recorded with the reply offset (characters of chunk content before it)
+    at which it occurred, and readers subscribe from an offset: what they missed is
+    replayed, then they receive new events live.
+    """
+
+    def __init__(self, generation_id: str, ttl: float) -> None:
+        self.id = generation_id
+        self.ttl = ttl
+        self.created = time.monotonic()
+        self.events: List[Tuple[int, Dict[str, Any]]] = []
+        self.length = 0  # Characters of reply text so far
+        self.size = 0  # Approximate memory held by the buffered events
+        self.finished_at: Optional[float] = None
+        self.detached_at: Optional[float] = self.created
+        self.stop_event = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+        self._subscribers: List[asyncio.Queue] = []
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    async def put(self, event: Dict[str, Any]) -> None:
+        if self.done and event.get("type") != "mood":  # The reply's final mood may follow "done"
+            return
+        self.events.append((self.length, event))
+        content = event.get("content")
+        self.size += len(content) if isinstance(content, str) else 64
+        if event.get("type") == "chunk":
+            self.length += len(content or "")
+        if event.get("type") in ("done", "error"):
+            self.finished_at = time.monotonic()
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+        # Nobody came back in time: stop spending the GPU/CPU on it
+        if self.detached_at is not None and not self.done and time.monotonic() - self.detached_at > self.ttl:
+            logger.info(f"Generation {self.id} abandoned; cancelling")
+            self.cancel()
+
+    def text(self) -> str:
+        return "".join(event.get("content", "") for _, event in self.events if event.get("type") == "chunk")
+
+    def subscribe(self, offset: int = 0) -> asyncio.Queue:
+        """A queue holding the events from reply offset `offset` on, then every new one."""
+        queue: asyncio.Queue = asyncio.Queue()
+        for position, event in self.events:
+            if event.get("type") == "chunk":
+                end = position + len(event.get("content", ""))
+                if end <= offset:
+                    continue
+                if position < offset:
+                    event = {**event, "content": event["content"][offset - position:]}
+            elif position < offset:
+                continue
+            queue.put_nowait(event)
+        self._subscribers.append(queue)
+        self.detached_at = None
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+        if not self._subscribers:
+            self.detached_at = time.monotonic()
+
+    def cancel(self) -> None:
+        self.stop_event.set()
+        for task in self.tasks:
+            task.cancel()
+        if not self.done:
+            self.finished_at = time.monotonic()
+            for queue in self._subscribers:
+                queue.put_nowait({"type": "error", "content": "Generation cancelled"})
+
+    def expired(self, now: float) -> bool:
+        if self._subscribers:
+            return False
+        since = max(self.detached_at or 0.0, self.finished_at or 0.0)
+        return now - since > self.ttl
+
+
+class GenerationStore:
+    """
+    Resumable generations of this worker process, bounded by a TTL after the last
+    client left (or after finishing) and by a total memory cap. When over the cap,
+    finished generations are dropped first, then abandoned running ones are cancelled,
+    oldest first. Generations with a connected client are never evicted.
+    """
+
+    def __init__(self) -> None:
+        # Off when several workers serve the API: a resume could reach a worker without the generation
+        self.enabled = (os.getenv("CHAT_RESUMABLE") or "true").lower() in ("1", "true", "yes")
+        self.ttl = float(os.getenv("CHAT_RESUME_TTL", 300))
+        self.max_chars = int(os.getenv("CHAT_RESUME_MAX_CHARS", 4_000_000))
+        self.generations: "OrderedDict[str, Generation]" = OrderedDict()
+
+    def create(self) -> Generation:
+        self.sweep()
+        generation = Generation(uuid.uuid4().hex, self.ttl)
+        self.generations[generation.id] = generation
+        return generation
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        self.sweep()
+        return self.generations.get(generation_id)
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        for generation in [g for g in self.generations.values() if g.expired(now)]:
+            self._drop(generation)
+
+        total = sum(g.size for g in self.generations.values())
+        if total <= self.max_chars:
+            return
+        detached = [g for g in self.generations.values() if g.detached_at is not None]
+        # Finished first, then running; oldest first within each group
+        for generation in sorted(detached, key=lambda g: (not g.done, g.created)):
+            if total <= self.max_chars:
+                break
+            total -= generation.size
+            self._drop(generation)
+
+    def _drop(self, generation: Generation) -> None:
+        if not generation.done:
+            generation.cancel()
+        self.generations.pop(generation.id, None)
+
+# Global instance
+generation_store = GenerationStore()
@@ -0,0 +1,176 @@
+import os
+import re
+import time
+import logging
+from typing import List, Dict, Tuple, Optional, Set
+
+from entity_service import entity_service
+from general_functions import APP_LANG
+from storage import vault_key
+from vault_service import vault_service
+from vault_watcher import vault_watcher
+
+logger = logging.getLogger(__name__)
+
+# Letters with inner apostrophes ("don't", "Veyra's"); digits and underscores split words
+WORD_RE = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+# Markdown that isn't prose: wikilinks, links, URLs, inline code, HTML tags
+MARKUP_RE = re.compile(r"!?\[\[[^\]]*\]\]|!?\[([^\]]*)\]\([^)]*\)|https?://\S+|`[^`]*`|<[^>]+>")
+
+# System word lists per language (APP_LANG codes); GRAMMAR_DICTIONARY overrides them
+DEFAULT_DICTIONARIES = {
+    "ENG": ("/usr/share/dict/words", "/usr/share/dict/american-english", "/usr/share/dict/british-english"),
+    "ESP": ("/usr/share/dict/spanish",),
+}
+ABBREVIATIONS = {"e.g", "i.e", "etc", "vs", "cf", "approx", "mr", "mrs", "ms", "dr", "st", "no"}
+LEGIT_REPEATS = {"had", "that", "is", "very", "bye", "no", "yes", "ha", "so", "go"}
+
+# (issue, pattern); any match sends the paragraph to the model. These hold in any language
+RULES = [
+    ("space before punctuation", re.compile(r"\w[ \t]+[,;:!?](?=\s|$)|\w[ \t]+\.(?!\.)")),
+    ("missing space after punctuation", re.compile(r"[a-z][,;!?][A-Za-z]|[a-z]{2}\.[A-Z][a-z]")),
+    ("repeated punctuation", re.compile(r",,|;;|::|(?<!\.)\.\.(?!\.)")),
+    ("double space", re.compile(r"\S {2,}\S")),
+]
+# Rules that only make sense in one language
+LANGUAGE_RULES = {"ENG": [
+    ("lowercase i", re.compile(r"(?<![\w'’-])i(?![\w'’-]|\.\w)")),
+    ("a/an", re.compile(r"\ba (?!one\b|once\b|eu|u)[aeio]\w*|\ban [b-df-gj-np-tv-z]\w*")),
+    ("agreement", re.compile(
+        r"\b(?:I (?:has|is|are|does)|(?:he|she|it) (?:have|are|don't)|(?:we|you|they) (?:has|is|was|does|doesn't))\b",
+        re.IGNORECASE
+    )),
+]}
+REPEATED_WORD_RE = re.compile(r"\b(\w+)\s+\1\b", re.IGNORECASE)
+SENTENCE_CASE_RE = re.compile(r"(\S+)[.!?]\s+[a-z]")
+
+
+class Vocabulary:
+    """Words the spell check accepts: a dictionary file and the vault's lore."""
+
+    def __init__(self, dictionary: Set[str], lore: Set[str]) -> None:
+        self.dictionary = dictionary
+        self.lore = lore
+
+    def known(self, word: str) -> bool:
+        word = word.lower().replace("’", "'")
+        for candidate in (word, word[:-2] if word.endswith("'s") else None):
+            if candidate and (candidate in self.lore or candidate in self.dictionary):
+                return True
+        return False
+
+
+class GrammarPrecheck:
+    """
+    CPU-only pre-pass that decides which paragraphs the grammar model needs to see.
+
+    A paragraph is sent when it has an unknown word or breaks one of the punctuation
+    and agreement rules. Known words are those of a word list (GRAMMAR_DICTIONARY, else
+    the system one if present) plus the vault's lore: note titles and entity names and
+    aliases. The text of the notes doesn't count, so a misspelling repeated across the
+    vault is still flagged. Capitalized words inside a sentence are taken for names.
+    The word list and the language-specific rules follow GRAMMAR_PRECHECK_LANG
+    (APP_LANG by default). Without a word list every word would look misspelled, so
+    the pre-pass turns itself off (with a warning) and every paragraph is sent.
+
+    Title words are cached per vault and dropped when the vault watcher reports a
+    note change. A worker that isn't polling only hears of saves made through the
+    API, so there the cache also expires after UNWATCHED_MAX_AGE seconds.
+    """
+
+    UNWATCHED_MAX_AGE = 60.0
+
+    def __init__(self) -> None:
+        self.enabled = os.getenv("GRAMMAR_PRECHECK", "true").lower() in ("1", "true", "yes")
+        self.language = os.getenv("GRAMMAR_PRECHECK_LANG", APP_LANG).upper()
+        self.rules = RULES + LANGUAGE_RULES.get(self.language, [])
+        configured = os.getenv("GRAMMAR_DICTIONARY")
+        candidates = [configured] if configured else DEFAULT_DICTIONARIES.get(self.language, ())
+        self.dictionary_path = next((path for path in candidates if os.path.exists(path)), None)
+        if self.enabled and not self.dictionary_path:
+            self._disable(f"no {self.language} word list found (set GRAMMAR_DICTIONARY)")
+        self._dictionary: Optional[Set[str]] = None
+        # vault path -> (monotonic time it was read, title words)
+        self._titles: Dict[str, Tuple[float, Set[str]]] = {}
+        vault_watcher.add_listener(self.on_change)
+
+    def dictionary(self) -> Set[str]:
+        if self._dictionary is None:
+            words: Set[str] = set()
+            if self.dictionary_path:
+                # One word per line, optionally followed by a count (SymSpell's format)
+                with open(self.dictionary_path, "r", encoding="utf-8", errors="ignore") as f:
+                    for line in f:
+                        word = line.split(None, 1)[0] if line.strip() else ""
+                        if word:
+                            words.add(word.lower())
+                logger.info(f"Loaded {len(words)} words from {self.dictionary_path}")
+            if not words and self.enabled:
+                self._disable(f"the word list {self.dictionary_path or '(none)'} is empty")
+            self._dictionary = words
+        return self._dictionary
+
+    def _disable(self, reason: str) -> None:
+        self.enabled = False
+        logger.warning(f"Grammar pre-check is off, every paragraph goes to the model: {reason}")
+
+    def on_change(self, vault_path: str, rel_path: str) -> None:
+        """Vault watcher listener: a note was added, edited, renamed or removed."""
+        self._titles.pop(vault_path, None)
+
+    def _note_titles(self, vault_path: str) -> Set[str]:
+        """Words of the vault's note titles, from its file names (the notes aren't read)."""
+        cached = self._titles.get(vault_path)
+        if cached is not None and (vault_watcher.watching or time.monotonic() - cached[0] < self.UNWATCHED_MAX_AGE):
+            return cached[1]
+        titles: Set[str] = set()
+        for _, dirs, names in os.walk(vault_path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.lower().endswith((".md", ".txt")):
+                    titles.update(w.lower() for w in WORD_RE.findall(os.path.splitext(name)[0]))
+        self._titles[vault_path] = (time.monotonic(), titles)
+        return titles
+
+    def vocabulary(self, vault_path: Optional[str] = None) -> Vocabulary:
+        vault_path = vault_path or vault_service.vault_path
+        lore: Set[str] = set()
+        if vault_path and os.path.isdir(vault_path):
+            lore.update(self._note_titles(vault_path))
+            for entity in entity_service.list_entities(vault_key(vault_path)):
+                for name in [entity["name"], *entity.get("aliases", [])]:
+                    lore.update(w.lower() for w in WORD_RE.findall(name))
+        return Vocabulary(self.dictionary(), lore)
+
+    def check(self, paragraph: str, vocabulary: Vocabulary) -> List[str]:
+        """Reasons this paragraph needs the model; empty when the pre-pass finds nothing."""
+        text = MARKUP_RE.sub(lambda m: m.group(1) or " ", paragraph)
+        issues = [issue for issue, pattern in self.rules if pattern.search(text)]
+
+        for match in REPEATED_WORD_RE.finditer(text):
+            if match.group(1).lower() not in LEGIT_REPEATS:
+                issues.append("repeated word")
+                break
+        for match in SENTENCE_CASE_RE.finditer(text):
+            if match.group(1).lower().rstrip(".") not in ABBREVIATIONS:
+                issues.append("lowercase sentence start")
+                break
+        if text.count('"') % 2 or text.count("“") != text.count("”") or text.count("(") != text.count(")"):
+            issues.append("unbalanced quotes or brackets")
+
+        for match in WORD_RE.finditer(text):
+            word = match.group()
+            if vocabulary.known(word):
+                continue
+            if word[0].isupper() and not self._starts_sentence(text, match.start()):
+                continue  # A name
+            issues.append(f"spelling: {word}")
+        return issues
+
+    @staticmethod
+    def _starts_sentence(text: str, position: int) -> bool:
+        before = text[:position].rstrip(" \t\"'“‘*_#>-")
+        return not before or before[-1] in ".!?:\n"
+
+# Global instance
+grammar_precheck = GrammarPrecheck()
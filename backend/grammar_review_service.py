@@ -0,0 +1,395 @@
+import os
+import re
+import time
+import uuid
+import difflib
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional, Tuple, AsyncGenerator, Callable
+
+from general_functions import ask_ollama
+from ollama_scheduler import ollama_scheduler, QueueFullError
+from model_router import model_router
+from response_cache import response_cache
+from grammar_precheck import grammar_precheck
+from storage import state_path, read_json, write_json_atomic, FileLock
+
+logger = logging.getLogger(__name__)
+
+# Words, runs of whitespace and single punctuation marks, like Diff.diffWords on the client
+TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]", re.UNICODE)
+PARAGRAPH_BREAK_RE = re.compile(r"\n\s*\n")
+SESSION_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+
+
+def build_grammar_prompt(text: str) -> str:
+    return (
+        "Correct the grammar, spelling, and punctuation of the following text. "
+        "Maintain the original tone and style. "
+        "IMPORTANT: RETURN ONLY THE CORRECTED TEXT. DO NOT EXPLAIN OR ADD CONVERSATIONAL FILLER.\n\n"
+        "### TEXT TO CORRECT:\n"
+        f"{text}"
+    )
+
+
+async def correct_text(text: str, use_cache: bool = True) -> str:
+    """
+    Runs the grammar prompt through Ollama on the grammar lane and returns the corrected text.
+    Results are cached per input, so re-running a review only regenerates edited segments.
+    Raises QueueFullError when the grammar lane is full.
+    """
+    route = await model_router.route("grammar")
+    if use_cache:
+        cached = await response_cache.lookup(route["model"], "grammar", text)
+        if cached is not None:
+            return cached
+
+    corrected = ""
+    async for event_type, content in ask_ollama(
+        build_grammar_prompt(text), [], lane="grammar", raise_queue_full=True, **route
+    ):
+        if event_type == "chunk":
+            corrected += content
+        elif event_type == "error":
+            raise RuntimeError(content)
+
+    await response_cache.store(route["model"], "grammar", text, corrected)
+    return corrected
+
+
+def split_segments(
+    text: str, max_chars: int, needs_review: Optional[Callable[[str], bool]] = None
+) -> List[Tuple[int, int]]:
+    """
+    Groups consecutive paragraphs into (start, end) spans of at most `max_chars`
+    (a single longer paragraph becomes its own span). Leading/trailing whitespace
+    of each span is excluded so corrections never touch paragraph breaks.
+    Paragraphs for which `needs_review` is false are left out, and never bridged.
+    """
+    paragraphs = []
+    position = 0
+    for match in PARAGRAPH_BREAK_RE.finditer(text):
+        paragraphs.append((position, match.start()))
+        position = match.end()
+    paragraphs.append((position, len(text)))
+
+    segments: List[Tuple[int, int]] = []
+    joinable = False
+    for start, end in paragraphs:
+        # Trim whitespace so offsets point at the prose itself
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start == end:
+            continue
+        if needs_review is not None and not needs_review(text[start:end]):
+            joinable = False
+            continue
+        if joinable and end - segments[-1][0] <= max_chars:
+            segments[-1] = (segments[-1][0], end)
+        else:
+            segments.append((start, end))
+        joinable = True
+    return segments
+
+
+def _visible_chars(text: str) -> int:
+    return sum(1 for c in text if not c.isspace())
+
+
+def word_diff(original: str, fixed: str, offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    Word-level diff of `fixed` against `original`. Each hunk replaces
+    original[start:end] (offsets shifted by `offset`) with `text`.
+    """
+    a_tokens = TOKEN_RE.findall(original)
+    b_tokens = TOKEN_RE.findall(fixed)
+
+    # Character offset of every token boundary in the original
+    a_offsets = [0]
+    for token in a_tokens:
+        a_offsets.append(a_offsets[-1] + len(token))
+
+    hunks = []
+    matcher = difflib.SequenceMatcher(None, a_tokens, b_tokens, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        hunks.append({
+            "start": offset + a_offsets[i1],
+            "end": offset + a_offsets[i2],
+            "text": "".join(b_tokens[j1:j2]),
+        })
+    return hunks
+
+
+def apply_hunks(text: str, hunks: List[Dict[str, Any]]) -> str:
+    """Applies non-overlapping hunks to `text`."""
+    parts = []
+    position = 0
+    for hunk in sorted(hunks, key=lambda h: h["start"]):
+        parts.append(text[position:hunk["start"]])
+        parts.append(hunk["text"])
+        position = hunk["end"]
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+class ReviewSession:
+    def __init__(self, original: str, path: Optional[str] = None, use_cache: bool = True) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.original = original
+        self.path = path
+        self.use_cache = use_cache
+        self.created_at = time.time()
+        self.hunks: Dict[int, Dict[str, Any]] = {}
+        self.complete = False
+        self.failed: List[Tuple[int, int]] = []  # Segment spans whose correction failed
+        self._next_id = 0
+
+    @classmethod
+    def from_state(cls, data: Dict[str, Any]) -> "ReviewSession":
+        session = cls(data["original"], data.get("path"), data.get("use_cache", True))
+        session.id = data["id"]
+        session.created_at = data["created_at"]
+        session.hunks = {hunk["id"]: hunk for hunk in data.get("hunks", [])}
+        session.complete = data.get("complete", False)
+        session.failed = [tuple(span) for span in data.get("failed", [])]
+        session._next_id = data.get("next_id", len(session.hunks))
+        return session
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "original": self.original,
+            "path": self.path,
+            "use_cache": self.use_cache,
+            "created_at": self.created_at,
+            "complete": self.complete,
+            "failed": [list(span) for span in self.failed],
+            "next_id": self._next_id,
+            "hunks": list(self.hunks.values()),
+        }
+
+    def add_hunks(self, hunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        added = []
+        for hunk in hunks:
+            hunk = dict(hunk, id=self._next_id, status="pending")
+            self.hunks[self._next_id] = hunk
+            self._next_id += 1
+            added.append(hunk)
+        return added
+
+    def resolve(self, accept: List[int], reject: List[int]) -> None:
+        for hunk_id in accept:
+            if hunk_id in self.hunks:
+                self.hunks[hunk_id]["status"] = "accepted"
+        for hunk_id in reject:
+            if hunk_id in self.hunks:
+                self.hunks[hunk_id]["status"] = "rejected"
+
+    def result(self) -> str:
+        accepted = [h for h in self.hunks.values() if h["status"] == "accepted"]
+        return apply_hunks(self.original, accepted)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "path": self.path,
+            "length": len(self.original),
+            "complete": self.complete,
+            "failed": [list(span) for span in self.failed],
+            "hunks": sorted(self.hunks.values(), key=lambda h: h["start"]),
+        }
+
+
+class GrammarReviewService:
+    """
+    Grammar review as a server-side session: the draft is corrected segment by
+    segment, each segment is diffed at word level here, and only the resulting
+    hunks (offsets into the original plus replacement text) go to the client.
+
+    Sessions are JSON files under the state directory, changed under a file lock, so
+    resolve and apply work whichever worker process serves them.
+
+    Fewer segments are in flight than the grammar lane runs and queues, and a full
+    lane is retried with backoff. Segments that still fail are kept on the session
+    (`failed`), which then isn't complete; `retry` re-runs only those.
+    """
+
+    def __init__(self) -> None:
+        self.segment_chars = int(os.getenv("REVIEW_SEGMENT_CHARS", 2000))
+        self.max_sessions = int(os.getenv("REVIEW_MAX_SESSIONS", 32))
+        self.session_ttl = float(os.getenv("REVIEW_SESSION_TTL", 3600))
+        self.retries = int(os.getenv("REVIEW_RETRIES", 3))
+        concurrency = int(os.getenv("REVIEW_CONCURRENCY", 4))
+        lane = ollama_scheduler.lanes.get("grammar")
+        if lane is not None and lane.max_queue:
+            concurrency = min(concurrency, max(1, lane.concurrency + lane.max_queue - 1))
+        self._calls = asyncio.Semaphore(concurrency)
+        logger.info("GrammarReviewService initialized")
+
+    @staticmethod
+    def _path(session_id: str) -> Optional[str]:
+        if not SESSION_ID_RE.match(session_id or ""):
+            return None
+        return state_path("review_sessions", f"{session_id}.json")
+
+    def _evict(self) -> None:
+        folder = os.path.dirname(state_path("review_sessions", "x"))
+        now = time.time()
+        sessions = []
+        for name in os.listdir(folder):
+            if not name.endswith(".json"):
+                continue
+            full_path = os.path.join(folder, name)
+            try:
+                sessions.append((os.path.getmtime(full_path), full_path))
+            except OSError:
+                continue
+        sessions.sort()
+        excess = len(sessions) - self.max_sessions
+        for position, (modified, full_path) in enumerate(sessions):
+            if position < excess or now - modified > self.session_ttl:
+                self._remove(full_path)
+
+    @staticmethod
+    def _remove(full_path: str) -> None:
+        for file_path in (full_path, f"{full_path}.lock"):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def _load(self, path: str) -> Optional[ReviewSession]:
+        data = read_json(path)
+        if not data:
+            return None
+        session = ReviewSession.from_state(data)
+        if time.time() - session.created_at > self.session_ttl:
+            return None
+        return session
+
+    def create_session(self, original: str, path: Optional[str] = None, use_cache: bool = True) -> ReviewSession:
+        session = ReviewSession(original, path, use_cache)
+        write_json_atomic(self._path(session.id), session.to_state())
+        self._evict()
+        return session
+
+    def get_session(self, session_id: str) -> Optional[ReviewSession]:
+        path = self._path(session_id)
+        return self._load(path) if path else None
+
+    def update_session(self, session_id: str, change: Callable[[ReviewSession], Any]) -> Optional[ReviewSession]:
+        """Locked read-modify-write of a stored session; None if it doesn't exist (any more)."""
+        path = self._path(session_id)
+        if not path:
+            return None
+        with FileLock(f"{path}.lock"):
+            session = self._load(path)
+            if session is None:
+                return None
+            change(session)
+            write_json_atomic(path, session.to_state())
+        return session
+
+    def discard_session(self, session_id: str) -> bool:
+        path = self._path(session_id)
+        if not path:
+            return False
+        with FileLock(f"{path}.lock"):
+            if not os.path.exists(path):
+                return False
+            os.remove(path)
+        return True
+
+    async def plan(self, text: str, vault_path: Optional[str] = None) -> Tuple[List[Tuple[int, int]], float]:
+        """
+        Segments that need the grammar model, and the fraction of the text (by visible
+        characters) the local pre-pass found clean and left out.
+        """
+        if not grammar_precheck.enabled:
+            return split_segments(text, self.segment_chars), 0.0
+        return await asyncio.to_thread(self._plan, text, vault_path)
+
+    def _plan(self, text: str, vault_path: Optional[str]) -> Tuple[List[Tuple[int, int]], float]:
+        vocabulary = grammar_precheck.vocabulary(vault_path)
+        if not grammar_precheck.enabled:  # Its word list turned out empty
+            return split_segments(text, self.segment_chars), 0.0
+        segments = split_segments(
+            text, self.segment_chars, lambda paragraph: bool(grammar_precheck.check(paragraph, vocabulary))
+        )
+        total = _visible_chars(text)
+        reviewed = sum(_visible_chars(text[start:end]) for start, end in segments)
+        return segments, round(1 - reviewed / total, 3) if total else 0.0
+
+    async def _correct(self, segment: str, use_cache: bool) -> str:
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._calls:
+                    return await correct_text(segment, use_cache=use_cache)
+            except QueueFullError:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def _review_segment(
+        self, session: ReviewSession, start: int, end: int
+    ) -> Tuple[int, int, Optional[List[Dict[str, Any]]], Optional[Exception]]:
+        """(start, end, hunks, None), or (start, end, None, error) when the segment failed."""
+        segment = session.original[start:end]
+        try:
+            fixed = (await self._correct(segment, session.use_cache)).strip()
+        except Exception as e:
+            return start, end, None, e
+        return start, end, word_diff(segment, fixed, offset=start) if fixed else [], None
+
+    async def run(self, session: ReviewSession, retry: bool = False) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Corrects every segment (as concurrently as the grammar lane allows) and yields hunks as
+        segments finish. With `retry`, only the segments that failed last time are run.
+        """
+        if retry:
+            segments, skipped = list(session.failed), 0.0
+        else:
+            segments, skipped = await self.plan(session.original)
+        yield {
+            "type": "session", "id": session.id, "length": len(session.original),
+            "segments": len(segments), "skipped": skipped
+        }
+
+        tasks = [asyncio.create_task(self._review_segment(session, start, end)) for start, end in segments]
+        failed: List[Tuple[int, int]] = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                start, end, hunks, error = await next_done
+                if error is not None:
+                    logger.error(f"Grammar review segment {start}-{end} failed: {error}")
+                    failed.append((start, end))
+                    yield {"type": "error", "content": str(error), "start": start, "end": end}
+                    continue
+                if hunks:
+                    added: List[Dict[str, Any]] = []
+                    stored = await asyncio.to_thread(
+                        self.update_session, session.id, lambda s: added.extend(s.add_hunks(hunks))
+                    )
+                    if stored is None:
+                        return  # Discarded while it was running
+                    yield {"type": "hunks", "hunks": added}
+
+            def finish(s: ReviewSession) -> None:
+                s.failed = sorted(failed)
+                s.complete = not failed
+
+            stored = await asyncio.to_thread(self.update_session, session.id, finish)
+            yield {
+                "type": "done", "hunks": len(stored.hunks) if stored else 0,
+                "failed": [list(span) for span in sorted(failed)], "partial": bool(failed)
+            }
+        finally:
+            for task in tasks:
+                task.cancel()
+
+# Global instance
+grammar_review_service = GrammarReviewService()
@@ -0,0 +1,401 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional, AsyncGenerator
+
+from knowledge_base_service import kb_service
+from storage import state_path, read_json, write_json_atomic, FileLock
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+FINAL_STATUSES = ("done", "error", "cancelled")
+
+
+class IndexingJob:
+    """
+    A vault sync running independently of any HTTP request.
+    Progress events are kept in memory so clients can attach at any offset;
+    finished files are checkpointed to disk so the job can resume after a restart.
+    The checkpoint is rewritten every CHECKPOINT_FILES files or CHECKPOINT_SECONDS
+    seconds (not after every file), so a resume may redo up to that many files.
+    """
+
+    MAX_EVENTS = 5000
+    CHECKPOINT_FILES = int(os.getenv("INDEX_CHECKPOINT_FILES", 50))
+    CHECKPOINT_SECONDS = float(os.getenv("INDEX_CHECKPOINT_SECONDS", 5))
+
+    def __init__(self, vault_path: str, job_id: Optional[str] = None) -> None:
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.vault_path = vault_path
+        self.status = "queued"
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.done_files: List[str] = []
+        self.errors: List[Dict[str, str]] = []
+        self.total = 0
+        self.events: List[Dict[str, Any]] = []
+        self.events_offset = 0  # Number of events dropped from the front of `events`
+        self.task: Optional[asyncio.Task] = None
+        self.lock: Optional[FileLock] = None
+        # Set when another worker process runs the job; progress is then followed through the checkpoint
+        self.remote = False
+        self._changed = asyncio.Event()
+        self._writing: Optional[asyncio.Future] = None
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+    @property
+    def checkpoint_file(self) -> str:
+        return state_path("index_jobs", f"{self.id}.json")
+
+    @property
+    def cancel_file(self) -> str:
+        return state_path("index_jobs", f"{self.id}.cancel")
+
+    @property
+    def event_count(self) -> int:
+        return self.events_offset + len(self.events)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "vault_path": self.vault_path,
+            "status": self.status,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "processed": len(self.done_files),
+            "total": self.total,
+            "errors": self.errors[-20:],
+            "events": self.event_count,
+            "remote": self.remote,
+        }
+
+    def checkpoint_data(self) -> Dict[str, Any]:
+        data = self.to_dict()
+        data["done_files"] = list(self.done_files)
+        del data["remote"]
+        return data
+
+    def checkpoint(self) -> None:
+        write_json_atomic(self.checkpoint_file, self.checkpoint_data())
+
+    async def checkpoint_async(self, force: bool = False) -> None:
+        """
+        Writes the checkpoint in a thread once enough progress has piled up (or with `force`).
+        The state is copied here, on the loop, and writes never overlap, so a slow
+        earlier write can't land after a later one.
+        """
+        self._unsaved += 1
+        due = self._unsaved >= self.CHECKPOINT_FILES or time.monotonic() - self._saved_at >= self.CHECKPOINT_SECONDS
+        if not (force or due):
+            return
+        await self.wait_for_checkpoint()
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self._writing = asyncio.ensure_future(asyncio.to_thread(write_json_atomic, self.checkpoint_file, self.checkpoint_data()))
+        await asyncio.shield(self._writing)
+
+    async def wait_for_checkpoint(self) -> None:
+        """Waits for a checkpoint write still running in its thread (even if our caller was cancelled)."""
+        if self._writing is not None and not self._writing.done():
+            await asyncio.wait([self._writing])
+
+    def refresh(self) -> None:
+        """Reloads state written by the worker that owns the job."""
+        data = read_json(self.checkpoint_file)
+        if data:
+            self.status = data.get("status", self.status)
+            self.updated_at = data.get("updated_at", self.updated_at)
+            self.done_files = data.get("done_files", self.done_files)
+            self.errors = data.get("errors", self.errors)
+            self.total = data.get("total", self.total)
+
+    @classmethod
+    def from_checkpoint(cls, data: Dict[str, Any]) -> "IndexingJob":
+        job = cls(data["vault_path"], job_id=data["id"])
+        job.status = data.get("status", "queued")
+        job.created_at = data.get("created_at", job.created_at)
+        job.updated_at = data.get("updated_at", job.updated_at)
+        job.done_files = data.get("done_files", [])
+        job.errors = data.get("errors", [])
+        job.total = data.get("total", 0)
+        return job
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        event = dict(event, job_id=self.id)
+        self.events.append(event)
+        if len(self.events) > self.MAX_EVENTS:
+            overflow = len(self.events) - self.MAX_EVENTS
+            del self.events[:overflow]
+            self.events_offset += overflow
+        self.updated_at = time.time()
+        # Wake every attached stream, then arm a fresh event for the next wait
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def stream(self, offset: int = 0) -> AsyncGenerator[Dict[str, Any], None]:
+        """Yields events from `offset` onwards until the job reaches a final state."""
+        if self.remote:
+            async for event in self._follow_checkpoint():
+                yield event
+            return
+        position = max(offset, self.events_offset)
+        while True:
+            while position < self.event_count:
+                yield self.events[position - self.events_offset]
+                position += 1
+            if self.status in FINAL_STATUSES:
+                return
+            await self._changed.wait()
+
+    async def _follow_checkpoint(self, interval: float = 1.0) -> AsyncGenerator[Dict[str, Any], None]:
+        """Progress of a job running in another worker, rebuilt from its checkpoint."""
+        processed = -1
+        while True:
+            await asyncio.to_thread(self.refresh)
+            if len(self.done_files) != processed:
+                processed = len(self.done_files)
+                yield {"status": "progress", "current": processed, "total": self.total, "job_id": self.id}
+            if self.status in FINAL_STATUSES:
+                yield {"status": self.status, "total": self.total or processed, "job_id": self.id}
+                return
+            await asyncio.sleep(interval)
+
+
+class IndexingService:
+    """
+    Runs and tracks indexing jobs. Checkpoints of jobs that ended (done, error or
+    cancelled) more than INDEX_JOB_RETENTION seconds ago are deleted, along with
+    leftover cancel markers.
+    """
+
+    def __init__(self) -> None:
+        self.jobs: Dict[str, IndexingJob] = {}
+        self.retention = float(os.getenv("INDEX_JOB_RETENTION", 7 * 24 * 3600))
+        self._shutting_down = False
+        logger.info("IndexingService initialized")
+
+    @staticmethod
+    def _jobs_folder() -> str:
+        return os.path.dirname(state_path("index_jobs", "x"))
+
+    def prune_finished(self) -> int:
+        """Deletes expired checkpoints of finished jobs and stray cancel markers. Returns how many files went."""
+        folder = self._jobs_folder()
+        now = time.time()
+        removed = []
+        for filename in os.listdir(folder):
+            full_path = os.path.join(folder, filename)
+            job_id, ext = os.path.splitext(filename)
+            if ext == ".json":
+                data = read_json(full_path) or {}
+                if data.get("status") in FINAL_STATUSES and now - data.get("updated_at", now) > self.retention:
+                    removed.append(full_path)
+                    self.jobs.pop(job_id, None)
+            elif ext == ".cancel":
+                # Only meaningful while the job runs
+                data = read_json(os.path.join(folder, f"{job_id}.json")) or {}
+                if data.get("status") not in ACTIVE_STATUSES:
+                    removed.append(full_path)
+        for full_path in removed:
+            try:
+                os.remove(full_path)
+            except OSError:
+                pass
+        return len(removed)
+
+    def _load_checkpoints(self) -> List[IndexingJob]:
+        folder = self._jobs_folder()
+        jobs = []
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith(".json"):
+                data = read_json(os.path.join(folder, filename))
+                if data and data.get("id") and data.get("vault_path"):
+                    jobs.append(IndexingJob.from_checkpoint(data))
+        return jobs
+
+    def resume_pending(self) -> List[str]:
+        """
+        Called at startup: reloads known jobs and restarts the ones a shutdown interrupted.
+        With several workers, only the one that claims a vault's lock resumes its job.
+        """
+        resumed = []
+        self.prune_finished()
+        for job in self._load_checkpoints():
+            if job.id in self.jobs:
+                continue
+            self.jobs[job.id] = job
+            if job.status in ACTIVE_STATUSES and self._launch(job):
+                logger.info(f"Resuming indexing job {job.id} ({len(job.done_files)} files already done)")
+                resumed.append(job.id)
+        return resumed
+
+    def _vault_lock(self, vault_path: str) -> FileLock:
+        return FileLock(state_path("locks", f"index_{kb_service.project_key(vault_path)}.lock"))
+
+    def _is_running_elsewhere(self, vault_path: str) -> bool:
+        lock = self._vault_lock(vault_path)
+        if lock.acquire(blocking=False):
+            lock.release()
+            return False
+        return True
+
+    def get_job(self, job_id: str) -> Optional[IndexingJob]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            # Possibly started by another worker
+            data = read_json(state_path("index_jobs", f"{job_id}.json"))
+            if data and data.get("id") == job_id and data.get("vault_path"):
+                job = IndexingJob.from_checkpoint(data)
+                job.remote = True
+                self.jobs[job.id] = job
+        elif job.remote:
+            job.refresh()
+        return job
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        return [job.to_dict() for job in sorted(self.jobs.values(), key=lambda j: j.created_at, reverse=True)]
+
+    def active_job_for(self, vault_path: str) -> Optional[IndexingJob]:
+        for job in self.jobs.values():
+            if job.vault_path == vault_path and job.status in ACTIVE_STATUSES:
+                return job
+        return None
+
+    def _remote_job_for(self, vault_path: str) -> Optional[IndexingJob]:
+        """Active job for the vault checkpointed by another worker that still holds its lock."""
+        if not self._is_running_elsewhere(vault_path):
+            return None
+        for job in self._load_checkpoints():
+            if job.vault_path == vault_path and job.status in ACTIVE_STATUSES:
+                job.remote = True
+                self.jobs[job.id] = job
+                return job
+        return None
+
+    def start_job(self, vault_path: str) -> IndexingJob:
+        """Starts a sync for the vault, or returns the one already running for it (in any worker)."""
+        existing = self.active_job_for(vault_path)
+        if existing and existing.remote:
+            existing.refresh()
+            existing = existing if existing.status in ACTIVE_STATUSES else None
+        if existing:
+            return existing
+        self.prune_finished()
+        remote = self._remote_job_for(vault_path)
+        if remote:
+            return remote
+        job = IndexingJob(vault_path)
+        self.jobs[job.id] = job
+        job.checkpoint()
+        if not self._launch(job):
+            # Another worker claimed the vault in the meantime
+            job.status = "cancelled"
+            job.checkpoint()
+            return self._remote_job_for(vault_path) or job
+        return job
+
+    def resume_job(self, job_id: str) -> Optional[IndexingJob]:
+        job = self.get_job(job_id)
+        if not job:
+            return None
+        if job.status in ("cancelled", "error") and not self._is_running_elsewhere(job.vault_path):
+            job.remote = False
+            job.status = "queued"
+            job.checkpoint()
+            self._launch(job)
+        return job
+
+    def cancel_job(self, job_id: str) -> Optional[IndexingJob]:
+        job = self.get_job(job_id)
+        if not job:
+            return None
+        if job.remote:
+            # The owning worker checks for this marker between files
+            if job.status in ACTIVE_STATUSES:
+                open(job.cancel_file, "w").close()
+        elif job.task and not job.task.done():
+            job.task.cancel()
+        elif job.status in ACTIVE_STATUSES:
+            job.status = "cancelled"
+            job.checkpoint()
+        return job
+
+    def _launch(self, job: IndexingJob) -> bool:
+        """Runs the job here if this worker can claim the vault; otherwise marks it as remote."""
+        lock = self._vault_lock(job.vault_path)
+        if not lock.acquire(blocking=False):
+            job.remote = True
+            return False
+        job.lock = lock
+        job.remote = False
+        if os.path.exists(job.cancel_file):
+            os.remove(job.cancel_file)
+        job.task = asyncio.create_task(self._run(job))
+        return True
+
+    async def _run(self, job: IndexingJob) -> None:
+        job.status = "running"
+        job.emit({"status": "started", "processed": len(job.done_files)})
+        done = set(job.done_files)
+        try:
+            async for progress in kb_service.sync_vault(job.vault_path, skip_files=set(done)):
+                if progress.get("status") == "error" and not progress.get("file"):
+                    # The store itself is unavailable; keep the checkpoint so the job can be resumed
+                    job.status = "error"
+                    job.errors.append({"message": progress.get("message", "")})
+                    job.emit(progress)
+                    break
+
+                if progress.get("status") == "done":
+                    continue
+
+                job.total = progress.get("total", job.total)
+                rel_path = progress.get("file")
+                if progress.get("status") == "error":
+                    # Not checkpointed as done, so a resume retries the note
+                    job.errors.append({"file": rel_path, "message": progress.get("message", "")})
+                elif rel_path and rel_path not in done:
+                    done.add(rel_path)
+                    job.done_files.append(rel_path)
+                job.emit(progress)
+                await job.checkpoint_async()
+                if os.path.exists(job.cancel_file):
+                    raise asyncio.CancelledError()
+            else:
+                job.status = "done"
+                job.emit({"status": "done", "total": job.total or len(job.done_files)})
+        except asyncio.CancelledError:
+            if self._shutting_down:
+                job.status = "queued"
+            else:
+                job.status = "cancelled"
+                job.emit({"status": "cancelled", "processed": len(job.done_files)})
+        except Exception as e:
+            logger.error(f"Indexing job {job.id} failed: {e}")
+            job.status = "error"
+            job.errors.append({"message": str(e)})
+            job.emit({"status": "error", "message": str(e)})
+        finally:
+            await job.wait_for_checkpoint()
+            job.checkpoint()
+            if job.lock is not None:
+                job.lock.release()
+                job.lock = None
+            if os.path.exists(job.cancel_file):
+                os.remove(job.cancel_file)
+
+    async def shutdown(self) -> None:
+        """Stops running jobs but leaves them queued so they resume on next startup."""
+        self._shutting_down = True
+        tasks = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+# Global instance
+indexing_service = IndexingService()
@@ -1,9 +1,20 @@
 import os
+import time
 import chromadb
 import httpx
 import logging
 import asyncio
 from typing import List, Dict, Any, Optional, Union, Tuple, AsyncGenerator
+from ollama_scheduler import ollama_scheduler
+from tracing import tracer
+from circuit_breaker import ollama_breaker, chroma_breaker, rerank_breaker, CircuitOpenError
+from session_service import session_vault
+from entity_service import entity_service
+from model_router import model_router
+from link_service import link_service
+from rerank_service import rerank_service
+from storage import vault_key
+from metrics import EMBEDDING_SECONDS, CHROMA_SECONDS, INDEX_FILE_SECONDS, FILE_SCAN_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -12,8 +23,10 @@ class KnowledgeBaseService:
         self.chroma_host = os.getenv("CHROMA_DB_HOST", "localhost")
         self.chroma_port = os.getenv("CHROMA_DB_PORT", "8000")
         
+        # Base names; every vault gets its own suffixed pair so project indexes coexist
         self.collection_world = "world_data"
         self.collection_novel = "novel_data"
+        self.default_vault_path: Optional[str] = None
         
         # Embedding Config (Ollama)
         self.ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434/api/embeddings")
@@ -24,9 +37,16 @@ class KnowledgeBaseService:
             self.ollama_embed_url = self.ollama_url
             
         self.model = "nomic-embed-text" 
-        self.extract_model = "llama3.2"
+
+        # Follow wikilinks from the top hits and add the best chunks of linked notes
+        self.expand_links = os.getenv("RAG_EXPAND_LINKS", "false").lower() in ("1", "true", "yes")
+        self.expand_results = int(os.getenv("RAG_EXPAND_RESULTS", 2))
+
+        # With reranking on, search returns trimmed passages within this many tokens
+        self.rerank_budget = int(os.getenv("RERANK_TOKEN_BUDGET", 600))
         
         self._client: Optional[chromadb.AsyncHttpClient] = None
+        chroma_breaker.probe = self.ping
         logger.info("KnowledgeBaseService initialized")
 
     async def get_client(self) -> chromadb.AsyncHttpClient:
@@ -43,31 +63,71 @@ class KnowledgeBaseService:
             except Exception as e:
                 logger.error(f"Error closing ChromaDB client: {e}")
 
+    def project_key(self, vault_path: str) -> str:
+        """Stable short identifier for a vault, used to namespace its collections."""
+        return vault_key(vault_path)
+
+    def collection_names(self, vault_path: Optional[str] = None) -> Tuple[str, str]:
+        """Returns the (world, novel) collection names for a vault, defaulting to the active one."""
+        vault_path = vault_path or self.active_vault_path
+        if not vault_path:
+            return self.collection_world, self.collection_novel
+        key = self.project_key(vault_path)
+        return f"{self.collection_world}_{key}", f"{self.collection_novel}_{key}"
+
+    @property
+    def active_vault_path(self) -> Optional[str]:
+        """The requesting session's vault, otherwise the default set through `set_active_vault`."""
+        return session_vault() or self.default_vault_path
+
+    def set_active_vault(self, vault_path: Optional[str]) -> None:
+        """Scopes searches to the given vault. Indexes of other vaults are left untouched."""
+        self.default_vault_path = vault_path
+        logger.info(f"Knowledge base scoped to: {vault_path}")
+
+    async def ping(self) -> bool:
+        """Breaker probe: Chroma is reachable and the active vault's collections exist."""
+        ok, message = await self.init_db()
+        if not ok:
+            # Drop the client so the next attempt reconnects from scratch
+            self._client = None
+            chroma_breaker.last_error = message
+        return ok
+
     async def init_db(self) -> Tuple[bool, str]:
         try:
             client = await self.get_client()
             await client.heartbeat()
             # Ensure collections exist
-            await client.get_or_create_collection(name=self.collection_world)
-            await client.get_or_create_collection(name=self.collection_novel)
+            name_world, name_novel = self.collection_names()
+            meta = {"vault_path": self.active_vault_path or ""}
+            await client.get_or_create_collection(name=name_world, metadata=meta)
+            await client.get_or_create_collection(name=name_novel, metadata=meta)
             return True, "ChromaDB Connected."
         except Exception as e:
             logger.error(f"Failed to connect/init ChromaDB: {e}")
             return False, str(e)
 
-    async def get_embedding(self, text: str) -> Optional[List[float]]:
-        """Generates embedding using Ollama."""
+    async def get_embedding(self, text: str, lane: str = "embedding") -> Optional[List[float]]:
+        """
+        Generates embedding using Ollama. Bulk indexing uses the low-priority lane.
+        Raises CircuitOpenError right away while Ollama is known to be down.
+        """
+        ollama_breaker.check()
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.ollama_embed_url,
-                    json={"model": self.model, "prompt": text},
-                    timeout=10
-                )
+            async with ollama_scheduler.slot(lane), httpx.AsyncClient() as client:
+                with EMBEDDING_SECONDS.time(lane=lane), tracer.span("kb.embedding", lane=lane):
+                    response = await client.post(
+                        self.ollama_embed_url,
+                        json={"model": self.model, "prompt": text},
+                        timeout=10
+                    )
                 response.raise_for_status()
-                return response.json().get("embedding")
+            ollama_breaker.record_success()
+            return response.json().get("embedding")
         except Exception as e:
             logger.error(f"Embedding Error: {e}")
+            ollama_breaker.record_error(e)
             return None
 
     def chunk_text(self, text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
@@ -78,104 +138,347 @@ class KnowledgeBaseService:
             chunks.append(chunk)
         return chunks
 
-    async def sync_vault(self, vault_path: str) -> AsyncGenerator[Dict[str, Any], None]:
-        try:
+    def list_vault_files(self, vault_path: str) -> List[str]:
+        """Relative paths of every indexable note in the vault, in a stable order."""
+        rel_paths = []
+        with FILE_SCAN_SECONDS.time(operation="index_scan"):
+            for root, _, files in os.walk(vault_path):
+                for file in files:
+                    if file.lower().endswith(('.md', '.txt')):
+                        rel_paths.append(os.path.relpath(os.path.join(root, file), vault_path))
+        return sorted(rel_paths)
+
+    async def get_collections(self, vault_path: Optional[str] = None) -> Tuple[Any, Any]:
+        """Returns the (world, novel) collections of a vault, creating them if needed."""
+        vault_path = vault_path or self.active_vault_path
+        name_world, name_novel = self.collection_names(vault_path)
+        meta = {"vault_path": vault_path or ""}
+        with chroma_breaker.guard():
             client = await self.get_client()
+            col_world = await client.get_or_create_collection(name=name_world, metadata=meta)
+            col_novel = await client.get_or_create_collection(name=name_novel, metadata=meta)
+        return col_world, col_novel
+
+    async def index_file(self, vault_path: str, rel_path: str) -> int:
+        """
+        Re-embeds a single note, replacing whatever chunks it had before.
+        Returns the number of chunks stored. Raises, leaving the old chunks in place,
+        if any chunk can't be embedded.
+        """
+        started = time.perf_counter()
+        col_world, col_novel = await self.get_collections(vault_path)
+
+        # Determine Category
+        is_novel = "Novel" in rel_path
+        target_col = col_novel if is_novel else col_world
+
+        # PR Feedback: Reading file off the event loop
+        text = await asyncio.to_thread(self._read_file_sync, os.path.join(vault_path, rel_path))
+        chunks = self.chunk_text(text)
+
+        ids = []
+        documents = []
+        embeddings = []
+        metadatas = []
+
+        for idx, chunk in enumerate(chunks):
+            vec = await self.get_embedding(chunk)
+            if not vec:
+                # Keep the note's previous chunks rather than indexing it partially
+                raise RuntimeError(f"No embedding for chunk {idx} of {rel_path}; its previous chunks were kept")
+            chunk_id = f"{rel_path}_{idx}"
+            ids.append(chunk_id)
+            documents.append(chunk)
+            embeddings.append(vec)
+            metadatas.append({"source": rel_path, "type": "novel" if is_novel else "world"})
+
+        # Swap old chunks for new ones only once the embeddings are ready
+        await self._delete_chunks(vault_path, rel_path)
+        if ids:
+            with CHROMA_SECONDS.time(operation="add"):
+                await target_col.add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+        INDEX_FILE_SECONDS.observe(time.perf_counter() - started)
+        if link_service.enabled:
+            await link_service.load(vault_path)
+            link_service.update_file(vault_path, rel_path, text)
+
+        # Lore entities come from World notes only; unchanged notes are skipped by hash
+        try:
+            if is_novel:
+                entity_service.remove_file(self.project_key(vault_path), rel_path)
+            else:
+                route = await model_router.route("extraction", vault_path=vault_path)
+                await entity_service.update_file(
+                    self.project_key(vault_path), rel_path, text, list(zip(ids, documents)), route=route
+                )
         except Exception as e:
-            yield {"status": "error", "message": f"ChromaDB not available: {e}"}
-            return
+            logger.error(f"Entity extraction failed for {rel_path}: {e}")
+        return len(ids)
+
+    async def _delete_chunks(self, vault_path: str, rel_path: str) -> None:
+        for col in await self.get_collections(vault_path):
+            with CHROMA_SECONDS.time(operation="delete"):
+                await col.delete(where={"source": rel_path})
 
-        # Delete existing to Resync
+    async def remove_file(self, vault_path: str, rel_path: str) -> None:
+        """Drops every chunk that came from `rel_path` in both collections, and its entities."""
+        await self._delete_chunks(vault_path, rel_path)
+        entity_service.remove_file(self.project_key(vault_path), rel_path)
+        if link_service.enabled:
+            await link_service.load(vault_path)
+            link_service.remove_file(vault_path, rel_path)
+
+    async def prune_missing(self, vault_path: str, present: List[str]) -> int:
+        """Removes chunks of notes that no longer exist in the vault. Returns how many were dropped."""
+        present_set = set(present)
+        removed = 0
+        for col in await self.get_collections(vault_path):
+            existing = await col.get(include=["metadatas"])
+            stale_ids = [
+                chunk_id for chunk_id, meta in zip(existing["ids"], existing["metadatas"] or [])
+                if (meta or {}).get("source") not in present_set
+            ]
+            if stale_ids:
+                await col.delete(ids=stale_ids)
+                removed += len(stale_ids)
+        entity_service.prune(self.project_key(vault_path), present)
+        if link_service.enabled:
+            await link_service.load(vault_path)
+            link_service.prune(vault_path, present)
+        return removed
+
+    async def sync_vault(self, vault_path: str, skip_files: Optional[set] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Re-indexes the vault file by file. Chunks are replaced per note instead of
+        dropping the collections up front, so an interrupted sync leaves a usable index.
+        `skip_files` lets a resumed job pass over notes it already finished.
+        """
         try:
-            await client.delete_collection(self.collection_world)
-            await client.delete_collection(self.collection_novel)
-        except:
-            pass
+            ollama_breaker.check()
+            await self.get_collections(vault_path)
+        except CircuitOpenError as e:
+            yield self._unavailable(e)
+            return
+        except Exception as e:
+            yield {"status": "error", "message": f"ChromaDB not available: {e}"}
+            return
 
-        col_world = await client.get_or_create_collection(name=self.collection_world)
-        col_novel = await client.get_or_create_collection(name=self.collection_novel)
-        
+        skip_files = skip_files or set()
+        rel_paths = await asyncio.to_thread(self.list_vault_files, vault_path)
+        total = len(rel_paths)
         files_processed = 0
-        
-        for root, _, files in os.walk(vault_path):
-            for file in files:
-                if file.lower().endswith(('.md', '.txt')):
-                    files_processed += 1
-                    full_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(full_path, vault_path)
-                    
-                    # Determine Category
-                    is_novel = "Novel" in rel_path
-                    target_col = col_novel if is_novel else col_world
-                    
-                    try:
-                        # PR Feedback: Reading file off the event loop
-                        text = await asyncio.to_thread(self._read_file_sync, full_path)
-                        
-                        chunks = self.chunk_text(text)
-                        
-                        ids = []
-                        documents = []
-                        embeddings = []
-                        metadatas = []
-
-                        for idx, chunk in enumerate(chunks):
-                            vec = await self.get_embedding(chunk)
-                            if vec:
-                                chunk_id = f"{rel_path}_{idx}"
-                                ids.append(chunk_id)
-                                documents.append(chunk)
-                                embeddings.append(vec)
-                                metadatas.append({"source": rel_path, "type": "novel" if is_novel else "world"})
-                        
-                        if ids:
-                            await target_col.add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
-
-                        yield {"status": "progress", "file": rel_path}
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing {rel_path}: {e}")
-                        yield {"status": "error", "message": f"Error in {rel_path}: {e}"}
 
+        for rel_path in rel_paths:
+            files_processed += 1
+            if rel_path in skip_files:
+                continue
+            try:
+                await self.index_file(vault_path, rel_path)
+                yield {"status": "progress", "file": rel_path, "current": files_processed, "total": total}
+            except CircuitOpenError as e:
+                # No point trying the remaining notes; the job keeps its checkpoint for a resume
+                yield self._unavailable(e)
+                return
+            except Exception as e:
+                logger.error(f"Error processing {rel_path}: {e}")
+                yield {"status": "error", "file": rel_path, "message": f"Error in {rel_path}: {e}"}
+
+        try:
+            await self.prune_missing(vault_path, rel_paths)
+        except Exception as e:
+            logger.error(f"Error pruning deleted notes: {e}")
         yield {"status": "done", "total": files_processed}
 
+    @staticmethod
+    def _unavailable(error: CircuitOpenError) -> Dict[str, Any]:
+        return {"status": "error", "message": str(error), "code": "dependency_unavailable", "dependency": error.dependency}
+
     def _read_file_sync(self, filepath: str) -> str:
         with open(filepath, 'r', encoding='utf-8') as f:
             return f.read()
 
-    async def search(self, query: str, top_k: int = 3) -> List[str]:
-        vec = await self.get_embedding(query)
+    async def search(
+        self, query: str, top_k: int = 3, vault_path: Optional[str] = None, expand_links: Optional[bool] = None
+    ) -> List[str]:
+        """
+        Searches the active project's collections (or those of `vault_path`).
+        With `expand_links` (default RAG_EXPAND_LINKS), notes linked to or from the
+        top hits contribute their most relevant chunks as well.
+        """
+        expand_links = self.expand_links if expand_links is None else expand_links
+        with tracer.span("kb.search", top_k=top_k) as span:
+            results = await self._search(query, top_k, vault_path, expand_links)
+            if span is not None:
+                span.attributes["results"] = len(results)
+            return results
+
+    def lookup_entity(self, name: str, vault_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Lore entity (character, place, faction, date) named exactly `name` or one of its aliases."""
+        vault_path = vault_path or self.active_vault_path
+        return entity_service.lookup(self.project_key(vault_path), name) if vault_path else None
+
+    def list_entities(self, kind: Optional[str] = None, vault_path: Optional[str] = None) -> List[Dict[str, Any]]:
+        vault_path = vault_path or self.active_vault_path
+        return entity_service.list_entities(self.project_key(vault_path), kind) if vault_path else []
+
+    async def _entity_snippets(self, entity: Dict[str, Any], vault_path: Optional[str]) -> List[str]:
+        """The entity's summary plus the World chunks it was extracted from, fetched by id."""
+        name_world, _ = self.collection_names(vault_path)
+        with chroma_breaker.guard():
+            client = await self.get_client()
+            col = await client.get_collection(name_world)
+            with CHROMA_SECONDS.time(operation="get"):
+                found = await col.get(ids=entity["chunks"][:4], include=["documents"])
+        snippets = [doc.strip() for doc in found.get("documents") or [] if doc and doc.strip()]
+        if snippets and entity.get("summary"):
+            snippets.insert(0, f"{entity['name']} ({entity['type']}): {entity['summary']}")
+        return snippets
+
+    async def _search(self, query: str, top_k: int, vault_path: Optional[str], expand_links: bool = False) -> List[str]:
+        # A query that is exactly a known entity name needs neither an embedding nor a vector search
+        entity = self.lookup_entity(query, vault_path)
+        if entity and entity["chunks"] and chroma_breaker.allow():
+            try:
+                snippets = await self._entity_snippets(entity, vault_path)
+                if snippets:
+                    tracer.annotate(entity_hit=entity["name"])
+                    return snippets[:4]
+            except Exception as e:
+                logger.error(f"Entity lookup failed, falling back to search: {e}")
+
+        # Fail fast while a dependency is down instead of waiting on its timeout
+        if not chroma_breaker.allow():
+            tracer.annotate(unavailable="chroma")
+            return []
+
+        # Query embeddings are interactive: don't queue them behind a running sync
+        try:
+            vec = await self.get_embedding(query, lane="chat")
+        except CircuitOpenError:
+            tracer.annotate(unavailable="ollama")
+            return []
         if not vec: return []
         
         try:
-            client = await self.get_client()
+            with chroma_breaker.guard():
+                client = await self.get_client()
         except Exception:
             return []
 
+        # Reranking looks at a wider candidate set than it returns
+        rerank = rerank_service.enabled and rerank_breaker.allow()
+        n_results = max(top_k, rerank_service.candidates) if rerank else top_k
+
+        name_world, name_novel = self.collection_names(vault_path)
         results = []
+        sources = []
         try:
-            # Search World
-            c_world = await client.get_collection(self.collection_world)
-            r_world = await c_world.query(query_embeddings=[vec], n_results=top_k)
-            if r_world and r_world['documents']:
-                for doc in r_world['documents'][0]:
-                    clean_doc = doc.strip()
-                    if clean_doc and clean_doc not in results:
-                        results.append(clean_doc)
-
-            # Search Novel
-            c_novel = await client.get_collection(self.collection_novel)
-            r_novel = await c_novel.query(query_embeddings=[vec], n_results=top_k)
-            if r_novel and r_novel['documents']:
-                 for doc in r_novel['documents'][0]:
-                    clean_doc = doc.strip()
-                    if clean_doc and clean_doc not in results:
-                        results.append(clean_doc)
-                 
-            return results[:4] # Cap at 4 highly relevant snippets
+            with chroma_breaker.guard():
+                # Search World
+                c_world = await client.get_collection(name_world)
+                with CHROMA_SECONDS.time(operation="query"), tracer.span("chroma.query"):
+                    r_world = await c_world.query(query_embeddings=[vec], n_results=n_results)
+                if r_world and r_world['documents']:
+                    for doc, source in self._hits(r_world):
+                        clean_doc = doc.strip()
+                        if clean_doc and clean_doc not in results:
+                            results.append(clean_doc)
+                            sources.append(source)
+
+                # Search Novel
+                c_novel = await client.get_collection(name_novel)
+                with CHROMA_SECONDS.time(operation="query"), tracer.span("chroma.query"):
+                    r_novel = await c_novel.query(query_embeddings=[vec], n_results=n_results)
+                if r_novel and r_novel['documents']:
+                     for doc, source in self._hits(r_novel):
+                        clean_doc = doc.strip()
+                        if clean_doc and clean_doc not in results:
+                            results.append(clean_doc)
+                            sources.append(source)
+
         except Exception as e:
             logger.error(f"Search Error: {e}")
             return []
 
+        if rerank and len(results) > 1:
+            try:
+                ranked = await rerank_service.rerank(query, results, top_n=4)
+                results = self.fit_token_budget([text for _, text in ranked], self.rerank_budget)
+                sources = [sources[i] for i, _ in ranked]
+                tracer.annotate(reranked=len(ranked))
+            except Exception as e:
+                logger.error(f"Reranking failed, keeping vector order: {e}")
+        results = results[:4] # Cap at 4 highly relevant snippets
+
+        if expand_links:
+            try:
+                with chroma_breaker.guard():
+                    hit_notes = [source for source in sources[:len(results)] if source]
+                    results += await self._linked_snippets(vec, hit_notes, results, (c_world, c_novel), vault_path)
+            except Exception as e:
+                logger.error(f"Link expansion failed: {e}")
+        return results
+
+    @staticmethod
+    def _hits(result: Dict[str, Any]) -> List[Tuple[str, Optional[str]]]:
+        """(document, source note) pairs of a single-query Chroma result."""
+        docs = (result.get("documents") or [[]])[0] or []
+        metas = (result.get("metadatas") or [[]])[0] or []
+        return [(doc, (metas[i] or {}).get("source") if i < len(metas) else None) for i, doc in enumerate(docs)]
+
+    async def _linked_snippets(
+        self, vec: List[float], hit_notes: List[str], seen: List[str], collections: Tuple[Any, Any], vault_path: Optional[str]
+    ) -> List[str]:
+        """Best chunks (closest to the query) among notes one wikilink away from the hits."""
+        vault_path = vault_path or self.active_vault_path
+        await link_service.load(vault_path)
+        linked = link_service.neighbors(hit_notes, hops=1, vault_path=vault_path)
+        if not linked or self.expand_results <= 0:
+            return []
+        candidates = []
+        for col in collections:
+            with CHROMA_SECONDS.time(operation="query"), tracer.span("chroma.query", expand="links"):
+                found = await col.query(
+                    query_embeddings=[vec], n_results=self.expand_results, where={"source": {"$in": linked}}
+                )
+            for doc, distance in zip((found.get("documents") or [[]])[0], (found.get("distances") or [[]])[0]):
+                if doc and doc.strip() not in seen:
+                    candidates.append((distance, doc.strip()))
+        return [doc for _, doc in sorted(candidates)[:self.expand_results]]
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Rough token count (~4 characters per token) good enough for budgeting prompts."""
+        return max(1, len(text) // 4)
+
+    def fit_token_budget(self, snippets: List[str], max_tokens: int) -> List[str]:
+        """Keeps snippets in rank order until the budget is spent; the last one is cut at a word boundary."""
+        selected = []
+        remaining = max_tokens
+        for snippet in snippets:
+            cost = self.estimate_tokens(snippet)
+            if cost <= remaining:
+                selected.append(snippet)
+                remaining -= cost
+                continue
+            if remaining >= 50:
+                cut = snippet[:remaining * 4].rsplit(" ", 1)[0]
+                selected.append(cut + " ...")
+            break
+        return selected
+
+    async def prefetch_context(self, query: str, max_tokens: int = 600, timeout: float = 2.0) -> List[str]:
+        """
+        Retrieval done up front for a chat prompt so the model can answer without a
+        search_vault round-trip. Gives up after `timeout` seconds and returns nothing.
+        """
+        try:
+            with tracer.span("kb.prefetch"):
+                snippets = await asyncio.wait_for(self.search(query), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.info("Context prefetch timed out")
+            return []
+        return self.fit_token_budget(snippets, max_tokens)
+
 # Global instance
 kb_service = KnowledgeBaseService()
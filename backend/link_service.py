@@ -0,0 +1,357 @@
+import os
+import re
+import asyncio
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import List, Dict, Any, Optional, Set, Iterable, Tuple
+
+from storage import state_path, read_json, update_json, vault_key
+from vault_service import vault_service
+
+logger = logging.getLogger(__name__)
+
+# [[Target]], [[Target|alias]], [[Target#Heading]], [[Target^block]] (and ![[embeds]])
+WIKILINK_RE = re.compile(r"\[\[([^\]\|#\^\n]+)[^\]\n]*\]\]")
+
+
+def parse_links(text: str) -> List[str]:
+    """Link targets of a note as written, in order, without duplicates."""
+    targets = []
+    for match in WIKILINK_RE.finditer(text):
+        target = match.group(1).strip().replace("\\", "/")
+        if target and target not in targets:
+            targets.append(target)
+    return targets
+
+
+def _stem(path: str) -> str:
+    """Lower-cased path without extension, with forward slashes."""
+    path = path.replace("\\", "/").lower()
+    return path[:-3] if path.endswith(".md") else path
+
+
+def _name(path: str) -> str:
+    return _stem(path).rsplit("/", 1)[-1]
+
+
+class LinkGraph:
+    """
+    Wikilink graph of one vault: forward links, backlinks and unresolved links per note.
+
+    Links resolve like Obsidian's: by note name, or by (partial) path when the link
+    contains a folder; ambiguous names go to the shallowest note. All updates touch
+    only the edges of the notes involved, so saving a note costs O(its links) and a
+    backlink query is a set lookup.
+    """
+
+    def __init__(self) -> None:
+        self.links: Dict[str, List[str]] = {}  # note -> link targets as written
+        self.forward: Dict[str, Set[str]] = {}
+        self.backward: Dict[str, Set[str]] = defaultdict(set)
+        self.unresolved: Dict[str, Set[str]] = {}
+        self.waiting: Dict[str, Set[str]] = defaultdict(set)  # note name -> notes with unresolved links to it
+        self.by_name: Dict[str, Set[str]] = defaultdict(set)
+
+    def resolve(self, target: str) -> Optional[str]:
+        candidates = self.by_name.get(_name(target))
+        if not candidates:
+            return None
+        if "/" in target:
+            suffix = _stem(target)
+            candidates = [c for c in candidates if _stem(c) == suffix or _stem(c).endswith("/" + suffix)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: (_stem(c).count("/"), c))
+
+    def set_note(self, rel_path: str, targets: List[str]) -> None:
+        is_new = rel_path not in self.links
+        self._unlink(rel_path)
+        self.links[rel_path] = targets
+        self._link(rel_path)
+        if is_new:
+            self.by_name[_name(rel_path)].add(rel_path)
+            # Links that were waiting for a note of this name now resolve
+            for source in list(self.waiting.pop(_name(rel_path), ())):
+                self._unlink(source)
+                self._link(source)
+
+    def remove_note(self, rel_path: str) -> None:
+        if rel_path not in self.links:
+            return
+        self._unlink(rel_path)
+        del self.links[rel_path]
+        names = self.by_name.get(_name(rel_path))
+        if names is not None:
+            names.discard(rel_path)
+            if not names:
+                del self.by_name[_name(rel_path)]
+        # Notes that linked here now point to another note of that name, or nowhere
+        for source in list(self.backward.pop(rel_path, ())):
+            self._unlink(source)
+            self._link(source)
+
+    def _link(self, rel_path: str) -> None:
+        resolved, unresolved = set(), set()
+        for target in self.links[rel_path]:
+            note = self.resolve(target)
+            if note is None:
+                unresolved.add(target)
+                self.waiting[_name(target)].add(rel_path)
+            elif note != rel_path:
+                resolved.add(note)
+                self.backward[note].add(rel_path)
+        self.forward[rel_path] = resolved
+        self.unresolved[rel_path] = unresolved
+
+    def _unlink(self, rel_path: str) -> None:
+        for note in self.forward.pop(rel_path, ()):
+            sources = self.backward.get(note)
+            if sources is not None:
+                sources.discard(rel_path)
+                if not sources:
+                    del self.backward[note]
+        for target in self.unresolved.pop(rel_path, ()):
+            sources = self.waiting.get(_name(target))
+            if sources is not None:
+                sources.discard(rel_path)
+                if not sources:
+                    del self.waiting[_name(target)]
+
+    def neighborhood(self, start: Iterable[str], hops: int, max_nodes: int) -> List[str]:
+        """Notes within `hops` links of `start` in either direction, nearest first (breadth-first)."""
+        seen = {note: 0 for note in start if note in self.links}
+        queue = deque(seen)
+        while queue and len(seen) < max_nodes:
+            note = queue.popleft()
+            if seen[note] >= hops:
+                continue
+            for other in sorted(self.forward.get(note, set()) | self.backward.get(note, set())):
+                if other not in seen:
+                    seen[other] = seen[note] + 1
+                    queue.append(other)
+                    if len(seen) >= max_nodes:
+                        break
+        return list(seen)
+
+
+class LinkService:
+    """
+    Keeps a LinkGraph per vault in memory, persisted as each note's raw link targets.
+    Updated when notes are saved through the API and when they are (re)indexed or
+    removed by the watcher and syncs. Writes to disk are batched for a second, so a
+    full sync doesn't rewrite the index once per note.
+    """
+
+    FLUSH_DELAY = 1.0
+
+    def __init__(self) -> None:
+        self.enabled = os.getenv("LINK_GRAPH", "true").lower() in ("1", "true", "yes")
+        # vault key -> (index file mtime, graph)
+        self._graphs: Dict[str, Tuple[float, LinkGraph]] = {}
+        # vault key -> {rel_path: targets, or None for removed notes} not yet on disk
+        self._dirty: Dict[str, Dict[str, Optional[List[str]]]] = {}
+        # Held while a graph is built or re-read, so a load in a thread and a caller don't both scan
+        self._build_lock = threading.Lock()
+        vault_service.add_change_listener(self.on_change)
+
+    def _path(self, key: str) -> str:
+        return state_path("links", f"{key}.json")
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        return os.path.getmtime(path) if os.path.exists(path) else 0.0
+
+    def _cached(self, key: str) -> Optional[LinkGraph]:
+        cached = self._graphs.get(key)
+        if cached is not None and (cached[0] == self._mtime(self._path(key)) or key in self._dirty):
+            return cached[1]
+        return None
+
+    async def load(self, vault_path: Optional[str] = None) -> LinkGraph:
+        """
+        The graph, built (first use: every note is read) or re-read off the event loop.
+        Async code awaits this before the queries below, which are then cheap.
+        """
+        vault_path = vault_path or vault_service.vault_path
+        if not vault_path:
+            return LinkGraph()
+        cached = self._cached(vault_key(vault_path))
+        return cached if cached is not None else await asyncio.to_thread(self.graph, vault_path)
+
+    def graph(self, vault_path: Optional[str] = None) -> LinkGraph:
+        vault_path = vault_path or vault_service.vault_path
+        if not vault_path:
+            return LinkGraph()
+        key = vault_key(vault_path)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+        with self._build_lock:
+            cached = self._cached(key)
+            return cached if cached is not None else self._build(vault_path, key)
+
+    def _build(self, vault_path: str, key: str) -> LinkGraph:
+        path = self._path(key)
+        mtime = self._mtime(path)
+        graph = LinkGraph()
+        data = read_json(path)
+        if data is None:
+            # First use on this vault: build from the notes themselves
+            files = self._scan(vault_path)
+            self._dirty[key] = dict(files)
+            self.flush(key)
+            mtime = self._mtime(path)
+        else:
+            files = data.get("files", {})
+        for rel_path in files:
+            graph.by_name[_name(rel_path)].add(rel_path)
+            graph.links[rel_path] = files[rel_path]
+        for rel_path in files:
+            graph._link(rel_path)
+        self._graphs[key] = (mtime, graph)
+        return graph
+
+    @staticmethod
+    def _scan(vault_path: str) -> Dict[str, List[str]]:
+        files = {}
+        for root, _, names in os.walk(vault_path):
+            for name in names:
+                if name.lower().endswith((".md", ".txt")):
+                    full_path = os.path.join(root, name)
+                    try:
+                        with open(full_path, "r", encoding="utf-8") as f:
+                            files[os.path.relpath(full_path, vault_path)] = parse_links(f.read())
+                    except (OSError, UnicodeDecodeError) as e:
+                        logger.warning(f"Skipping {full_path} in link graph: {e}")
+        return files
+
+    def update_file(self, vault_path: str, rel_path: str, text: str) -> bool:
+        """Re-reads a note's links. Returns False when they didn't change."""
+        if not self.enabled:
+            return False
+        graph = self.graph(vault_path)
+        targets = parse_links(text)
+        if graph.links.get(rel_path) == targets:
+            return False
+        graph.set_note(rel_path, targets)
+        self._mark(vault_key(vault_path), {rel_path: targets})
+        return True
+
+    def remove_file(self, vault_path: str, rel_path: str) -> None:
+        if not self.enabled:
+            return
+        graph = self.graph(vault_path)
+        if rel_path in graph.links:
+            graph.remove_note(rel_path)
+            self._mark(vault_key(vault_path), {rel_path: None})
+
+    def prune(self, vault_path: str, present: List[str]) -> None:
+        if not self.enabled:
+            return
+        graph = self.graph(vault_path)
+        present_set = set(present)
+        stale = [rel_path for rel_path in graph.links if rel_path not in present_set]
+        for rel_path in stale:
+            graph.remove_note(rel_path)
+        if stale:
+            self._mark(vault_key(vault_path), dict.fromkeys(stale))
+        self.flush(vault_key(vault_path))
+
+    def on_change(self, vault_path: str, rel_path: str) -> None:
+        """Change listener for notes saved through the API."""
+        if not rel_path.lower().endswith((".md", ".txt")):
+            return
+        if self.enabled and self._cached(vault_key(vault_path)) is None:
+            try:
+                # Saves come from request handlers: build the graph off the loop, then update
+                asyncio.get_running_loop().create_task(self._update_when_loaded(vault_path, rel_path))
+                return
+            except RuntimeError:  # No event loop (scripts, tests)
+                pass
+        self._update_from_disk(vault_path, rel_path)
+
+    async def _update_when_loaded(self, vault_path: str, rel_path: str) -> None:
+        await self.load(vault_path)
+        self._update_from_disk(vault_path, rel_path)
+
+    def _update_from_disk(self, vault_path: str, rel_path: str) -> None:
+        try:
+            with open(os.path.join(vault_path, rel_path), "r", encoding="utf-8") as f:
+                self.update_file(vault_path, rel_path, f.read())
+        except OSError as e:
+            logger.error(f"Could not update links of {rel_path}: {e}")
+
+    def _mark(self, key: str, changes: Dict[str, Optional[List[str]]]) -> None:
+        first = key not in self._dirty
+        self._dirty.setdefault(key, {}).update(changes)
+        if not first:
+            return
+        try:
+            asyncio.get_running_loop().call_later(self.FLUSH_DELAY, self.flush, key)
+        except RuntimeError:  # No event loop (scripts, tests): write right away
+            self.flush(key)
+
+    def flush(self, key: str) -> None:
+        changes = self._dirty.pop(key, None)
+        if not changes:
+            return
+        path = self._path(key)
+        before = self._mtime(path)
+
+        def mutate(data):
+            data = data or {"files": {}}
+            files = data.setdefault("files", {})
+            for rel_path, targets in changes.items():
+                if targets is None:
+                    files.pop(rel_path, None)
+                else:
+                    files[rel_path] = targets
+            return data
+
+        try:
+            update_json(path, mutate, default={"files": {}})
+        except Exception as e:
+            logger.error(f"Failed to save link graph: {e}")
+            return
+        cached = self._graphs.get(key)
+        if cached is not None:
+            if cached[0] == before:
+                self._graphs[key] = (self._mtime(path), cached[1])
+            else:
+                # Another worker wrote in between: reload the merged file on next use
+                self._graphs.pop(key, None)
+
+    # Queries (relative paths of the active vault unless `vault_path` is given)
+
+    def backlinks(self, rel_path: str, vault_path: Optional[str] = None) -> List[str]:
+        return sorted(self.graph(vault_path).backward.get(rel_path, ()))
+
+    def links(self, rel_path: str, vault_path: Optional[str] = None) -> Dict[str, Any]:
+        graph = self.graph(vault_path)
+        return {
+            "path": rel_path,
+            "links": sorted(graph.forward.get(rel_path, ())),
+            "unresolved": sorted(graph.unresolved.get(rel_path, ())),
+            "backlinks": sorted(graph.backward.get(rel_path, ())),
+        }
+
+    def unresolved(self, vault_path: Optional[str] = None) -> Dict[str, List[str]]:
+        graph = self.graph(vault_path)
+        return {rel_path: sorted(targets) for rel_path, targets in sorted(graph.unresolved.items()) if targets}
+
+    def neighborhood(self, rel_path: str, hops: int = 1, max_nodes: int = 200, vault_path: Optional[str] = None) -> Dict[str, Any]:
+        graph = self.graph(vault_path)
+        nodes = graph.neighborhood([rel_path], hops, max_nodes)
+        members = set(nodes)
+        edges = [[source, target] for source in nodes for target in sorted(graph.forward.get(source, ())) if target in members]
+        return {"path": rel_path, "hops": hops, "nodes": nodes, "edges": edges}
+
+    def neighbors(self, rel_paths: Iterable[str], hops: int = 1, max_nodes: int = 50, vault_path: Optional[str] = None) -> List[str]:
+        """Notes linked to or from `rel_paths` (excluding them), for expanding search hits."""
+        start = list(rel_paths)
+        nodes = self.graph(vault_path).neighborhood(start, hops, max_nodes + len(start))
+        return [note for note in nodes if note not in start][:max_nodes]
+
+# Global instance
+link_service = LinkService()
@@ -0,0 +1,186 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Optional, Callable, Iterator
+
+# Latency buckets in seconds, from sub-millisecond store lookups to multi-minute generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Gauge set directly or computed at scrape time by a callback returning {label values: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        if self.callback:
+            items = list(self.callback().items())
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._values.items()]
+        lines = self.header()
+        for key, series in items:
+            for idx, bound in enumerate(self.buckets):
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {series[idx]}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Backend metrics ---
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "luna_http_request_seconds", "Time until the response (or stream headers) is returned.", ("route", "method", "status"))
+OLLAMA_TTFT_SECONDS = REGISTRY.histogram(
+    "luna_ollama_time_to_first_token_seconds", "Delay between sending a generation and its first token.", ("lane", "step"))
+OLLAMA_GENERATION_SECONDS = REGISTRY.histogram(
+    "luna_ollama_generation_seconds", "Wall time of a streamed generation.", ("lane", "step"))
+OLLAMA_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "luna_ollama_tokens_per_second", "Decode speed reported by Ollama (eval_count / eval_duration).", ("lane",),
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200))
+OLLAMA_TOKENS = REGISTRY.counter(
+    "luna_ollama_tokens_total", "Tokens generated by Ollama.", ("lane",))
+OLLAMA_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "luna_ollama_queue_wait_seconds", "Time a request waited for a scheduler slot.", ("lane",))
+TOOL_CALL_SECONDS = REGISTRY.histogram(
+    "luna_tool_call_seconds", "Duration of tool handlers invoked by the model.", ("tool",))
+EMBEDDING_SECONDS = REGISTRY.histogram(
+    "luna_embedding_seconds", "Latency of a single Ollama embedding call.", ("lane",))
+INDEX_FILE_SECONDS = REGISTRY.histogram(
+    "luna_index_file_seconds", "Time to embed and store all chunks of one note.", ())
+CHROMA_SECONDS = REGISTRY.histogram(
+    "luna_chroma_seconds", "Latency of ChromaDB operations.", ("operation",))
+MOOD_SECONDS = REGISTRY.histogram(
+    "luna_mood_inference_seconds", "Emotion classifier inference time.", ())
+FILE_SCAN_SECONDS = REGISTRY.histogram(
+    "luna_file_scan_seconds", "Time to walk the vault directory tree.", ("operation",))
+WEB_SEARCH_SECONDS = REGISTRY.histogram(
+    "luna_web_search_seconds", "Web search and page fetch latency.", ("operation",))
+CACHE_LOOKUPS = REGISTRY.counter(
+    "luna_response_cache_lookups_total", "Response cache lookups by result.", ("task", "result"))
@@ -0,0 +1,141 @@
+import os
+import time
+import logging
+from typing import List, Dict, Any, Optional, Set
+
+import httpx
+
+from general_functions import OLLAMA_URL, MODEL
+from vault_service import vault_service
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+TASKS = ("chat", "fact_check", "grammar", "summary", "extraction")
+OPTION_KEYS = ("num_ctx", "num_predict", "temperature")
+
+# Smaller model for the mechanical tasks, so they don't need (or evict) the chat model
+SMALL_MODEL = os.getenv("SMALL_MODEL", "llama3.2:1b")
+
+# task: (model, generation options, keep_alive)
+DEFAULT_ROUTES = {
+    "chat": (MODEL, {"temperature": 0.7}, "30m"),
+    "fact_check": (MODEL, {"temperature": 0, "num_ctx": 4096, "num_predict": 512}, "5m"),
+    "grammar": (SMALL_MODEL, {"temperature": 0, "num_ctx": 4096}, "2m"),
+    "summary": (SMALL_MODEL, {"temperature": 0.3, "num_ctx": 8192, "num_predict": 512}, "2m"),
+    "extraction": (SMALL_MODEL, {"temperature": 0, "num_ctx": 2048, "num_predict": 512}, "2m"),
+}
+
+
+def _tagged(model: str) -> str:
+    """Ollama lists untagged models as `name:latest`."""
+    return model if ":" in model else f"{model}:latest"
+
+
+class ModelRouter:
+    """
+    Picks the model and generation options for each kind of Ollama call.
+
+    Routes come from DEFAULT_ROUTES, overridden per task by ROUTE_<TASK>_MODEL,
+    _NUM_CTX, _NUM_PREDICT, _TEMPERATURE, _KEEP_ALIVE and _FALLBACKS, and then by the
+    `models` section of the active project's config, e.g.
+    {"models": {"grammar": {"model": "qwen2.5:1.5b", "num_ctx": 2048}}}.
+
+    A model that isn't pulled is skipped for the route's fallbacks and finally the
+    chat model. Cheap tasks get a short keep_alive, so their model leaves memory
+    soon after instead of pushing the chat model out.
+    """
+
+    def __init__(self) -> None:
+        self.list_ttl = float(os.getenv("MODEL_LIST_TTL", 60))
+        self.routes: Dict[str, Dict[str, Any]] = {}
+        for task, (model, options, keep_alive) in DEFAULT_ROUTES.items():
+            key = f"ROUTE_{task.upper()}"
+            options = dict(options)
+            for option, cast in (("num_ctx", int), ("num_predict", int), ("temperature", float)):
+                value = os.getenv(f"{key}_{option.upper()}")
+                if value:
+                    options[option] = cast(value)
+            fallbacks = os.getenv(f"{key}_FALLBACKS", "")
+            self.routes[task] = {
+                "model": os.getenv(f"{key}_MODEL", model),
+                "fallbacks": [m.strip() for m in fallbacks.split(",") if m.strip()],
+                "options": options,
+                "keep_alive": os.getenv(f"{key}_KEEP_ALIVE", keep_alive),
+            }
+        self._available: Optional[Set[str]] = None
+        self._listed_at = 0.0
+
+    async def available_models(self, refresh: bool = False) -> Optional[Set[str]]:
+        """Models pulled in Ollama (cached for `list_ttl`), or None when Ollama can't be asked."""
+        if not refresh and self._available is not None and time.monotonic() - self._listed_at < self.list_ttl:
+            return self._available
+        base_url = OLLAMA_URL.replace("/api/generate", "")
+        try:
+            async with httpx.AsyncClient(timeout=2) as client:
+                response = await client.get(f"{base_url}/api/tags")
+                response.raise_for_status()
+            self._available = {_tagged(m["name"]) for m in response.json().get("models", [])}
+        except Exception as e:
+            logger.debug(f"Could not list Ollama models: {e}")
+            # Keep the last known list; without one, routes are used as configured
+        self._listed_at = time.monotonic()
+        return self._available
+
+    def _project_routes(self, vault_path: Optional[str]) -> Dict[str, Any]:
+        # Imported here: project_service uses the router for summaries
+        from project_service import project_service
+        config = project_service.config_for_vault(vault_path) if vault_path else None
+        return (config or {}).get("models") or {}
+
+    def configured(self, task: str, project_config: Optional[Dict[str, Any]] = None, vault_path: Optional[str] = None) -> Dict[str, Any]:
+        """The route for `task` with project overrides applied, before checking what is pulled."""
+        if task not in self.routes:
+            raise ValueError(f"Unknown model task '{task}'")
+        route = self.routes[task]
+        overrides = (project_config or {}).get("models") if project_config is not None \
+            else self._project_routes(vault_path or vault_service.vault_path)
+        override = (overrides or {}).get(task) or {}
+        if isinstance(override, str):
+            override = {"model": override}
+        options = dict(route["options"])
+        options.update({k: override[k] for k in OPTION_KEYS if override.get(k) is not None})
+        return {
+            "model": override.get("model") or route["model"],
+            "fallbacks": list(override.get("fallbacks") or route["fallbacks"]),
+            "options": options,
+            "keep_alive": override.get("keep_alive") or route["keep_alive"],
+        }
+
+    async def route(self, task: str, project_config: Optional[Dict[str, Any]] = None, vault_path: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Keyword arguments (model, options, keep_alive) for ask_ollama / generate_json.
+        Pass the project's config when it is at hand, otherwise the session's project is used.
+        """
+        route = self.configured(task, project_config, vault_path)
+        model = self.pick(route["model"], route["fallbacks"], await self.available_models())
+        tracer.annotate(**{f"model_{task}": model})
+        return {"model": model, "options": route["options"], "keep_alive": route["keep_alive"]}
+
+    @staticmethod
+    def pick(model: str, fallbacks: List[str], available: Optional[Set[str]]) -> str:
+        candidates = [model, *fallbacks, MODEL]
+        if available is None:
+            return model
+        for candidate in candidates:
+            if _tagged(candidate) in available:
+                if candidate != model:
+                    logger.info(f"Model {model} is not pulled; using {candidate}")
+                return candidate
+        return model
+
+    async def describe(self, vault_path: Optional[str] = None) -> Dict[str, Any]:
+        available = await self.available_models()
+        routes = {}
+        for task in TASKS:
+            route = self.configured(task, vault_path=vault_path)
+            routes[task] = {**route, "resolved": self.pick(route["model"], route["fallbacks"], available)}
+        return {"routes": routes, "available": sorted(available) if available is not None else None}
+
+# Global instance
+model_router = ModelRouter()
@@ -0,0 +1,94 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Awaitable
+
+from general_functions import classify_emotion, EMOTION_MOODS
+from circuit_breaker import mood_breaker
+
+logger = logging.getLogger(__name__)
+
+# Follow the mood of the assistant's reply while it streams (in addition to the prompt's)
+MOOD_STREAM = os.getenv("MOOD_STREAM", "true").lower() in ("1", "true", "yes")
+
+# One thread for all classifications: bounds CPU use and keeps the model off the event loop
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mood")
+_backlog = 0
+
+
+class StreamingMoodAnalyzer:
+    """
+    Follows the assistant's reply as it streams and re-classifies the latest
+    `window_chars` of text, at most every `interval` seconds and only after
+    `min_new_chars` of new text. Classification runs on the mood thread; `feed`
+    never waits for it, so token delivery is unaffected. `on_mood` is awaited
+    with the new mood whenever it changes.
+    """
+
+    def __init__(self, on_mood: Callable[[str], Awaitable[None]], initial: Optional[str] = None) -> None:
+        self.window_chars = int(os.getenv("MOOD_STREAM_WINDOW_CHARS", 600))
+        self.interval = float(os.getenv("MOOD_STREAM_INTERVAL", 1.5))
+        self.min_new_chars = int(os.getenv("MOOD_STREAM_MIN_CHARS", 120))
+        self.max_backlog = int(os.getenv("MOOD_STREAM_MAX_BACKLOG", 4))
+        self.on_mood = on_mood
+        self.mood = initial
+        self._text = ""
+        self._classified_upto = 0
+        self._last_run = float("-inf")
+        self._task: Optional[asyncio.Task] = None
+
+    def feed(self, content: str) -> None:
+        self._text += content
+        # Only the window is ever classified; drop older text
+        if len(self._text) > self.window_chars * 2:
+            consumed = len(self._text) - self.window_chars
+            self._text = self._text[consumed:]
+            self._classified_upto = max(0, self._classified_upto - consumed)
+        if self._due(time.monotonic()):
+            self._start()
+
+    def _due(self, now: float) -> bool:
+        return (
+            (self._task is None or self._task.done())
+            and len(self._text) - self._classified_upto >= self.min_new_chars
+            and now - self._last_run >= self.interval
+            and _backlog < self.max_backlog  # Shed load when many streams are classifying
+            and mood_breaker.allow()
+        )
+
+    def _start(self) -> None:
+        self._last_run = time.monotonic()
+        self._classified_upto = len(self._text)
+        self._task = asyncio.create_task(self._classify(self._text[-self.window_chars:]))
+
+    async def _classify(self, window: str) -> None:
+        global _backlog
+        _backlog += 1
+        try:
+            label = await asyncio.get_running_loop().run_in_executor(_executor, classify_emotion, window)
+        except Exception as e:
+            logger.error(f"Streaming mood analysis failed: {e}")
+            return
+        finally:
+            _backlog -= 1
+        mood = EMOTION_MOODS.get(label, "neutral")
+        if mood != self.mood:
+            self.mood = mood
+            await self.on_mood(mood)
+
+    async def finish(self, timeout: float = 1.0) -> None:
+        """Classifies the unclassified tail of the reply, waiting at most `timeout` seconds."""
+        try:
+            if self._task is not None and not self._task.done():
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            if len(self._text) > self._classified_upto and self._text.strip():
+                self._start()
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,184 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Tuple, AsyncIterator
+
+from tracing import tracer
+from metrics import REGISTRY, OLLAMA_QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a lane already has as many waiting requests as it allows."""
+
+    def __init__(self, lane: str) -> None:
+        super().__init__(f"Ollama queue for '{lane}' is full, try again shortly.")
+        self.lane = lane
+
+
+class Lane:
+    def __init__(self, name: str, priority: int, concurrency: int, max_queue: int) -> None:
+        self.name = name
+        self.priority = priority          # Lower runs first
+        self.concurrency = concurrency
+        self.max_queue = max_queue        # 0 means unbounded
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "priority": self.priority,
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.admitted if self.admitted else 0.0,
+            "wait_max": self.wait_max,
+            "wait_last": self.wait_last,
+        }
+
+
+# name: (priority, default concurrency, default max queue)
+DEFAULT_LANES = {
+    "chat": (0, 2, 16),
+    "grammar": (1, 1, 8),
+    "summary": (2, 1, 8),
+    "embedding": (3, 2, 0),
+}
+
+
+class OllamaScheduler:
+    """
+    Admission control in front of the single local Ollama instance.
+    Every call takes a slot in its lane; a global limit caps total concurrency and,
+    when slots free up, waiting requests are admitted in lane priority order.
+    The last `reserved_interactive` global slots are kept for chat so bulk work
+    like indexing embeddings can never crowd out an interactive reply.
+    """
+
+    def __init__(self) -> None:
+        self.max_concurrency = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 3))
+        self.reserved_interactive = int(os.getenv("OLLAMA_RESERVED_INTERACTIVE", 1))
+        self.lanes: Dict[str, Lane] = {}
+        for name, (priority, concurrency, max_queue) in DEFAULT_LANES.items():
+            key = name.upper()
+            self.lanes[name] = Lane(
+                name,
+                priority,
+                int(os.getenv(f"OLLAMA_LANE_{key}_CONCURRENCY", concurrency)),
+                int(os.getenv(f"OLLAMA_LANE_{key}_MAX_QUEUE", max_queue)),
+            )
+        self.active = 0
+        self._waiters: List[Tuple[int, int, str, asyncio.Future]] = []
+        self._seq = itertools.count()
+        logger.info(f"OllamaScheduler initialized (max concurrency {self.max_concurrency})")
+
+    def _lane(self, name: str) -> Lane:
+        return self.lanes.get(name) or self.lanes["chat"]
+
+    def has_capacity(self, lane_name: str) -> bool:
+        """True if a new request on this lane would be queued rather than rejected."""
+        lane = self._lane(lane_name)
+        return not lane.max_queue or lane.queued < lane.max_queue
+
+    def _can_run(self, lane: Lane) -> bool:
+        if lane.active >= lane.concurrency:
+            return False
+        limit = self.max_concurrency
+        if lane.priority > 0:
+            limit -= self.reserved_interactive
+        return self.active < max(limit, 1)
+
+    def _dispatch(self) -> None:
+        """Wakes waiters in (priority, arrival) order while slots are available."""
+        skipped = []
+        while self._waiters:
+            item = heapq.heappop(self._waiters)
+            _, _, lane_name, future = item
+            if future.done():
+                continue
+            lane = self.lanes[lane_name]
+            if self._can_run(lane):
+                lane.active += 1
+                self.active += 1
+                future.set_result(True)
+            else:
+                skipped.append(item)
+                if self.active >= self.max_concurrency:
+                    break
+        for item in skipped:
+            heapq.heappush(self._waiters, item)
+
+    def _release(self, lane: Lane) -> None:
+        lane.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, lane_name: str = "chat") -> AsyncIterator[None]:
+        lane = self._lane(lane_name)
+        started = time.monotonic()
+
+        if not self._waiters and self._can_run(lane):
+            lane.active += 1
+            self.active += 1
+        else:
+            if not self.has_capacity(lane.name):
+                lane.rejected += 1
+                raise QueueFullError(lane.name)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (lane.priority, next(self._seq), lane.name, future))
+            lane.queued += 1
+            self._dispatch()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Slot was granted just as we were cancelled: hand it back
+                    self._release(lane)
+                raise
+            finally:
+                lane.queued -= 1
+
+        waited = time.monotonic() - started
+        lane.admitted += 1
+        lane.wait_total += waited
+        lane.wait_last = waited
+        lane.wait_max = max(lane.wait_max, waited)
+        OLLAMA_QUEUE_WAIT_SECONDS.observe(waited, lane=lane.name)
+        tracer.record("ollama.queue_wait", waited, lane=lane.name)
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "reserved_interactive": self.reserved_interactive,
+            "active": self.active,
+            "queued": sum(lane.queued for lane in self.lanes.values()),
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()},
+        }
+
+# Global instance
+ollama_scheduler = OllamaScheduler()
+
+REGISTRY.gauge(
+    "luna_ollama_queue_depth", "Requests waiting for an Ollama slot.", ("lane",),
+    callback=lambda: {(name,): lane.queued for name, lane in ollama_scheduler.lanes.items()})
+REGISTRY.gauge(
+    "luna_ollama_active_requests", "Requests currently holding an Ollama slot.", ("lane",),
+    callback=lambda: {(name,): lane.active for name, lane in ollama_scheduler.lanes.items()})
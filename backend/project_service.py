@@ -4,6 +4,8 @@ import shutil
 import logging
 from typing import List, Dict, Any, Optional, Union
 from general_functions import ask_ollama
+from model_router import model_router
+from storage import update_json, write_json_atomic
 
 logger = logging.getLogger(__name__)
 
@@ -36,12 +38,13 @@ class ProjectService:
                 return {}
         return {}
 
-    def _save_registry(self, registry: Dict[str, str]) -> None:
+    def _update_registry(self, mutate) -> Dict[str, str]:
+        """Locked read-modify-write, so concurrent workers never drop each other's entries."""
         try:
-            with open(self.registry_file, "w", encoding="utf-8") as f:
-                json.dump(registry, f, indent=4)
+            return update_json(self.registry_file, mutate, default={})
         except Exception as e:
             logger.error(f"Error saving registry: {e}")
+            return {}
 
     def list_projects(self) -> List[str]:
         registry = self._load_registry()
@@ -57,7 +60,10 @@ class ProjectService:
         
         # Clean up registry if any projects were moved/deleted
         if len(updated_registry) != len(registry):
-            self._save_registry(updated_registry)
+            stale = set(registry) - set(updated_registry)
+            self._update_registry(lambda current: {
+                name: path for name, path in current.items() if name not in stale
+            })
             
         return sorted(existing_projects)
 
@@ -81,6 +87,15 @@ class ProjectService:
                 return None
         return None
 
+    def config_for_vault(self, vault_path: str) -> Optional[Dict[str, Any]]:
+        """Config of the registered project stored at `vault_path`, if any."""
+        target = os.path.normcase(os.path.realpath(vault_path))
+        for name, path in self._load_registry().items():
+            if os.path.normcase(os.path.realpath(path)) == target:
+                project = self.load_project(name)
+                return project.get("config") if project else None
+        return None
+
     async def save_project(self, name: str, history: List[Dict[str, Any]], config: Optional[Dict[str, Any]] = None, trigger_init: bool = False, description: Optional[str] = None) -> Dict[str, Any]:
         """
         Saves project metadata locally to its vault path.
@@ -102,7 +117,8 @@ class ProjectService:
         if not description and history and isinstance(history, list):
             prompt = "Please summarize the entire conversation above, focusing on key creative decisions, plot points, and characters. format it as a project memory."
             try:
-                async for event_type, content in ask_ollama(prompt, history):
+                route = await model_router.route("summary", project_config=config)
+                async for event_type, content in ask_ollama(prompt, history, lane="summary", **route):
                     if event_type == "chunk":
                         summary += content
             except Exception as e:
@@ -113,7 +129,11 @@ class ProjectService:
             "summary": summary,
             "config": config or {}
         }
-        
+        self.store_project(name, vault_path, project_data)
+        return project_data
+
+    def store_project(self, name: str, vault_path: str, project_data: Dict[str, Any]) -> None:
+        """Writes the project file into its vault folder and registers the path."""
         # Ensure project directory exists
         if not os.path.exists(vault_path):
             os.makedirs(vault_path, exist_ok=True)
@@ -121,18 +141,13 @@ class ProjectService:
         # Save locally to project folder
         filepath = os.path.join(vault_path, f"{name}.json")
         try:
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(project_data, f, indent=4)
+            write_json_atomic(filepath, project_data)
         except Exception as e:
             logger.error(f"Error saving project file {filepath}: {e}")
             raise
             
         # Update Registry
-        registry = self._load_registry()
-        registry[name] = vault_path
-        self._save_registry(registry)
-        
-        return project_data
+        self._update_registry(lambda registry: {**registry, name: vault_path})
 
     def init_workspace(self, base_path: str, project_name: str) -> Optional[str]:
         try:
@@ -158,11 +173,15 @@ class ProjectService:
                     logger.error(f"Error deleting physical files for {name}: {e}")
 
         # Remove from registry
-        if name in registry:
-            del registry[name]
-            self._save_registry(registry)
-            return True
-        return False
+        removed = []
+
+        def remove(current: Dict[str, str]) -> Dict[str, str]:
+            if name in current:
+                removed.append(current.pop(name))
+            return current
+
+        self._update_registry(remove)
+        return bool(removed)
 
 # Global instance
 project_service = ProjectService()
@@ -0,0 +1,131 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional, Any
+
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from circuit_breaker import rerank_breaker
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Sentence ends (with closing quotes/brackets) followed by whitespace, or blank lines
+SENTENCE_RE = re.compile(r"(?<=[.!?…])[\"'”’)\]]*\s+|\n\s*\n")
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in SENTENCE_RE.split(text) if s and s.strip()]
+
+
+class RerankService:
+    """
+    Optional second retrieval stage (RAG_RERANK): a small cross-encoder scores
+    (query, passage) pairs for a larger candidate set than search returns, then the
+    best passages are cut down to the sentences that score close to their best one.
+
+    The model loads on first use and runs on CPU in its own thread, batch by batch.
+    Scores are cached per (query, text), so a repeated or refined search only scores
+    what it hasn't seen. Any failure opens the reranker's breaker and search falls
+    back to vector order.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = os.getenv("RAG_RERANK", "false").lower() in ("1", "true", "yes")
+        self.model_name = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+        self.candidates = int(os.getenv("RERANK_CANDIDATES", 20))
+        self.batch_size = int(os.getenv("RERANK_BATCH_SIZE", 16))
+        # Sentences scoring within this many logits of the passage's best one are kept
+        self.sentence_margin = float(os.getenv("RERANK_SENTENCE_MARGIN", 4.0))
+        self.cache_size = int(os.getenv("RERANK_CACHE_SIZE", 4096))
+        self._scores: "OrderedDict[bytes, float]" = OrderedDict()
+        self._model: Optional[Tuple[Any, Any]] = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+    def _load(self) -> Tuple[Any, Any]:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    logger.info(f"Loading reranker {self.model_name}")
+                    tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                    model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+                    model.eval()
+                    self._model = (tokenizer, model)
+        return self._model
+
+    def _score_sync(self, query: str, texts: List[str]) -> List[float]:
+        tokenizer, model = self._load()
+        scores: List[float] = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            inputs = tokenizer(
+                [query] * len(batch), batch, padding=True, truncation=True, max_length=512, return_tensors="pt"
+            )
+            with torch.inference_mode():
+                logits = model(**inputs).logits
+            # Single-logit relevance models, else the "relevant" class of a two-class head
+            scores += logits[:, -1].tolist()
+        return scores
+
+    @staticmethod
+    def _key(query: str, text: str) -> bytes:
+        return hashlib.blake2b(f"{query.strip().lower()}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+    async def score(self, query: str, texts: List[str]) -> List[float]:
+        """Relevance of each text to `query`; only pairs missing from the cache reach the model."""
+        keys = [self._key(query, text) for text in texts]
+        missing = {key: text for key, text in zip(keys, texts) if key not in self._scores}
+        if missing:
+            with rerank_breaker.guard(), tracer.span("rerank.score", pairs=len(missing)):
+                scores = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._score_sync, query, list(missing.values())
+                )
+            for key, score in zip(missing, scores):
+                self._scores[key] = score
+        result = []
+        for key in keys:
+            self._scores.move_to_end(key)
+            result.append(self._scores[key])
+        while len(self._scores) > self.cache_size:
+            self._scores.popitem(last=False)
+        return result
+
+    async def rerank(self, query: str, passages: List[str], top_n: int) -> List[Tuple[int, str]]:
+        """
+        The `top_n` most relevant passages as (index in `passages`, trimmed text), best
+        first. Gaps left by dropped sentences are marked with "...".
+        """
+        scores = await self.score(query, passages)
+        ranked = sorted(range(len(passages)), key=lambda i: scores[i], reverse=True)[:top_n]
+
+        sentences = {i: split_sentences(passages[i]) for i in ranked}
+        # All sentences of the kept passages are scored in one batched pass
+        flat = [s for i in ranked if len(sentences[i]) > 1 for s in sentences[i]]
+        sentence_scores = await self.score(query, flat) if flat else []
+        by_sentence = dict(zip(flat, sentence_scores))
+
+        trimmed = []
+        for i in ranked:
+            if len(sentences[i]) <= 1:
+                trimmed.append((i, passages[i].strip()))
+                continue
+            best = max(by_sentence[s] for s in sentences[i])
+            parts, last = [], None
+            for position, sentence in enumerate(sentences[i]):
+                if by_sentence[sentence] >= best - self.sentence_margin:
+                    if last is not None and position != last + 1:
+                        parts.append("...")
+                    parts.append(sentence)
+                    last = position
+            trimmed.append((i, " ".join(parts)))
+        return trimmed
+
+# Global instance
+rerank_service = RerankService()
@@ -0,0 +1,203 @@
+import os
+import re
+import math
+import time
+import array
+import sqlite3
+import hashlib
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional
+
+from storage import state_path
+from tracing import tracer
+from metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+# Tasks that return their input with corrections: a change in layout alone must miss,
+# or the cached reply would bring back the old paragraph breaks
+VERBATIM_TASKS = ("grammar", "#task:fix_grammar")
+
+
+class ResponseCache:
+    """
+    Persistent cache for deterministic editor tasks (grammar passes, #task: prompts).
+    Entries are keyed by (model, task, hash of the input) and stored in SQLite so they
+    survive restarts and can be shared between workers. The input is whitespace-
+    normalized first, except for VERBATIM_TASKS, which are keyed on the exact text.
+    Optionally, a miss can fall back to the most similar cached input by embedding;
+    callers opt into that per lookup since it only suits tasks where near enough is fine.
+    """
+
+    def __init__(self, db_path: Optional[str] = None) -> None:
+        self.enabled = os.getenv("RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+        self.max_bytes = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", 64)) * 1024 * 1024)
+        self.ttl = float(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+        self.semantic = os.getenv("RESPONSE_CACHE_SEMANTIC", "false").lower() in ("1", "true", "yes")
+        self.similarity = float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.97))
+        self.db_path = db_path or state_path("response_cache.sqlite3")
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._init_db()
+        logger.info(f"ResponseCache initialized at {self.db_path} (enabled={self.enabled})")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _init_db(self) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT, task TEXT, response TEXT,"
+                " embedding BLOB, size INTEGER, created REAL, last_used REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_task ON responses (model, task)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_used ON responses (last_used)")
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r"\s+", " ", text).strip()
+
+    def make_key(self, model: str, task: str, text: str) -> str:
+        keyed = text if task in VERBATIM_TASKS else self.normalize(text)
+        digest = hashlib.sha256(keyed.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model}\0{task}\0{digest}".encode("utf-8")).hexdigest()
+
+    # --- Blocking operations (run through asyncio.to_thread) ---
+
+    def get_exact(self, model: str, task: str, text: str) -> Optional[str]:
+        key = self.make_key(model, task, text)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            if now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def find_similar(self, model: str, task: str, embedding: List[float], limit: int = 500) -> Optional[str]:
+        """Best cached response whose input embedding clears the similarity threshold."""
+        now = time.time()
+        best_key, best_score = None, self.similarity
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT key, embedding FROM responses WHERE model = ? AND task = ? AND embedding IS NOT NULL"
+                " AND created > ? ORDER BY last_used DESC LIMIT ?",
+                (model, task, now - self.ttl, limit)
+            ).fetchall()
+            for key, blob in rows:
+                score = _cosine(embedding, array.array("f", blob))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, best_key))
+            return conn.execute("SELECT response FROM responses WHERE key = ?", (best_key,)).fetchone()[0]
+
+    def put(self, model: str, task: str, text: str, response: str, embedding: Optional[List[float]] = None) -> None:
+        key = self.make_key(model, task, text)
+        blob = array.array("f", embedding).tobytes() if embedding else None
+        size = len(response.encode("utf-8")) + (len(blob) if blob else 0)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, task, response, embedding, size, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, task, response, blob, size, now, now)
+            )
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Drops least recently used entries until the cache fits in `max_bytes`."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "enabled": self.enabled,
+            "semantic": self.semantic,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+        }
+
+    # --- Async API used by the routes ---
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        from knowledge_base_service import kb_service
+        return await kb_service.get_embedding(self.normalize(text)[:4000], lane="chat")
+
+    async def lookup(self, model: str, task: str, text: str, allow_similar: bool = False) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with tracer.span("cache.lookup", task=task) as span:
+            cached = await self._lookup(model, task, text, allow_similar)
+            if span is not None:
+                span.attributes["hit"] = cached is not None
+            return cached
+
+    async def _lookup(self, model: str, task: str, text: str, allow_similar: bool) -> Optional[str]:
+        try:
+            cached = await asyncio.to_thread(self.get_exact, model, task, text)
+            if cached is None and allow_similar and self.semantic:
+                embedding = await self._embed(text)
+                if embedding:
+                    cached = await asyncio.to_thread(self.find_similar, model, task, embedding)
+                    if cached is not None:
+                        self.similar_hits += 1
+                        CACHE_LOOKUPS.inc(task=task, result="similar")
+                        return cached
+        except Exception as e:
+            logger.error(f"Response cache lookup failed: {e}")
+            return None
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        CACHE_LOOKUPS.inc(task=task, result="miss" if cached is None else "hit")
+        return cached
+
+    async def store(self, model: str, task: str, text: str, response: str, allow_similar: bool = False) -> None:
+        if not self.enabled or not response.strip():
+            return
+        try:
+            embedding = await self._embed(text) if allow_similar and self.semantic else None
+            await asyncio.to_thread(self.put, model, task, text, response, embedding)
+        except Exception as e:
+            logger.error(f"Response cache store failed: {e}")
+
+
+def _cosine(a, b) -> float:
+    if len(a) != len(b):
+        return 0.0
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+# Global instance
+response_cache = ResponseCache()
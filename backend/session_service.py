@@ -0,0 +1,81 @@
+import os
+import re
+import time
+import uuid
+import sqlite3
+import logging
+import contextvars
+from typing import Dict, Any, Optional
+
+from storage import state_path
+
+logger = logging.getLogger(__name__)
+
+SESSION_HEADER = "X-Luna-Session"
+SESSION_COOKIE = "luna_session"
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+# Vault chosen by the session of the request being handled. Services read it through
+# `session_vault()` and fall back to the configured default when it is unset.
+_session_vault: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("luna_session_vault", default=None)
+
+
+def session_vault() -> Optional[str]:
+    return _session_vault.get()
+
+
+class SessionService:
+    """
+    Active project per client session, stored in SQLite so that every uvicorn
+    worker resolves the same vault for a session regardless of which one serves it.
+    """
+
+    def __init__(self, db_path: Optional[str] = None) -> None:
+        self.ttl = float(os.getenv("SESSION_TTL", 30 * 24 * 3600))
+        self.db_path = db_path or state_path("sessions.sqlite3")
+        self._init_db()
+        logger.info(f"SessionService initialized at {self.db_path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _init_db(self) -> None:
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY, vault_path TEXT, project TEXT, updated REAL)"
+            )
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def is_valid_id(session_id: Optional[str]) -> bool:
+        return bool(session_id and SESSION_ID_RE.match(session_id))
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT vault_path, project, updated FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if not row or time.time() - row[2] > self.ttl:
+            return None
+        return {"vault_path": row[0], "project": row[1]}
+
+    def set(self, session_id: str, vault_path: str, project: Optional[str] = None) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, vault_path, project, updated) VALUES (?, ?, ?, ?)",
+                (session_id, vault_path, project, now)
+            )
+            conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+
+    def activate(self, vault_path: Optional[str]) -> None:
+        """Binds a vault to the current request context (and tasks it spawns)."""
+        _session_vault.set(vault_path)
+
+# Global instance
+session_service = SessionService()
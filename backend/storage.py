@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from typing import Any, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Root directory of the repository (one level above backend/)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Where background jobs, caches and indexes keep their files between restarts
+STATE_DIR = os.getenv("LUNA_STATE_DIR", os.path.join(BASE_DIR, ".luna_state"))
+
+
+def state_path(*parts: str) -> str:
+    """Returns a path inside the state directory, creating its parent folders."""
+    path = os.path.join(STATE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def vault_key(vault_path: str) -> str:
+    """Stable short identifier for a vault, used to namespace its indexes and state files."""
+    normalized = os.path.normcase(os.path.realpath(vault_path))
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+def read_json(path: str, default: Any = None) -> Any:
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error reading {path}: {e}")
+        return default
+
+
+def write_json_atomic(path: str, data: Any) -> None:
+    """
+    Writes JSON through a temp file and os.replace so readers never see a partial file.
+    The temp file is unique, so concurrent writers (threads or processes) never share one.
+    """
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates it private
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class FileLock:
+    """
+    Exclusive inter-process lock on a lock file (flock on POSIX, msvcrt on Windows).
+    Lets several uvicorn workers share files without racing each other.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(0.05)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def update_json(path: str, mutate: Callable[[Any], Any], default: Any = None) -> Any:
+    """
+    Locked read-modify-write of a JSON file. `mutate` receives the current data and
+    returns the new data (or None to keep the mutated object). Returns what was written.
+    """
+    with FileLock(f"{path}.lock"):
+        data = read_json(path, default)
+        result = mutate(data)
+        if result is not None:
+            data = result
+        write_json_atomic(path, data)
+    return data
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import uuid
+import logging
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# The trace and span of the code currently running. asyncio tasks copy the context
+# when created, so work spawned by a request (tool calls, prefetch, mood) joins its trace.
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("luna_trace", default=None)
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("luna_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], start: float, attributes: Dict[str, Any]) -> None:
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = start
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Trace:
+    """Span tree of one request. Times are perf_counter values; `wall_start_ns` anchors them for export."""
+
+    def __init__(self, name: str, request_id: str, max_spans: int, attributes: Dict[str, Any]) -> None:
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.max_spans = max_spans
+        self.wall_start_ns = time.time_ns()
+        self.root = Span(name, None, time.perf_counter(), attributes)
+        self.spans: List[Span] = [self.root]
+        self.dropped = 0
+
+    def add_span(self, name: str, parent: Optional[Span], start: float, attributes: Dict[str, Any]) -> Optional[Span]:
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return None
+        span = Span(name, (parent or self.root).span_id, start, attributes)
+        self.spans.append(span)
+        return span
+
+    def finish(self) -> None:
+        if self.root.end is None:
+            self.root.end = time.perf_counter()
+
+    def summary(self, include_spans: bool = True) -> Dict[str, Any]:
+        """
+        Stage durations in milliseconds. `stages` sums spans by name, so stages that
+        ran concurrently (e.g. mood analysis and the first generation) can add up to more than `total_ms`.
+        """
+        stages: Dict[str, float] = {}
+        for span in self.spans[1:]:
+            stages[span.name] = stages.get(span.name, 0.0) + span.duration * 1000
+        result = {
+            "request_id": self.request_id,
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "total_ms": round(self.root.duration * 1000, 1),
+            "stages": {name: round(ms, 1) for name, ms in stages.items()},
+        }
+        if include_spans:
+            result["spans"] = [{
+                "id": span.span_id,
+                "parent": span.parent_id,
+                "name": span.name,
+                "start_ms": round((span.start - self.root.start) * 1000, 1),
+                "duration_ms": round(span.duration * 1000, 1),
+                "attributes": span.attributes,
+                **({"error": span.error} if span.error else {}),
+            } for span in self.spans]
+            if self.dropped:
+                result["dropped_spans"] = self.dropped
+        return result
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP/JSON representation, readable by the OpenTelemetry collector's file receiver and HTTP endpoint."""
+        def to_ns(value: float) -> str:
+            return str(self.wall_start_ns + int((value - self.root.start) * 1e9))
+
+        spans = []
+        for span in self.spans:
+            attributes = [{"key": "luna.request_id", "value": {"stringValue": self.request_id}}]
+            attributes += [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()]
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 2 if span is self.root else 1,
+                "startTimeUnixNano": to_ns(span.start),
+                "endTimeUnixNano": to_ns(span.end if span.end is not None else span.start + span.duration),
+                "attributes": attributes,
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "luna-backend"}}]},
+            "scopeSpans": [{"scope": {"name": "luna"}, "spans": spans}],
+        }]}
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    """
+    Lightweight per-request tracing. Spans are plain objects appended to the active
+    trace; nothing is recorded outside a trace, and exporting happens on a background thread.
+    Finished traces are kept in a small in-memory history for GET /traces.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = os.getenv("TRACING", "true").lower() in ("1", "true", "yes")
+        self.max_spans = int(os.getenv("TRACE_MAX_SPANS", 500))
+        self.history_size = int(os.getenv("TRACE_HISTORY", 100))
+        self.export_file = os.getenv("TRACE_EXPORT_FILE", "")
+        self.otlp_endpoint = os.getenv("TRACE_OTLP_ENDPOINT", "")  # e.g. http://localhost:4318/v1/traces
+        self.history: "OrderedDict[str, Trace]" = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if self.export_file or self.otlp_endpoint:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace_export")
+
+    @staticmethod
+    def new_request_id() -> str:
+        return uuid.uuid4().hex[:16]
+
+    def start_trace(self, name: str, request_id: Optional[str] = None, **attributes: Any) -> Optional[Trace]:
+        """Starts a trace and makes it current for this task and any tasks it creates afterwards."""
+        if not self.enabled:
+            return None
+        trace = Trace(name, request_id or self.new_request_id(), self.max_spans, attributes)
+        _current_trace.set(trace)
+        _current_span.set(trace.root)
+        return trace
+
+    def finish_trace(self, trace: Optional[Trace]) -> None:
+        if trace is None or trace.root.end is not None:
+            return
+        trace.finish()
+        self.history[trace.request_id] = trace
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+        if self._executor is not None:
+            self._executor.submit(self._export, trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        trace = _current_trace.get()
+        if trace is None:
+            yield None
+            return
+        parent = _current_span.get()
+        span = trace.add_span(name, parent, time.perf_counter(), attributes)
+        if span is None:
+            yield None
+            return
+        _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            # Restore by value rather than token: generators may be closed from another context
+            _current_span.set(parent)
+
+    def record(self, name: str, duration: float, **attributes: Any) -> None:
+        """Adds an already finished span (e.g. a queue wait measured elsewhere) ending now."""
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        now = time.perf_counter()
+        span = trace.add_span(name, _current_span.get(), now - duration, attributes)
+        if span is not None:
+            span.end = now
+
+    def annotate(self, **attributes: Any) -> None:
+        """Sets attributes on the innermost open span."""
+        span = _current_span.get()
+        if span is not None:
+            span.attributes.update(attributes)
+
+    def current_request_id(self) -> Optional[str]:
+        trace = _current_trace.get()
+        return trace.request_id if trace else None
+
+    def get(self, request_id: str) -> Optional[Trace]:
+        return self.history.get(request_id)
+
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        traces = list(self.history.values())[-limit:]
+        return [trace.summary(include_spans=False) for trace in reversed(traces)]
+
+    def _export(self, trace: Trace) -> None:
+        payload = trace.to_otlp()
+        try:
+            if self.export_file:
+                with open(self.export_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(payload) + "\n")
+            if self.otlp_endpoint:
+                httpx.post(self.otlp_endpoint, json=payload, timeout=5)
+        except Exception as e:
+            logger.warning(f"Trace export failed: {e}")
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+# Global instance
+tracer = Tracer()
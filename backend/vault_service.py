@@ -1,18 +1,44 @@
 import os
 import json
 import logging
-from typing import List, Dict, Any, Optional, Union, Tuple
+from typing import List, Dict, Any, Optional, Union, Tuple, Callable
+from metrics import FILE_SCAN_SECONDS
+from session_service import session_vault
+from storage import update_json
 
 logger = logging.getLogger(__name__)
 
 class VaultService:
     def __init__(self) -> None:
         self.config_file = "config.json"
-        self.vault_path = self._load_initial_vault_path()
+        self._config_mtime: Optional[float] = None
+        self.default_vault_path = self._load_initial_vault_path()
+        self._change_listeners: List[Callable[[str, str], None]] = []
         logger.info(f"VaultService initialized. Current vault: {self.vault_path}")
 
+    @property
+    def vault_path(self) -> Optional[str]:
+        """The vault picked by the requesting session, otherwise the configured default."""
+        return session_vault() or self.default_vault_path
+
+    @vault_path.setter
+    def vault_path(self, value: Optional[str]) -> None:
+        self.default_vault_path = value
+
+    def _config_stamp(self) -> Optional[float]:
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def refresh_default(self) -> None:
+        """Picks up a default vault changed by another worker process."""
+        if self._config_stamp() != self._config_mtime:
+            self.default_vault_path = self._load_initial_vault_path()
+
     def _load_initial_vault_path(self) -> Optional[str]:
         """Retrieves the VAULT_PATH from config.json, fallbacks to env."""
+        self._config_mtime = self._config_stamp()
         if os.path.exists(self.config_file):
             try:
                 with open(self.config_file, 'r') as f:
@@ -25,27 +51,29 @@ class VaultService:
         return os.getenv("VAULT_PATH")
 
     def set_vault_path(self, path: str) -> bool:
-        """Updates and saves the vault path."""
-        config = {}
-        if os.path.exists(self.config_file):
-            try:
-                with open(self.config_file, 'r') as f:
-                    config = json.load(f)
-            except:
-                pass
-                
-        config["vault_path"] = path
-        self.vault_path = path
+        """Updates and saves the default vault path (used by sessions that haven't picked one)."""
+        self.default_vault_path = path
         
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config, f, indent=4)
+            update_json(self.config_file, lambda config: {**(config or {}), "vault_path": path}, default={})
+            self._config_mtime = self._config_stamp()
             logger.info(f"Vault path updated to: {path}")
             return True
         except Exception as e:
             logger.error(f"Failed to save vault path: {e}")
             return False
 
+    def add_change_listener(self, listener: Callable[[str, str], None]) -> None:
+        """Registers a callback invoked as listener(vault_path, rel_path) after a file is written."""
+        self._change_listeners.append(listener)
+
+    def _notify_change(self, rel_path: str) -> None:
+        for listener in self._change_listeners:
+            try:
+                listener(self.vault_path, rel_path)
+            except Exception as e:
+                logger.error(f"Change listener failed for {rel_path}: {e}")
+
     def is_safe_path(self, path: str, follow_symlinks: bool = True) -> bool:
         """Prevents path traversal attacks."""
         if not self.vault_path:
@@ -83,7 +111,8 @@ class VaultService:
             return d
 
         # Return children of the root
-        tree = get_tree(self.vault_path)
+        with FILE_SCAN_SECONDS.time(operation="list_files"):
+            tree = get_tree(self.vault_path)
         return tree['children']
 
     def read_file(self, rel_path: str) -> Optional[str]:
@@ -115,6 +144,7 @@ class VaultService:
             os.makedirs(os.path.dirname(full_path), exist_ok=True)
             with open(full_path, "w", encoding="utf-8") as f:
                 f.write(content)
+            self._notify_change(rel_path)
             return True
         except Exception as e:
             logger.error(f"Error saving file {full_path}: {e}")
@@ -139,6 +169,7 @@ class VaultService:
             os.makedirs(os.path.dirname(full_path), exist_ok=True)
             with open(full_path, "w", encoding="utf-8") as f:
                 f.write("") 
+            self._notify_change(rel_path)
             return True, rel_path
         except Exception as e:
             logger.error(f"Error creating file {full_path}: {e}")
@@ -0,0 +1,198 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional, Tuple, List, Callable
+
+from vault_service import vault_service
+from knowledge_base_service import kb_service
+from storage import FileLock, state_path
+
+logger = logging.getLogger(__name__)
+
+
+class VaultWatcher:
+    """
+    Keeps the knowledge base fresh by re-embedding only the notes that changed.
+    Changes come from two sources: VaultService writes (immediate) and a cheap
+    mtime poll of the active vault (edits made in Obsidian or any other editor).
+    Events are debounced per file so a burst of saves costs a single re-index.
+    A file whose re-index fails (Ollama or Chroma down) stays queued and is retried
+    with exponential backoff; the poll snapshot only moves forward once it succeeds.
+    """
+
+    TICK = 0.5
+    RETRY_BACKOFF = 5.0
+    MAX_RETRY_BACKOFF = 300.0
+
+    def __init__(self) -> None:
+        self.enabled = os.getenv("VAULT_WATCH", "false").lower() in ("1", "true", "yes")
+        self.debounce = float(os.getenv("VAULT_WATCH_DEBOUNCE", 2))
+        self.poll_interval = float(os.getenv("VAULT_WATCH_POLL_INTERVAL", 5))
+
+        # (vault_path, rel_path) -> monotonic time of the latest change (pushed back after a failure)
+        self._pending: Dict[Tuple[str, str], float] = {}
+        # (vault_path, rel_path) -> consecutive failed re-indexes
+        self._failures: Dict[Tuple[str, str], int] = {}
+        self._snapshot: Dict[str, float] = {}
+        self._snapshot_vault: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        # With several workers only the lock holder polls, so an edit is re-indexed once
+        self._poll_lock = FileLock(state_path("locks", "vault_watcher.lock"))
+        self._listeners: List[Callable[[str, str], None]] = []
+
+        self.reindexed = 0
+        self.last_error: Optional[str] = None
+
+        vault_service.add_change_listener(self.notify)
+        logger.info(f"VaultWatcher initialized (enabled={self.enabled})")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "running": self._task is not None and not self._task.done(),
+            "pending": len(self._pending),
+            "retrying": len(self._failures),
+            "reindexed": self.reindexed,
+            "debounce": self.debounce,
+            "poll_interval": self.poll_interval,
+            "polling": self._poll_lock.locked,
+            "last_error": self.last_error,
+        }
+
+    @property
+    def watching(self) -> bool:
+        """Whether this worker polls, i.e. its listeners also hear of edits made outside the app."""
+        return self.enabled and self._poll_lock.locked and self._task is not None and not self._task.done()
+
+    def add_listener(self, listener: Callable[[str, str], None]) -> None:
+        """
+        Registers a callback invoked as listener(vault_path, rel_path) for every note
+        change seen: saves through the API always, other edits only while watching.
+        """
+        self._listeners.append(listener)
+
+    def _changed(self, vault_path: str, rel_path: str) -> None:
+        for listener in self._listeners:
+            try:
+                listener(vault_path, rel_path)
+            except Exception as e:
+                logger.error(f"Vault change listener failed for {rel_path}: {e}")
+
+    def notify(self, vault_path: Optional[str], rel_path: str) -> None:
+        """Marks a note as changed. Cheap and safe to call from any write path."""
+        if not vault_path or not rel_path.lower().endswith(('.md', '.txt')):
+            return
+        self._changed(vault_path, rel_path)
+        if not self.enabled:
+            return
+        key = (vault_path, os.path.normpath(rel_path))
+        self._pending[key] = time.monotonic()
+
+    def start(self) -> None:
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._poll_lock.release()
+
+    async def set_enabled(self, enabled: bool) -> None:
+        self.enabled = enabled
+        if enabled:
+            # Start from the current state of the vault instead of re-indexing everything
+            self._snapshot_vault = None
+            self.start()
+        else:
+            self._pending.clear()
+            self._failures.clear()
+            await self.stop()
+
+    async def _run(self) -> None:
+        last_poll = 0.0
+        while True:
+            try:
+                now = time.monotonic()
+                if now - last_poll >= self.poll_interval:
+                    await self._poll()
+                    last_poll = now
+                await self._flush(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Vault watcher error: {e}")
+            await asyncio.sleep(self.TICK)
+
+    def _scan(self, vault_path: str) -> Dict[str, float]:
+        snapshot = {}
+        for rel_path in kb_service.list_vault_files(vault_path):
+            try:
+                snapshot[rel_path] = os.path.getmtime(os.path.join(vault_path, rel_path))
+            except OSError:
+                continue
+        return snapshot
+
+    async def _poll(self) -> None:
+        if not self._poll_lock.locked and not self._poll_lock.acquire(blocking=False):
+            return
+        vault_path = vault_service.vault_path
+        if not vault_path or not os.path.isdir(vault_path):
+            return
+
+        snapshot = await asyncio.to_thread(self._scan, vault_path)
+        if vault_path != self._snapshot_vault:
+            # New or switched vault: take a baseline, its index is already on disk
+            self._snapshot = snapshot
+            self._snapshot_vault = vault_path
+            return
+
+        # The snapshot itself only moves forward in _flush, once a file is re-indexed
+        now = time.monotonic()
+        for rel_path, mtime in snapshot.items():
+            if self._snapshot.get(rel_path) != mtime and (vault_path, rel_path) not in self._pending:
+                self._pending[(vault_path, rel_path)] = now
+                self._changed(vault_path, rel_path)
+        for rel_path in self._snapshot.keys() - snapshot.keys():
+            if (vault_path, rel_path) not in self._pending:
+                self._pending[(vault_path, rel_path)] = now
+                self._changed(vault_path, rel_path)
+
+    async def _flush(self, now: float) -> None:
+        due = [key for key, changed_at in self._pending.items() if now - changed_at >= self.debounce]
+        for key in due:
+            # A newer event may have arrived while an earlier file was indexing
+            if now - self._pending.get(key, now) < self.debounce:
+                continue
+            self._pending.pop(key, None)
+            vault_path, rel_path = key
+            full_path = os.path.join(vault_path, rel_path)
+            try:
+                if os.path.exists(full_path):
+                    chunks = await kb_service.index_file(vault_path, rel_path)
+                    logger.info(f"Re-indexed {rel_path} ({chunks} chunks)")
+                    if vault_path == self._snapshot_vault:
+                        self._snapshot[rel_path] = os.path.getmtime(full_path)
+                else:
+                    await kb_service.remove_file(vault_path, rel_path)
+                    logger.info(f"Removed {rel_path} from the index")
+                    if vault_path == self._snapshot_vault:
+                        self._snapshot.pop(rel_path, None)
+                self.reindexed += 1
+                self._failures.pop(key, None)
+            except Exception as e:
+                failures = self._failures[key] = self._failures.get(key, 0) + 1
+                delay = min(self.MAX_RETRY_BACKOFF, self.RETRY_BACKOFF * 2 ** (failures - 1))
+                # Due again `delay` seconds from now, unless a newer change already requeued it
+                self._pending.setdefault(key, now + delay - self.debounce)
+                self.last_error = f"{rel_path}: {e}"
+                logger.error(f"Failed to re-index {rel_path} (retrying in {delay:.0f}s): {e}")
+
+# Global instance
+vault_watcher = VaultWatcher()
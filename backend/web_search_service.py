@@ -1,39 +1,256 @@
+import os
+import socket
 import logging
 import asyncio
-from typing import List, Dict, Any
+import threading
+import ipaddress
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import List, Dict, Any, Optional
+import httpx
 from ddgs import DDGS
+from tracing import tracer
+from metrics import WEB_SEARCH_SECONDS
 
 logger = logging.getLogger(__name__)
 
-class WebSearchService:
+MAX_REDIRECTS = 5
+
+
+class SearchProvider(ABC):
+    """Interface for blocking search backends run inside the web search executor."""
+
+    name = "base"
+
+    @abstractmethod
+    def search(self, query: str, max_results: int) -> List[Dict[str, str]]:
+        ...
+
+
+class DDGSProvider(SearchProvider):
+    """DuckDuckGo provider. Keeps one DDGS session per executor thread so engines and connections are reused."""
+
+    name = "ddgs"
+
+    def __init__(self, timeout: int = 5) -> None:
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self) -> DDGS:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = DDGS(timeout=self.timeout)
+            self._local.session = session
+        return session
+
+    def search(self, query: str, max_results: int) -> List[Dict[str, str]]:
+        results = []
+        for result in self._session().text(query, max_results=max_results):
+            results.append({
+                "title": result.get("title", ""),
+                "snippet": result.get("body", ""),
+                "url": result.get("href", "")
+            })
+        return results
+
+
+class StubSearchProvider(SearchProvider):
+    """Offline provider returning canned results. Used by tests and benchmarks."""
+
+    name = "stub"
+
+    def __init__(self, results: Optional[List[Dict[str, str]]] = None, delay: float = 0.0) -> None:
+        self.results = results or []
+        self.delay = delay
+        self.calls: List[str] = []
+
+    def search(self, query: str, max_results: int) -> List[Dict[str, str]]:
+        self.calls.append(query)
+        if self.delay:
+            threading.Event().wait(self.delay)
+        if self.results:
+            return [dict(r) for r in self.results[:max_results]]
+        return [{
+            "title": f"Result for {query}",
+            "snippet": f"Stub snippet about {query}.",
+            "url": f"https://example.invalid/{idx}"
+        } for idx in range(max_results)]
+
+
+class _TextExtractor(HTMLParser):
+    """Collects visible text from an HTML document, skipping scripts and styles."""
+
+    SKIP_TAGS = {"script", "style", "noscript", "svg", "head"}
+
     def __init__(self) -> None:
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skip_depth and data.strip():
+            self.parts.append(data.strip())
+
+    def text(self) -> str:
+        return " ".join(self.parts)
+
+
+def is_public_address(address: str) -> bool:
+    """False for loopback, private, link-local, reserved and multicast addresses."""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def html_to_text(html: str) -> str:
+    parser = _TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        logger.debug(f"HTML parse error: {e}")
+    return parser.text()
+
+
+class WebSearchService:
+    def __init__(self, provider: Optional[SearchProvider] = None) -> None:
         self.max_results = 3
-        logger.info("WebSearchService initialized")
+        self.timeout = float(os.getenv("WEB_SEARCH_TIMEOUT", 8))
+        self.max_concurrency = int(os.getenv("WEB_SEARCH_MAX_CONCURRENCY", 2))
+        self.fetch_timeout = float(os.getenv("WEB_FETCH_TIMEOUT", 6))
+        self.fetch_max_bytes = int(os.getenv("WEB_FETCH_MAX_BYTES", 200_000))
+        self.fetch_max_chars = int(os.getenv("WEB_FETCH_MAX_CHARS", 4000))
+
+        self.provider = provider or DDGSProvider(timeout=int(self.timeout))
+        # Dedicated pool so slow searches never occupy the default to_thread workers
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="web_search")
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._http: Optional[httpx.AsyncClient] = None
+        logger.info(f"WebSearchService initialized with provider '{self.provider.name}'")
+
+    def set_provider(self, provider: SearchProvider) -> None:
+        self.provider = provider
+
+    def _get_http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            # Redirects are followed by hand so every hop's address is checked
+            self._http = httpx.AsyncClient(
+                timeout=self.fetch_timeout,
+                follow_redirects=False,
+                headers={"User-Agent": "Mozilla/5.0 (compatible; LunaBot/1.0)"}
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            try:
+                await self._http.aclose()
+            except Exception as e:
+                logger.error(f"Error closing web fetch client: {e}")
+            self._http = None
 
     async def web_search(self, query: str, max_results: int = 3) -> List[Dict[str, str]]:
         """
-        Search the web using DuckDuckGo for factual information.
+        Search the web using the configured provider (DuckDuckGo by default).
         Returns a list of search results with title, snippet, and URL.
+        Calls are bounded by a dedicated executor and a per-call deadline.
+
+        A provider call can't be interrupted, so one that outlives its deadline keeps its
+        slot until its thread actually returns; waiting for a slot counts toward the
+        deadline too, so stuck providers make later searches fail fast rather than queue.
         """
-        return await asyncio.to_thread(self._web_search_sync, query, max_results)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        with WEB_SEARCH_SECONDS.time(operation="search"), tracer.span("web.search"):
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Web search for '{query}' found no free slot within {self.timeout}s")
+                return []
+            future = loop.run_in_executor(self._executor, self._web_search_sync, query, max_results)
+            future.add_done_callback(lambda _: self._semaphore.release())
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                logger.warning(f"Web search for '{query}' timed out after {self.timeout}s")
+                return []
 
     def _web_search_sync(self, query: str, max_results: int = 3) -> List[Dict[str, str]]:
         try:
-            with DDGS() as ddgs:
-                results = []
-                for result in ddgs.text(query, max_results=max_results):
-                    results.append({
-                        "title": result.get("title", ""),
-                        "snippet": result.get("body", ""),
-                        "url": result.get("href", "")
-                    })
-                
-                logger.info(f"Web search for '{query}' returned {len(results)} results")
-                return results
-                
+            results = self.provider.search(query, max_results)
+            logger.info(f"Web search for '{query}' returned {len(results)} results")
+            return results
         except Exception as e:
             logger.error(f"Web search error: {e}")
             return []
 
+    async def fetch_page(self, url: str, max_chars: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Downloads a result page on demand and returns its visible text.
+        The body is streamed and cut off after `fetch_max_bytes`; text is truncated to `max_chars`.
+        Only public http(s) addresses are fetched, redirects included, since the URL
+        comes from a model tool call.
+        """
+        max_chars = max_chars or self.fetch_max_chars
+        if not url.startswith(("http://", "https://")):
+            return {"url": url, "error": "Unsupported URL scheme"}
+
+        async with self._semaphore:
+            try:
+                with WEB_SEARCH_SECONDS.time(operation="fetch"), tracer.span("web.fetch"):
+                    body = await asyncio.wait_for(self._stream_body(url), timeout=self.fetch_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Fetching {url} timed out after {self.fetch_timeout}s")
+                return {"url": url, "error": "Timed out"}
+            except Exception as e:
+                logger.error(f"Fetch error for {url}: {e}")
+                return {"url": url, "error": str(e)}
+
+        if "<" in body:
+            text = await asyncio.get_running_loop().run_in_executor(self._executor, html_to_text, body)
+        else:
+            text = body
+        truncated = len(text) > max_chars
+        return {"url": url, "text": text[:max_chars], "truncated": truncated}
+
+    @staticmethod
+    async def _ensure_public(url: httpx.URL) -> None:
+        if url.scheme not in ("http", "https") or not url.host:
+            raise ValueError("Unsupported URL")
+        port = url.port or (443 if url.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+        for info in infos:
+            if not is_public_address(info[4][0]):
+                raise ValueError(f"Refusing to fetch {url.host}: not a public address")
+
+    async def _stream_body(self, url: str) -> str:
+        client = self._get_http()
+        target = httpx.URL(url)
+        for _ in range(MAX_REDIRECTS + 1):
+            await self._ensure_public(target)
+            received = bytearray()
+            async with client.stream("GET", target) as response:
+                if response.is_redirect:
+                    target = target.join(response.headers["location"])
+                    continue
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    received.extend(chunk)
+                    if len(received) >= self.fetch_max_bytes:
+                        break
+            encoding = response.encoding or "utf-8"
+            return bytes(received[:self.fetch_max_bytes]).decode(encoding, errors="replace")
+        raise ValueError(f"More than {MAX_REDIRECTS} redirects")
+
 # Global instance
 web_search_service = WebSearchService()
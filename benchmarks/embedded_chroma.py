@@ -0,0 +1,40 @@
+"""
+In-process Chroma exposing the async client interface the knowledge base uses.
+
+`kb_service` talks to a Chroma server through `chromadb.AsyncHttpClient`; the
+benchmarks swap in this wrapper around an ephemeral (in-memory) Chroma so the
+real collection logic runs without a server. Blocking calls go through a thread,
+as they would be off the event loop with the HTTP client.
+"""
+import asyncio
+from typing import Any
+
+import chromadb
+from chromadb.config import Settings
+
+
+class _AsyncProxy:
+    def __init__(self, target: Any) -> None:
+        self._target = target
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            result = await asyncio.to_thread(attr, *args, **kwargs)
+            # Collections come back wrapped so their methods are awaitable too
+            if hasattr(result, "query") and hasattr(result, "add"):
+                return _AsyncProxy(result)
+            return result
+
+        return call
+
+
+class EmbeddedChroma(_AsyncProxy):
+    def __init__(self) -> None:
+        super().__init__(chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False, allow_reset=True)))
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._target.reset)
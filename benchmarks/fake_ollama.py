@@ -0,0 +1,173 @@
+"""
+Local stand-in for the Ollama HTTP API used by the benchmarks and tests.
+
+Serves /api/chat (streamed NDJSON or a single JSON reply), /api/generate and
+/api/embeddings with a configurable first-token latency, token rate and
+embedding dimension, so backend timings can be measured without a GPU or model.
+"""
+import json
+import math
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any, Optional
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """Hashed bag-of-words vector: texts sharing words land close together, so search results are meaningful."""
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOllamaServer:
+    """
+    Threaded fake Ollama. `latency` is the delay before the first token,
+    `token_rate` the tokens per second streamed afterwards and `tokens` the reply length.
+    Every request body is recorded in `requests` as (path, payload).
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        token_rate: float = 200.0,
+        tokens: int = 50,
+        embedding_dim: int = 256,
+        embedding_latency: float = 0.0,
+        reply: Optional[str] = None,
+        json_reply: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.embedding_dim = embedding_dim
+        self.embedding_latency = embedding_latency
+        self.reply = reply
+        self.json_reply = json_reply if json_reply is not None else {}
+        self.requests: List[tuple] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake_ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeOllamaServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def reply_tokens(self) -> List[str]:
+        if self.reply is not None:
+            words = self.reply.split(" ")
+            return [w + " " for w in words[:-1]] + words[-1:]
+        return [f"token{i} " for i in range(self.tokens)]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/api/tags":
+                    self._send_json({"models": []})
+                else:
+                    body = b"Ollama is running"
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with server._lock:
+                    server.requests.append((self.path, payload))
+
+                if self.path.startswith("/api/embed"):
+                    if server.embedding_latency:
+                        time.sleep(server.embedding_latency)
+                    text = payload.get("prompt") or payload.get("input") or ""
+                    self._send_json({"embedding": fake_embedding(text, server.embedding_dim)})
+                elif self.path.startswith(("/api/chat", "/api/generate")):
+                    self._generate(payload, chat=self.path.startswith("/api/chat"))
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def _send_json(self, data: Dict[str, Any], status: int = 200) -> None:
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _write_chunk(self, data: Dict[str, Any]) -> None:
+                line = json.dumps(data).encode("utf-8") + b"\n"
+                self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+                self.wfile.flush()
+
+            def _message(self, content: str, chat: bool) -> Dict[str, Any]:
+                if chat:
+                    return {"message": {"role": "assistant", "content": content}}
+                return {"response": content}
+
+            def _generate(self, payload: Dict[str, Any], chat: bool) -> None:
+                time.sleep(server.latency)
+                tokens = server.reply_tokens()
+                stats = {
+                    "done": True,
+                    "prompt_eval_count": sum(len(str(m.get("content", "")).split()) for m in payload.get("messages", [])),
+                    "eval_count": len(tokens),
+                    "eval_duration": int(len(tokens) / server.token_rate * 1e9) if server.token_rate else 0,
+                }
+
+                if payload.get("format") == "json" or not payload.get("stream", True):
+                    if server.token_rate:
+                        time.sleep(len(tokens) / server.token_rate)
+                    content = json.dumps(server.json_reply) if payload.get("format") == "json" else "".join(tokens)
+                    self._send_json({**self._message(content, chat), **stats})
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                interval = 1.0 / server.token_rate if server.token_rate else 0
+                try:
+                    for token in tokens:
+                        self._write_chunk({**self._message(token, chat), "done": False})
+                        if interval:
+                            time.sleep(interval)
+                    self._write_chunk({**self._message("", chat), **stats})
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
@@ -0,0 +1,405 @@
+"""
+Backend benchmark suite.
+
+Runs against a local fake Ollama (see fake_ollama.py) and an in-process Chroma,
+so numbers reflect the backend itself rather than the model or GPU. Results are
+printed (and optionally written) as JSON to compare across versions.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --only sync,search --files 500
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+from typing import List, Dict, Any
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "backend"))
+
+from fake_ollama import FakeOllamaServer
+
+SCENARIOS = ("chat", "sync", "list_files", "search", "stream")
+
+LORE_WORDS = ["Aldermoor", "Veyra", "Kestrel", "Obsidian", "Thornwall", "Ilsabet", "Marrow", "Duskfen",
+              "Corvane", "Sunspire", "Halvard", "Emberline", "Wyrmgate", "Solenne", "Grimhollow"]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Summary in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+        "p50_ms": round(pick(0.5) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def make_words(rng: random.Random, count: int) -> str:
+    vocabulary = LORE_WORDS + [f"word{i}" for i in range(2000)]
+    return " ".join(rng.choice(vocabulary) for _ in range(count))
+
+
+def generate_vault(root: str, files: int, words: int, seed: int = 7) -> None:
+    """Flat-ish vault split between World/ and Novel/, like a real project."""
+    rng = random.Random(seed)
+    for idx in range(files):
+        folder = os.path.join(root, "Novel" if idx % 3 == 0 else "World", f"part{idx % 10}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"note{idx}.md"), "w", encoding="utf-8") as f:
+            f.write(f"# Note {idx}\n\n{make_words(rng, words)}\n")
+
+
+def generate_deep_tree(root: str, depth: int, fanout: int, files_per_dir: int) -> int:
+    created = 0
+
+    def build(path: str, level: int) -> None:
+        nonlocal created
+        os.makedirs(path, exist_ok=True)
+        for idx in range(files_per_dir):
+            with open(os.path.join(path, f"note{idx}.md"), "w", encoding="utf-8") as f:
+                f.write("x")
+            created += 1
+        if level < depth:
+            for idx in range(fanout):
+                build(os.path.join(path, f"dir{idx}"), level + 1)
+
+    build(root, 1)
+    return created
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+# --- Scenarios ---
+
+async def bench_sync(args, kb_service, workdir: str) -> Dict[str, Any]:
+    vault = os.path.join(workdir, "vault")
+    generate_vault(vault, args.files, args.words)
+    kb_service.set_active_vault(vault)
+
+    started = time.perf_counter()
+    errors = 0
+    async for event in kb_service.sync_vault(vault):
+        errors += event.get("status") == "error"
+    elapsed = time.perf_counter() - started
+
+    chunks = 0
+    for collection in await kb_service.get_collections(vault):
+        chunks += await collection.count()
+    return {
+        "files": args.files,
+        "words_per_file": args.words,
+        "chunks": chunks,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "files_per_second": round(args.files / elapsed, 2),
+        "chunks_per_second": round(chunks / elapsed, 2),
+    }
+
+
+async def bench_search(args, kb_service, workdir: str) -> Dict[str, Any]:
+    vault = os.path.join(workdir, "vault")
+    if not os.path.isdir(vault):
+        await bench_sync(args, kb_service, workdir)
+
+    rng = random.Random(11)
+    latencies = []
+    for _ in range(args.queries):
+        query = make_words(rng, 6)
+        started = time.perf_counter()
+        await kb_service.search(query)
+        latencies.append(time.perf_counter() - started)
+    return {"queries": args.queries, "latency": percentiles(latencies)}
+
+
+def bench_list_files(args, workdir: str) -> Dict[str, Any]:
+    from vault_service import VaultService
+
+    root = os.path.join(workdir, "deep")
+    files = generate_deep_tree(root, args.depth, args.fanout, args.files_per_dir)
+    service = VaultService()
+    service.vault_path = root  # set directly: set_vault_path would rewrite config.json
+
+    latencies = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        service.list_files()
+        latencies.append(time.perf_counter() - started)
+    return {"files": files, "depth": args.depth, "fanout": args.fanout, "latency": percentiles(latencies)}
+
+
+async def _chat_client(client, url: str, prompt: str) -> Dict[str, Any]:
+    started = time.perf_counter()
+    first_token = None
+    async with client.stream("POST", url, json={"prompt": prompt, "history": []}) as response:
+        if response.status_code != 200:
+            return {"status": response.status_code}
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get("type") == "chunk" and first_token is None:
+                first_token = time.perf_counter() - started
+    return {"status": 200, "ttft": first_token, "total": time.perf_counter() - started}
+
+
+def _stream_app(tokens: int, token_rate: float):
+    """
+    Minimal ASGI app streaming like /chat: a producer feeds token events into a queue
+    and the response drains it, encoding per the `mode` query parameter.
+    """
+    from starlette.applications import Starlette
+    from starlette.responses import StreamingResponse
+    from starlette.routing import Route
+    from ndjson import dumps_line, ChunkCoalescer
+
+    async def stream(request):
+        mode = request.query_params.get("mode", "json")
+
+        async def body():
+            queue: asyncio.Queue = asyncio.Queue()
+
+            async def produce():
+                interval = 1.0 / token_rate if token_rate else 0
+                for t in range(tokens):
+                    await queue.put({"type": "chunk", "content": f"tok{t} "})
+                    await asyncio.sleep(interval)
+                await queue.put({"type": "done"})
+
+            producer = asyncio.create_task(produce())
+            coalescer = ChunkCoalescer() if mode == "coalesced" else None
+            while True:
+                due_in = coalescer.timeout() if coalescer else None
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=1 if due_in is None else due_in)
+                except asyncio.TimeoutError:
+                    for line in coalescer.flush():
+                        yield line
+                    continue
+                if coalescer:
+                    lines = coalescer.push(event)
+                elif mode == "json":
+                    lines = [json.dumps(event) + "\n"]
+                else:
+                    lines = [dumps_line(event)]
+                for line in lines:
+                    yield line
+                if event["type"] == "done":
+                    await producer
+                    return
+
+        return StreamingResponse(body(), media_type="application/x-ndjson")
+
+    return Starlette(routes=[Route("/stream", stream, methods=["POST"])])
+
+
+async def _stream_clients(url: str, mode: str, streams: int, tokens: int) -> Dict[str, Any]:
+    import httpx
+
+    totals = {"lines": 0, "bytes": 0}
+
+    async def one_stream(client) -> None:
+        received = 0
+        async with client.stream("POST", f"{url}?mode={mode}") as response:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                totals["lines"] += 1
+                totals["bytes"] += len(line) + 1
+                event = json.loads(line)  # What the frontend does per line
+                if event["type"] == "chunk":
+                    received += event["content"].count("tok")
+        assert received == tokens, f"{mode}: got {received} of {tokens} tokens"
+
+    limits = httpx.Limits(max_connections=streams, max_keepalive_connections=streams)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        cpu_started, wall_started = time.process_time(), time.perf_counter()
+        await asyncio.gather(*[one_stream(client) for _ in range(streams)])
+        cpu = time.process_time() - cpu_started
+        wall = time.perf_counter() - wall_started
+    return {
+        "lines": totals["lines"],
+        "bytes": totals["bytes"],
+        "cpu_seconds": round(cpu, 3),
+        "wall_seconds": round(wall, 3),
+        "tokens_per_cpu_second": round(streams * tokens / cpu, 1) if cpu else None,
+    }
+
+
+def bench_stream(args) -> Dict[str, Any]:
+    """
+    Per-token json.dumps vs orjson vs orjson with coalescing, over HTTP with many
+    concurrent streams. CPU time covers both server and client (same process).
+    """
+    import uvicorn
+
+    port = free_port()
+    app = _stream_app(args.stream_tokens, args.stream_token_rate)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    results = {"streams": args.streams, "tokens_per_stream": args.stream_tokens, "token_rate": args.stream_token_rate}
+    try:
+        for mode in ("json", "orjson", "coalesced"):
+            results[mode] = asyncio.run(_stream_clients(
+                f"http://127.0.0.1:{port}/stream", mode, args.streams, args.stream_tokens
+            ))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+    return results
+
+
+def bench_chat(args, fake: FakeOllamaServer) -> Dict[str, Any]:
+    import httpx
+    import uvicorn
+    from app import app
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    async def run() -> Dict[str, Any]:
+        url = f"http://127.0.0.1:{port}/chat"
+        results = []
+        async with httpx.AsyncClient(timeout=None) as client:
+            for round_idx in range(args.rounds):
+                results += await asyncio.gather(*[
+                    _chat_client(client, url, f"Tell me about Veyra, round {round_idx} client {idx}")
+                    for idx in range(args.clients)
+                ])
+        ok = [r for r in results if r["status"] == 200 and r["ttft"] is not None]
+        return {
+            "clients": args.clients,
+            "rounds": args.rounds,
+            "fake_latency_ms": fake.latency * 1000,
+            "fake_token_rate": fake.token_rate,
+            "completed": len(ok),
+            "rejected": sum(1 for r in results if r["status"] == 429),
+            "ttft": percentiles([r["ttft"] for r in ok]),
+            "total": percentiles([r["total"] for r in ok]),
+        }
+
+    try:
+        return asyncio.run(run())
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default=",".join(SCENARIOS), help="Comma-separated scenarios: " + ", ".join(SCENARIOS))
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    # Fake Ollama
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=200, help="Tokens per second")
+    parser.add_argument("--tokens", type=int, default=50, help="Tokens per reply")
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    # Scenario sizes
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent /chat clients")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--files", type=int, default=200, help="Notes in the generated vault")
+    parser.add_argument("--words", type=int, default=800, help="Words per note")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files-per-dir", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--streams", type=int, default=200, help="Concurrent NDJSON streams")
+    parser.add_argument("--stream-tokens", type=int, default=500)
+    parser.add_argument("--stream-token-rate", type=float, default=500, help="Tokens per second per stream")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.only.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="luna_bench_")
+    fake = FakeOllamaServer(
+        latency=args.latency, token_rate=args.token_rate, tokens=args.tokens,
+        embedding_dim=args.embedding_dim, embedding_latency=args.embedding_latency
+    ).start()
+
+    # Backend modules read these at import time
+    os.environ["OLLAMA_URL"] = f"{fake.url}/api/generate"
+    os.environ["LUNA_STATE_DIR"] = os.path.join(workdir, "state")
+    os.environ.setdefault("VAULT_WATCH", "false")
+    os.environ.setdefault("RESPONSE_CACHE", "false")
+
+    from embedded_chroma import EmbeddedChroma
+    from knowledge_base_service import kb_service
+    kb_service._client = EmbeddedChroma()
+
+    results: Dict[str, Any] = {}
+    try:
+        if "list_files" in scenarios:
+            results["list_files"] = bench_list_files(args, workdir)
+        if "sync" in scenarios:
+            results["sync"] = asyncio.run(bench_sync(args, kb_service, workdir))
+        if "search" in scenarios:
+            results["search"] = asyncio.run(bench_search(args, kb_service, workdir))
+        if "stream" in scenarios:
+            results["stream"] = bench_stream(args)
+        if "chat" in scenarios:
+            results["chat"] = bench_chat(args, fake)
+    finally:
+        fake.stop()
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": vars(args),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ import ProjectManager from './components/ProjectManager';
 import VaultExplorer from './components/VaultExplorer';
 import DraftingBoard from './components/DraftingBoard';
 import { useAppContext } from './AppContext';
-import { ChatMessage, SyncData } from './types';
+import { SyncData } from './types';
 import { syncVault as apiSyncVault } from './api';
 import './index.css';
 
@@ -17,8 +17,6 @@ const App: React.FC = () => {
     projectContext, setProjectContext
   } = useAppContext();
 
-  const [currentHistory, setCurrentHistory] = useState<ChatMessage[]>([]);
-
   // Sync State
   const [syncing, setSyncing] = useState(false);
   const [syncProgress, setSyncProgress] = useState<SyncData>({ status: 'done', current: 0, total: 100, file: '' });
@@ -79,7 +77,6 @@ const App: React.FC = () => {
         <MoodDisplay />
 
         <ProjectManager
-          history={currentHistory}
           onProjectLoaded={handleProjectLoaded}
         />
 
@@ -113,7 +110,6 @@ const App: React.FC = () => {
         {/* Right: Chat */}
         <div className="chat-section">
           <ChatInterface
-            onHistoryChange={setCurrentHistory}
             externalPrompt={externalPrompt}
             onConfigClear={() => setExternalPrompt(null)}
           />
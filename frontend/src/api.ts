@@ -1,15 +1,48 @@
-import { HealthResponse, ChatMessage, SyncData, ProjectMeta, ProjectConfig } from './types';
+import { HealthResponse, ChatMessage, SyncData, ProjectMeta, ProjectConfig, ReviewHunk } from './types';
 
 declare const __BACKEND_PORT__: number;
 const PORT = typeof __BACKEND_PORT__ !== 'undefined' ? __BACKEND_PORT__ : 5000;
 const API_URL = `http://localhost:${PORT}`;
 
+/**
+ * Per-tab session id. The backend keys the active project on it, so two tabs
+ * (or users) can work on different projects against the same server.
+ */
+const SESSION_HEADER = 'X-Luna-Session';
+const getSessionId = (): string => {
+    let id = sessionStorage.getItem('lunaSession');
+    if (!id) {
+        id = crypto.randomUUID().replace(/-/g, '');
+        sessionStorage.setItem('lunaSession', id);
+    }
+    return id;
+};
+
+/**
+ * Per-tab conversation id. The backend keeps the history in its conversation log,
+ * so each chat turn only carries the new message.
+ */
+export const getConversationId = (): string => {
+    let id = sessionStorage.getItem('lunaConversation');
+    if (!id) {
+        id = crypto.randomUUID().replace(/-/g, '');
+        sessionStorage.setItem('lunaConversation', id);
+    }
+    return id;
+};
+
+const apiFetch = (url: string, init: RequestInit = {}): Promise<Response> => {
+    const headers = new Headers(init.headers);
+    headers.set(SESSION_HEADER, getSessionId());
+    return fetch(url, { ...init, headers });
+};
+
 /**
  * Checks the health of the backend and Ollama.
  */
 export const checkHealth = async (): Promise<HealthResponse> => {
     try {
-        const response = await fetch(`${API_URL}/health`);
+        const response = await apiFetch(`${API_URL}/health`);
         return await response.json();
     } catch (error) {
         console.error("Health check failed:", error);
@@ -23,7 +56,6 @@ export const checkHealth = async (): Promise<HealthResponse> => {
  */
 export const sendChat = (
     prompt: string,
-    history: ChatMessage[],
     onChunk: (chunk: string) => void,
     onMood: (mood: string) => void,
     onDone: () => void,
@@ -32,10 +64,10 @@ export const sendChat = (
 ): AbortController => {
     const controller = new AbortController();
 
-    fetch(`${API_URL}/chat`, {
+    apiFetch(`${API_URL}/chat`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ prompt, history }),
+        body: JSON.stringify({ prompt, conversation_id: getConversationId() }),
         signal: controller.signal
     }).then(async (response) => {
         if (!response.ok) {
@@ -92,51 +124,62 @@ export const sendChat = (
 
 export const stopGeneration = async (): Promise<void> => {
     try {
-        await fetch(`${API_URL}/stop`, { method: 'POST' });
+        await apiFetch(`${API_URL}/stop`, { method: 'POST' });
     } catch (e) {
         console.error("Failed to stop", e);
     }
 };
 
+/**
+ * Adds a message to the conversation log without generating a reply.
+ */
+export const appendConversationMessage = async (message: ChatMessage): Promise<void> => {
+    await apiFetch(`${API_URL}/conversations/${getConversationId()}/messages`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(message)
+    });
+};
+
 export const getProjects = async (): Promise<string[]> => {
-    const res = await fetch(`${API_URL}/projects`);
+    const res = await apiFetch(`${API_URL}/projects`);
     return await res.json();
 };
 
-export const createProject = async (name: string, history: ChatMessage[], config: ProjectConfig = {}): Promise<any> => {
-    const res = await fetch(`${API_URL}/projects`, {
+export const createProject = async (name: string, config: ProjectConfig = {}): Promise<any> => {
+    const res = await apiFetch(`${API_URL}/projects`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ name, history, config })
+        body: JSON.stringify({ name, config, conversation_id: getConversationId() })
     });
     return await res.json();
 };
 
 export const deleteProject = async (name: string, deleteFiles = false): Promise<any> => {
-    const res = await fetch(`${API_URL}/projects/${name}${deleteFiles ? '?delete_files=true' : ''}`, {
+    const res = await apiFetch(`${API_URL}/projects/${name}${deleteFiles ? '?delete_files=true' : ''}`, {
         method: 'DELETE'
     });
     return await res.json();
 };
 
-export const updateProject = async (name: string, config: ProjectConfig, history: ChatMessage[] = []): Promise<any> => {
-    const res = await fetch(`${API_URL}/projects/${name}`, {
+export const updateProject = async (name: string, config: ProjectConfig): Promise<any> => {
+    const res = await apiFetch(`${API_URL}/projects/${name}`, {
         method: 'PATCH',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ config, history })
+        body: JSON.stringify({ config, conversation_id: getConversationId() })
     });
     return await res.json();
 };
 
 export const loadProject = async (name: string): Promise<ProjectMeta> => {
-    const res = await fetch(`${API_URL}/projects/${name}/load`, {
+    const res = await apiFetch(`${API_URL}/projects/${name}/load`, {
         method: 'POST'
     });
     return await res.json();
 };
 
 export const getVaultFiles = async (): Promise<any[]> => {
-    const res = await fetch(`${API_URL}/vault/files`);
+    const res = await apiFetch(`${API_URL}/vault/files`);
     if (!res.ok) {
         throw new Error("Failed to fetch vault files");
     }
@@ -145,7 +188,7 @@ export const getVaultFiles = async (): Promise<any[]> => {
 
 export const readVaultFile = async (path: string): Promise<{ content?: string; error?: string }> => {
     try {
-        const response = await fetch(`${API_URL}/vault/read`, {
+        const response = await apiFetch(`${API_URL}/vault/read`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ path })
@@ -163,7 +206,7 @@ export const readVaultFile = async (path: string): Promise<{ content?: string; e
 
 export const saveVaultFile = async (path: string, content: string): Promise<any> => {
     try {
-        const response = await fetch(`${API_URL}/vault/save`, {
+        const response = await apiFetch(`${API_URL}/vault/save`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ path, content })
@@ -181,7 +224,7 @@ export const saveVaultFile = async (path: string, content: string): Promise<any>
 
 export const syncVault = async (onProgress?: (data: SyncData) => void): Promise<any> => {
     try {
-        const response = await fetch(`${API_URL}/vault/sync`, {
+        const response = await apiFetch(`${API_URL}/vault/sync`, {
             method: 'POST',
         });
 
@@ -220,12 +263,12 @@ export const syncVault = async (onProgress?: (data: SyncData) => void): Promise<
 };
 
 export const getConfig = async (): Promise<any> => {
-    const res = await fetch(`${API_URL}/config`);
+    const res = await apiFetch(`${API_URL}/config`);
     return await res.json();
 };
 
 export const saveConfig = async (vault_path: string): Promise<any> => {
-    const res = await fetch(`${API_URL}/config`, {
+    const res = await apiFetch(`${API_URL}/config`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ vault_path })
@@ -234,7 +277,7 @@ export const saveConfig = async (vault_path: string): Promise<any> => {
 };
 
 export const createVaultFile = async (path: string): Promise<any> => {
-    const res = await fetch(`${API_URL}/vault/create`, {
+    const res = await apiFetch(`${API_URL}/vault/create`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ path })
@@ -243,10 +286,105 @@ export const createVaultFile = async (path: string): Promise<any> => {
 };
 
 export const fixGrammar = async (content: string): Promise<{ fixed?: string; original?: string; error?: string }> => {
-    const res = await fetch(`${API_URL}/vault/fix-grammar`, {
+    const res = await apiFetch(`${API_URL}/vault/fix-grammar`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ content })
     });
     return await res.json();
 };
+
+type ReviewResult = { id?: string; failed?: [number, number][]; error?: string };
+
+/** Reads a review stream; `failed` holds the spans of the draft that couldn't be corrected. */
+const readReviewStream = async (
+    response: Response,
+    onHunks: (sessionId: string, hunks: ReviewHunk[]) => void
+): Promise<ReviewResult> => {
+    if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+    if (!response.body) throw new Error("Review response body is null");
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let sessionId = '';
+    let failed: [number, number][] = [];
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop() || '';
+
+        for (const line of lines) {
+            if (!line.trim()) continue;
+            const data = JSON.parse(line);
+            if (data.type === 'session') {
+                sessionId = data.id;
+            } else if (data.type === 'hunks') {
+                onHunks(sessionId, data.hunks);
+            } else if (data.type === 'error') {
+                console.error("Review segment error:", data.content);
+            } else if (data.type === 'done') {
+                failed = data.failed || [];
+            }
+        }
+    }
+    return { id: sessionId, failed };
+};
+
+/**
+ * Starts a server-side grammar review. Hunks (offsets into `content` plus replacement text)
+ * arrive as each part of the draft is corrected, so no client-side diff is needed.
+ */
+export const startGrammarReview = async (
+    content: string,
+    path: string | null,
+    onHunks: (sessionId: string, hunks: ReviewHunk[]) => void
+): Promise<ReviewResult> => {
+    try {
+        const response = await apiFetch(`${API_URL}/vault/review`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ content, path })
+        });
+        return await readReviewStream(response, onHunks);
+    } catch (error: any) {
+        console.error("Grammar Review Error:", error);
+        return { error: error.message };
+    }
+};
+
+/** Re-runs only the parts of a review that failed (server busy or unavailable). */
+export const retryGrammarReview = async (
+    sessionId: string,
+    onHunks: (sessionId: string, hunks: ReviewHunk[]) => void
+): Promise<ReviewResult> => {
+    try {
+        const response = await apiFetch(`${API_URL}/vault/review/${sessionId}/retry`, { method: 'POST' });
+        return await readReviewStream(response, onHunks);
+    } catch (error: any) {
+        console.error("Grammar Review Error:", error);
+        return { error: error.message };
+    }
+};
+
+export const applyGrammarReview = async (sessionId: string, accept: number[] | 'all', path: string | null): Promise<any> => {
+    await apiFetch(`${API_URL}/vault/review/${sessionId}/resolve`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(accept === 'all' ? { accept_all: true } : { accept })
+    });
+    const res = await apiFetch(`${API_URL}/vault/review/${sessionId}/apply`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ path })
+    });
+    return await res.json();
+};
+
+export const discardGrammarReview = async (sessionId: string): Promise<void> => {
+    await apiFetch(`${API_URL}/vault/review/${sessionId}`, { method: 'DELETE' });
+};
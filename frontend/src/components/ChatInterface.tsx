@@ -1,18 +1,16 @@
 import React, { useState, useEffect, useRef } from 'react';
-import { sendChat, stopGeneration } from '../api';
+import { sendChat, stopGeneration, appendConversationMessage } from '../api';
 import ReactMarkdown from 'react-markdown';
 import remarkGfm from 'remark-gfm';
 import { useAppContext } from '../AppContext';
 import { ChatMessage, Mood } from '../types';
 
 interface ChatInterfaceProps {
-    onHistoryChange?: (history: ChatMessage[]) => void;
     externalPrompt?: string | null;
     onConfigClear?: () => void;
 }
 
 const ChatInterface: React.FC<ChatInterfaceProps> = ({
-    onHistoryChange,
     externalPrompt,
     onConfigClear
 }) => {
@@ -24,13 +22,6 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
     const bottomRef = useRef<HTMLDivElement>(null);
     const abortControllerRef = useRef<AbortController | null>(null);
 
-    // Update parent with history whenever it changes
-    useEffect(() => {
-        if (onHistoryChange) {
-            onHistoryChange(history);
-        }
-    }, [history, onHistoryChange]);
-
     // Handle External Prompts (from Drafting Board)
     useEffect(() => {
         if (externalPrompt) {
@@ -44,6 +35,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
         if (projectContext) {
             const contextMsg: ChatMessage = { role: 'system', content: `[PROJECT SUMMARY LOADED]: ${projectContext}` };
             setHistory(prev => [...prev, contextMsg]);
+            appendConversationMessage(contextMsg);
         }
     }, [projectContext]);
 
@@ -71,7 +63,6 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
 
         const controller = sendChat(
             userMsg.content,
-            newHistory,
             (chunk) => {
                 currentResponse += chunk;
                 setHistory(prev => {
@@ -1,8 +1,8 @@
 import React, { useState, useEffect } from 'react';
 import ReactMarkdown from 'react-markdown';
 import remarkGfm from 'remark-gfm';
-import * as Diff from 'diff';
-import { saveVaultFile, fixGrammar } from '../api';
+import { saveVaultFile, startGrammarReview, retryGrammarReview, applyGrammarReview, discardGrammarReview } from '../api';
+import { ReviewHunk } from '../types';
 
 interface DraftingBoardProps {
     onRequestAnalysis: (prompt: string) => void;
@@ -27,9 +27,9 @@ const DraftingBoard: React.FC<DraftingBoardProps> = ({
 
     // Review Mode State
     const [isReviewing, setIsReviewing] = useState(false);
-    const [, setOriginalDraft] = useState('');
-    const [diffResult, setDiffResult] = useState<Diff.Change[]>([]);
-    const [correctedText, setCorrectedText] = useState('');
+    const [originalDraft, setOriginalDraft] = useState('');
+    const [reviewId, setReviewId] = useState('');
+    const [hunks, setHunks] = useState<ReviewHunk[]>([]);
     const [loadingReview, setLoadingReview] = useState(false);
 
     // Load content when file changes
@@ -44,20 +44,30 @@ const DraftingBoard: React.FC<DraftingBoardProps> = ({
 
         if (type === 'grammar') {
             setLoadingReview(true);
-            try {
-                const res = await fixGrammar(draft);
-                if (res.fixed) {
-                    setOriginalDraft(draft);
-                    setCorrectedText(res.fixed);
-                    const diff = Diff.diffWords(draft, res.fixed);
-                    setDiffResult(diff);
-                    setIsReviewing(true);
-                }
-            } catch (err) {
+            setOriginalDraft(draft);
+            setHunks([]);
+            setIsReviewing(true);
+            // Hunks stream in as the server corrects each part of the draft
+            const onHunks = (sessionId: string, newHunks: ReviewHunk[]) => {
+                setReviewId(sessionId);
+                setHunks(prev => [...prev, ...newHunks].sort((a, b) => a.start - b.start));
+            };
+            let res = await startGrammarReview(draft, filePath, onHunks);
+            // Parts the server couldn't get to (busy or unavailable) can be re-run on their own
+            while (res.id && res.failed?.length &&
+                   window.confirm(`${res.failed.length} part(s) of the draft could not be reviewed. Retry them?`)) {
+                const id: string = res.id;
+                const retried = await retryGrammarReview(id, onHunks);
+                if (retried.error) break;  // Keep the hunks already shown
+                res = { ...retried, id };
+            }
+            if (res.error) {
                 alert("Failed to get grammar suggestions.");
-            } finally {
-                setLoadingReview(false);
+                setIsReviewing(false);
+            } else if (res.id) {
+                setReviewId(res.id);
             }
+            setLoadingReview(false);
         } else {
             // Fact check still uses chat
             let prefix = "";
@@ -66,15 +76,52 @@ const DraftingBoard: React.FC<DraftingBoardProps> = ({
         }
     };
 
-    const handleAccept = () => {
-        setDraft(correctedText);
+    const applyHunksLocally = (): string => {
+        let result = '';
+        let position = 0;
+        for (const hunk of hunks) {
+            result += originalDraft.slice(position, hunk.start) + hunk.text;
+            position = hunk.end;
+        }
+        return result + originalDraft.slice(position);
+    };
+
+    const handleAccept = async () => {
+        const updated = applyHunksLocally();
+        if (reviewId) {
+            const res = await applyGrammarReview(reviewId, 'all', filePath);
+            if (res.status === 'saved' && onSaveStatus) {
+                onSaveStatus('Saved');
+                setTimeout(() => onSaveStatus(''), 2000);
+            }
+        }
+        setDraft(updated);
         setIsReviewing(false);
     };
 
     const handleDiscard = () => {
+        if (reviewId) discardGrammarReview(reviewId);
         setIsReviewing(false);
     };
 
+    // Builds the review view from the hunks only: O(changes), not O(document)
+    const renderReview = () => {
+        const parts: React.ReactNode[] = [];
+        let position = 0;
+        hunks.forEach((hunk) => {
+            parts.push(<span key={`k${hunk.id}`}>{originalDraft.slice(position, hunk.start)}</span>);
+            if (hunk.end > hunk.start) {
+                parts.push(<span key={`r${hunk.id}`} className="diff-removed">{originalDraft.slice(hunk.start, hunk.end)}</span>);
+            }
+            if (hunk.text) {
+                parts.push(<span key={`a${hunk.id}`} className="diff-added">{hunk.text}</span>);
+            }
+            position = hunk.end;
+        });
+        parts.push(<span key="tail">{originalDraft.slice(position)}</span>);
+        return parts;
+    };
+
     const handleSave = async () => {
         if (!filePath) return;
         setIsSaving(true);
@@ -116,7 +163,7 @@ const DraftingBoard: React.FC<DraftingBoardProps> = ({
                 <div className="toolbar-right">
                     {isReviewing ? (
                         <>
-                            <button className="btn btn-sm btn-success" onClick={handleAccept}>✔️ Apply All</button>
+                            <button className="btn btn-sm btn-success" onClick={handleAccept} disabled={loadingReview}>✔️ Apply All</button>
                             <button className="btn btn-sm btn-secondary" onClick={handleDiscard}>✖️ Discard</button>
                         </>
                     ) : (
@@ -143,17 +190,7 @@ const DraftingBoard: React.FC<DraftingBoardProps> = ({
             <div className="editor-container">
                 {isReviewing ? (
                     <div className="review-diff-view">
-                        {diffResult.map((part, index) => {
-                            let className = '';
-                            if (part.added) className = 'diff-added';
-                            else if (part.removed) className = 'diff-removed';
-
-                            return (
-                                <span key={index} className={className}>
-                                    {part.value}
-                                </span>
-                            );
-                        })}
+                        {renderReview()}
                     </div>
                 ) : (
                     <>
@@ -1,10 +1,9 @@
 import React, { useState, useEffect } from 'react';
 import { getProjects, createProject, deleteProject, loadProject, updateProject, getConfig } from '../api';
 import { useAppContext } from '../AppContext';
-import { ChatMessage, ProjectConfig } from '../types';
+import { ProjectConfig } from '../types';
 
 interface ProjectManagerProps {
-    history: ChatMessage[];
     onProjectLoaded: (name: string, summary: string, vaultPath?: string) => void;
 }
 
@@ -14,7 +13,7 @@ interface EditingProject {
     description: string;
 }
 
-const ProjectManager: React.FC<ProjectManagerProps> = ({ history, onProjectLoaded }) => {
+const ProjectManager: React.FC<ProjectManagerProps> = ({ onProjectLoaded }) => {
     const { activeProject, setActiveProject } = useAppContext();
     const [projects, setProjects] = useState<string[]>([]);
     const [newProjectName, setNewProjectName] = useState('');
@@ -49,7 +48,7 @@ const ProjectManager: React.FC<ProjectManagerProps> = ({ history, onProjectLoade
         if (!newProjectName.trim()) return;
         setLoading(true);
         const config: ProjectConfig = { vault_path: vaultPath };
-        const res = await createProject(newProjectName, history, config);
+        const res = await createProject(newProjectName, config);
         setLoading(false);
         if (res.status === 'created') {
             setNewProjectName('');
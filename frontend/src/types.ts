@@ -21,6 +21,14 @@ export interface SyncData {
     total?: number;
 }
 
+export interface ReviewHunk {
+    id: number;
+    start: number;
+    end: number;
+    text: string;
+    status?: 'pending' | 'accepted' | 'rejected';
+}
+
 export interface HealthResponse {
     status: 'online' | 'offline';
     ollama: string;
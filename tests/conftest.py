@@ -6,35 +6,66 @@ from unittest.mock import MagicMock, patch
 # Add backend to path
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
 
 from project_service import ProjectService
 
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path):
+    """
+    Points the state directory, and the SQLite stores that resolved their path at import,
+    at the test's tmp dir so tests neither read nor leave behind the repository's .luna_state.
+    """
+    from response_cache import response_cache
+    from session_service import session_service
+
+    state_dir = tmp_path / "luna_state"
+    with patch("storage.STATE_DIR", str(state_dir)):
+        with patch.object(response_cache, "db_path", str(state_dir / "response_cache.sqlite3")), \
+             patch.object(session_service, "db_path", str(state_dir / "sessions.sqlite3")):
+            state_dir.mkdir(exist_ok=True)
+            response_cache._init_db()
+            session_service._init_db()
+            yield state_dir
+
 @pytest.fixture
 def temp_workspace(tmp_path):
     """Creates a temporary workspace and project root for testing."""
     workspace = tmp_path / "luna_test_ws"
     workspace.mkdir()
     
-    # Mock base_dir and registry_file in ProjectService
+    # Mock base_dir and registry_file in ProjectService. It is a singleton, so the
+    # shared instance's own attributes are patched too (they shadow the class ones)
+    instance = ProjectService()
     with patch.object(ProjectService, "__init__", lambda self: None):
         with patch("project_service.ProjectService.base_dir", str(workspace), create=True):
              with patch("project_service.ProjectService.registry_file", str(workspace / "known_projects.json"), create=True):
-                yield workspace
+                with patch.object(instance, "base_dir", str(workspace)), \
+                     patch.object(instance, "registry_file", str(workspace / "known_projects.json")):
+                    yield workspace
+
+@pytest.fixture
+def fake_ollama():
+    """Local fake Ollama server (see benchmarks/fake_ollama.py); the knowledge base embeds through it."""
+    from fake_ollama import FakeOllamaServer
+    from knowledge_base_service import kb_service
+
+    with FakeOllamaServer(latency=0, token_rate=0, reply="Mocked AI Response", embedding_dim=64) as server:
+        with patch.object(kb_service, "ollama_embed_url", f"{server.url}/api/embeddings"):
+            yield server
 
 @pytest.fixture
-def mock_ollama():
-    """Mocks the Ollama API calls."""
-    with patch("general_functions.requests.post") as mock_post:
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"message": {"content": "Mocked AI Response"}}
-        mock_post.return_value = mock_response
-        yield mock_post
+def mock_ollama(fake_ollama):
+    """Points chat generation at the fake Ollama server."""
+    with patch("general_functions.OLLAMA_URL", f"{fake_ollama.url}/api/generate"):
+        yield fake_ollama
 
 @pytest.fixture
 def mock_chroma():
-    """Mocks the ChromaDB client."""
-    with patch("knowledge_base_service.chromadb.HttpClient") as mock_client:
-        mock_instance = MagicMock()
-        mock_client.return_value = mock_instance
-        yield mock_instance
+    """Swaps the ChromaDB server client for an in-process one."""
+    from embedded_chroma import EmbeddedChroma
+    from knowledge_base_service import kb_service
+
+    client = EmbeddedChroma()
+    with patch.object(kb_service, "_client", client):
+        yield client
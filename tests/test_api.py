@@ -52,6 +52,31 @@ def test_chat_stream_structure(client):
             assert any(e["type"] == "mood" and e["content"] == "happy" for e in events)
             assert any(e["type"] == "chunk" and e["content"] == "Hello" for e in events)
 
+def test_final_reply_mood_follows_done(client):
+    import time
+
+    def slow_classify(text):
+        time.sleep(0.3)
+        return "joy"
+
+    payload = {"prompt": "Hello Luna", "mood_stream": True}
+    with patch("app.get_mood_from_text", return_value="neutral"), \
+         patch("mood_service.classify_emotion", side_effect=slow_classify), \
+         patch("app.ask_ollama") as mock_ask:
+
+        async def mock_gen(*args, **kwargs):
+            yield "chunk", "Hello"
+
+        mock_ask.return_value = mock_gen()
+        with client.stream("POST", "/chat", json=payload) as response:
+            events = [json.loads(line) for line in response.iter_lines() if line.strip()]
+
+    types = [e["type"] for e in events]
+    assert "done" in types
+    # The reply isn't held up by the last mood pass; its result still reaches the client
+    assert events[-1] == {"type": "mood", "content": "happy", "source": "response"}
+    assert types.index("done") < len(events) - 1
+
 def test_grammar_checker_payload(client):
     # Test /vault/fix-grammar
     payload = {"content": "I has a pencil."}
@@ -66,3 +91,18 @@ def test_grammar_checker_payload(client):
         assert response.status_code == 200
         assert response.json()["fixed"] == "I have a pencil."
         assert response.json()["original"] == "I has a pencil."
+
+def test_rejected_chat_leaves_no_conversation_turn(client, tmp_path):
+    from unittest.mock import PropertyMock
+    from conversation_service import conversation_service
+
+    conversation_id = conversation_service.new_id()
+    payload = {"prompt": "Hello Luna", "conversation_id": conversation_id}
+    with patch("vault_service.VaultService.vault_path", new_callable=PropertyMock, return_value=str(tmp_path)), \
+         patch("app.ollama_scheduler.has_capacity", return_value=False):
+        assert client.post('/chat', json=payload).status_code == 429
+        assert conversation_service.tail(conversation_id) == []
+
+    with patch("vault_service.VaultService.vault_path", new_callable=PropertyMock, return_value=None):
+        assert client.get(f'/conversations/{conversation_id}').status_code == 409
+        assert client.get('/conversations').json() == []
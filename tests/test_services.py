@@ -61,3 +61,1073 @@ def test_vault_service_operations(temp_workspace):
     # 5. Security Check (Path Traversal)
     with pytest.raises(ValueError):
         vs.read_file("../../secret.txt")
+
+@pytest.mark.asyncio
+async def test_web_search_stub_provider_and_deadline():
+    from web_search_service import WebSearchService, StubSearchProvider
+
+    provider = StubSearchProvider()
+    ws = WebSearchService(provider=provider)
+    results = await ws.web_search("speed of light", max_results=2)
+    assert len(results) == 2
+    assert provider.calls == ["speed of light"]
+    assert {"title", "snippet", "url"} <= set(results[0])
+
+    # A provider slower than the deadline returns no results instead of hanging
+    ws.set_provider(StubSearchProvider(delay=0.5))
+    ws.timeout = 0.1
+    assert await ws.web_search("slow query") == []
+
+@pytest.mark.asyncio
+async def test_stuck_web_search_keeps_its_slot_and_private_pages_are_refused():
+    import asyncio
+    from unittest.mock import patch
+    from web_search_service import WebSearchService, StubSearchProvider
+
+    provider = StubSearchProvider(delay=0.4)
+    with patch.dict(os.environ, {"WEB_SEARCH_MAX_CONCURRENCY": "1"}):
+        ws = WebSearchService(provider=provider)
+    ws.timeout = 0.1
+    assert await ws.web_search("stuck") == []
+    # The first call's thread still runs: the next search gives up without reaching the provider
+    assert await ws.web_search("queued") == []
+    assert provider.calls == ["stuck"]
+
+    await asyncio.sleep(0.4)
+    provider.delay = 0
+    assert len(await ws.web_search("later")) == 3
+
+    for url in ("http://127.0.0.1:5000/config", "http://169.254.169.254/latest/meta-data", "file:///etc/passwd"):
+        assert "error" in await ws.fetch_page(url)
+
+def test_knowledge_base_collections_are_scoped_per_project(temp_workspace):
+    from knowledge_base_service import KnowledgeBaseService
+
+    kb = KnowledgeBaseService()
+    book_a = str(temp_workspace / "BookA")
+    book_b = str(temp_workspace / "BookB")
+
+    names_a = kb.collection_names(book_a)
+    names_b = kb.collection_names(book_b)
+    assert names_a != names_b
+    assert names_a == kb.collection_names(book_a)  # Stable across calls
+
+    kb.set_active_vault(book_b)
+    assert kb.collection_names() == names_b
+
+@pytest.mark.asyncio
+async def test_indexing_job_runs_in_background_and_checkpoints(tmp_path):
+    from unittest.mock import patch
+    from indexing_service import IndexingService
+
+    async def fake_sync(vault_path, skip_files=None):
+        for idx, name in enumerate(["World/a.md", "Novel/b.md"], start=1):
+            if name not in (skip_files or set()):
+                yield {"status": "progress", "file": name, "current": idx, "total": 2}
+        yield {"status": "done", "total": 2}
+
+    with patch("storage.STATE_DIR", str(tmp_path)), \
+         patch("indexing_service.kb_service.sync_vault", fake_sync):
+        service = IndexingService()
+        job = service.start_job("/vault")
+        assert service.start_job("/vault") is job  # Joins the running job
+
+        events = [event async for event in job.stream(0)]
+        assert events[-1]["status"] == "done"
+        assert job.done_files == ["World/a.md", "Novel/b.md"]
+
+        # A fresh service (e.g. after a restart) sees the finished job from its checkpoint
+        restarted = IndexingService()
+        restarted.resume_pending()
+        assert restarted.get_job(job.id).status == "done"
+
+@pytest.mark.asyncio
+async def test_vault_watcher_debounces_saves(temp_workspace):
+    from unittest.mock import patch, AsyncMock
+    from vault_watcher import VaultWatcher
+
+    vs = VaultService()
+    vs.config_file = str(temp_workspace / "config.json")
+    vault_path = str(temp_workspace / "Vault")
+    os.makedirs(vault_path)
+    vs.set_vault_path(vault_path)
+
+    with patch("vault_watcher.vault_service", vs), \
+         patch("vault_watcher.kb_service.index_file", new_callable=AsyncMock, return_value=1) as index_file:
+        watcher = VaultWatcher()
+        watcher.enabled = True
+        watcher.debounce = 0
+        vs.add_change_listener(watcher.notify)
+
+        vs.save_file("World/Dragon.md", "First draft")
+        vs.save_file("World/Dragon.md", "Second draft")
+        await watcher._flush(float("inf"))
+
+        index_file.assert_awaited_once_with(vault_path, os.path.normpath("World/Dragon.md"))
+
+@pytest.mark.asyncio
+async def test_indexing_checkpoints_are_batched_and_expire(tmp_path):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest.mock import patch
+    from storage import write_json_atomic, read_json
+    from indexing_service import IndexingService, IndexingJob
+
+    names = [f"World/{i}.md" for i in range(120)]
+    async def fake_sync(vault_path, skip_files=None):
+        for idx, name in enumerate(names, start=1):
+            yield {"status": "progress", "file": name, "current": idx, "total": len(names)}
+        yield {"status": "done", "total": len(names)}
+
+    writes = []
+    def counting_write(path, data):
+        writes.append(path)
+        write_json_atomic(path, data)
+
+    with patch("indexing_service.kb_service.sync_vault", fake_sync), \
+         patch("indexing_service.write_json_atomic", counting_write), \
+         patch.object(IndexingJob, "CHECKPOINT_SECONDS", 3600):
+        service = IndexingService()
+        job = service.start_job("/vault")
+        events = [event async for event in job.stream(0)]
+    assert events[-1]["status"] == "done"
+    assert len(writes) <= 1 + len(names) // IndexingJob.CHECKPOINT_FILES + 1  # Not one per file
+    assert read_json(job.checkpoint_file)["done_files"] == names
+
+    # Concurrent writers of one file each use their own temp file
+    target = str(tmp_path / "shared.json")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for future in [pool.submit(write_json_atomic, target, {"n": n, "pad": "x" * 100000}) for n in range(32)]:
+            future.result()  # Re-raises a writer that lost its temp file to another
+    assert read_json(target)["n"] in range(32)
+    assert sorted(os.listdir(tmp_path)) == ["luna_state", "shared.json"]  # No temp files left
+
+    # Finished jobs past the retention period are deleted, with stray cancel markers
+    open(job.cancel_file, "w").close()
+    service.retention = 0
+    time.sleep(0.01)
+    assert service.prune_finished() == 2
+    assert not os.path.exists(job.checkpoint_file) and not os.path.exists(job.cancel_file)
+    assert service.get_job(job.id) is None
+
+@pytest.mark.asyncio
+async def test_vault_watcher_retries_a_failed_reindex(temp_workspace):
+    import time
+    from unittest.mock import patch, AsyncMock
+    from vault_watcher import VaultWatcher
+
+    vault_path = temp_workspace / "Vault"
+    vault_path.mkdir()
+    note = vault_path / "Note.md"
+    note.write_text("First draft")
+
+    with patch("vault_watcher.vault_service.default_vault_path", str(vault_path)), \
+         patch("vault_watcher.kb_service.index_file", new_callable=AsyncMock,
+               side_effect=[RuntimeError("chroma is down"), 1]) as index_file:
+        watcher = VaultWatcher()
+        watcher.enabled = True
+        await watcher._poll()  # Baseline
+        baseline = watcher._snapshot["Note.md"]
+
+        note.write_text("Second draft")
+        os.utime(note, (baseline + 10, baseline + 10))
+        await watcher._poll()
+        now = time.monotonic()
+        await watcher._flush(now + watcher.debounce)
+        # The edit isn't lost: still queued, and the snapshot didn't move past it
+        assert ("Note.md" in watcher._snapshot) and watcher._snapshot["Note.md"] == baseline
+        assert (str(vault_path), "Note.md") in watcher._pending
+
+        await watcher._poll()
+        await watcher._flush(now + watcher.debounce + 1)  # Still backing off
+        assert index_file.await_count == 1
+        await watcher._flush(now + watcher.debounce + watcher.RETRY_BACKOFF)
+        assert index_file.await_count == 2
+        assert watcher._snapshot["Note.md"] == baseline + 10 and not watcher._pending and not watcher._failures
+        watcher._poll_lock.release()
+
+@pytest.mark.asyncio
+async def test_ollama_scheduler_prioritizes_chat_and_rejects_overflow():
+    import asyncio
+    from ollama_scheduler import OllamaScheduler, QueueFullError
+
+    scheduler = OllamaScheduler()
+    scheduler.max_concurrency = 2
+    scheduler.reserved_interactive = 1
+    scheduler.lanes["grammar"].max_queue = 1
+
+    release = asyncio.Event()
+
+    async def hold(lane):
+        async with scheduler.slot(lane):
+            await release.wait()
+
+    # Bulk work can only use the non-reserved slot...
+    embeddings = [asyncio.create_task(hold("embedding")) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert scheduler.active == 1
+
+    # ...so chat is admitted immediately
+    async with scheduler.slot("chat"):
+        assert scheduler.lanes["chat"].active == 1
+
+    queued_grammar = asyncio.create_task(hold("grammar"))
+    await asyncio.sleep(0)
+    with pytest.raises(QueueFullError):
+        async with scheduler.slot("grammar"):
+            pass
+
+    release.set()
+    await asyncio.gather(queued_grammar, *embeddings)
+    assert scheduler.active == 0
+    assert scheduler.stats()["lanes"]["grammar"]["rejected"] == 1
+
+def test_grammar_review_hunks_roundtrip():
+    from grammar_review_service import word_diff, apply_hunks, split_segments, ReviewSession
+
+    original = "I has a pencil, and she dont like it.\n\nThe second paragraph is fine."
+    segments = split_segments(original, max_chars=40)
+    assert [original[start:end] for start, end in segments] == [
+        "I has a pencil, and she dont like it.",
+        "The second paragraph is fine.",
+    ]
+
+    fixed = "I have a pencil, and she doesn't like it."
+    hunks = word_diff(original[:37], fixed)
+    assert [original[h["start"]:h["end"]] for h in hunks] == ["has", "dont"]
+
+    session = ReviewSession(original)
+    added = session.add_hunks(hunks)
+    session.resolve(accept=[added[0]["id"]], reject=[added[1]["id"]])
+    assert session.result().startswith("I have a pencil, and she dont like it.")
+    assert apply_hunks(original[:37], hunks) == fixed
+
+def test_review_session_is_shared_between_workers():
+    from grammar_review_service import GrammarReviewService, word_diff
+
+    first, second = GrammarReviewService(), GrammarReviewService()  # Two workers, one state dir
+    original = "I has a pencil."
+    session = first.create_session(original, path="Notes.md")
+    first.update_session(session.id, lambda s: s.add_hunks(word_diff(original, "I have a pencil.")))
+
+    resolved = second.update_session(session.id, lambda s: s.resolve(accept=list(s.hunks), reject=[]))
+    assert resolved.result() == "I have a pencil."
+    assert first.get_session(session.id).hunks[0]["status"] == "accepted"
+
+    assert second.discard_session(session.id)
+    assert first.get_session(session.id) is None
+    assert first.update_session(session.id, lambda s: s.resolve([0], [])) is None
+    assert first.get_session("../../etc") is None
+
+@pytest.mark.asyncio
+async def test_review_keeps_within_the_grammar_lane_and_reports_failed_segments():
+    import asyncio
+    from unittest.mock import patch
+    from ollama_scheduler import QueueFullError
+    from grammar_review_service import GrammarReviewService
+
+    in_flight, peak, busy_once, broken = 0, 0, {"Part 3 has a eror."}, True
+
+    async def fake_correct(text, use_cache=True):
+        nonlocal in_flight, peak
+        if in_flight >= 9:  # The grammar lane: one running, eight queued
+            raise QueueFullError("grammar")
+        if text in busy_once:
+            busy_once.discard(text)
+            raise QueueFullError("grammar")
+        if broken and text.startswith("Part 7 "):
+            raise RuntimeError("Ollama went away")
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return text.replace("eror", "error")
+        finally:
+            in_flight -= 1
+
+    text = "\n\n".join(f"Part {i} has a eror." for i in range(15))
+    reviewer = GrammarReviewService()
+    reviewer.segment_chars = 20
+    with patch("grammar_review_service.correct_text", fake_correct), \
+         patch("grammar_review_service.grammar_precheck.enabled", False):
+        session = reviewer.create_session(text)
+        events = [event async for event in reviewer.run(session)]
+        assert events[0]["segments"] == 15 and peak <= 4
+        errors = [e for e in events if e["type"] == "error"]
+        assert len(errors) == 1 and text[errors[0]["start"]:errors[0]["end"]] == "Part 7 has a eror."
+        assert events[-1]["partial"] and events[-1]["hunks"] == 14
+        stored = reviewer.get_session(session.id)
+        assert not stored.complete and stored.failed == [(errors[0]["start"], errors[0]["end"])]
+
+        broken = False
+        events = [event async for event in reviewer.run(stored, retry=True)]
+        assert events[0]["segments"] == 1 and not events[-1]["partial"]
+        stored = reviewer.get_session(session.id)
+        assert stored.complete and stored.failed == [] and len(stored.hunks) == 15
+
+@pytest.mark.asyncio
+async def test_fact_check_pipeline_dedupes_and_streams_verdicts():
+    from unittest.mock import patch
+    from fact_check_service import FactCheckService, EXTRACT_SYSTEM
+
+    async def fake_generate_json(prompt, system=None, lane="chat", **route):
+        if system == EXTRACT_SYSTEM:
+            return {"claims": ["Mars has two moons.", "mars has two moons"]}
+        return {"verdict": "verified", "explanation": "Matches the notes.", "sources": ["vault"]}
+
+    async def fake_search(query):
+        return ["Mars: two moons, Phobos and Deimos."]
+
+    text = "\n\n".join(f"Paragraph {i} says that Mars has two moons orbiting it." for i in range(3))
+    with patch("fact_check_service.generate_json", fake_generate_json), \
+         patch("fact_check_service.kb_service.search", fake_search) as search:
+        service = FactCheckService()
+        service.segment_chars = 60
+        service.use_web = False
+        events = [event async for event in service.run(text)]
+
+    verdicts = [e for e in events if e["type"] == "verdict"]
+    assert len(verdicts) == 1  # Same claim from three segments is checked once
+    assert verdicts[0]["verdict"] == "VERIFIED"
+    assert events[-1] == {
+        "type": "done", "claims": 1, "verdicts": 1, "failed_segments": 0, "failed_claims": 0, "partial": False
+    }
+
+@pytest.mark.asyncio
+async def test_fact_check_reports_work_the_lane_rejected():
+    from unittest.mock import patch
+    from fact_check_service import FactCheckService, EXTRACT_SYSTEM, UNVERIFIED
+    from ollama_scheduler import QueueFullError
+
+    lanes = []
+
+    async def fake_generate_json(prompt, system=None, lane="chat", **route):
+        lanes.append(lane)
+        if system == EXTRACT_SYSTEM:
+            if "Venus" in prompt:
+                raise QueueFullError(lane)
+            return {"claims": ["Mars has two moons."]}
+        raise QueueFullError(lane)
+
+    async def fake_search(query):
+        return ["Mars: two moons."]
+
+    text = "Paragraph one says that Mars has two moons.\n\nParagraph two says that Venus has no moons at all."
+    with patch("fact_check_service.generate_json", fake_generate_json), \
+         patch("fact_check_service.kb_service.search", fake_search):
+        service = FactCheckService()
+        service.segment_chars = 50
+        service.use_web = False
+        service.retries = 1
+        events = [event async for event in service.run(text)]
+
+    assert "chat" not in lanes
+    assert [e["segment"] for e in events if e["type"] == "error"] == [1]
+    [verdict] = [e for e in events if e["type"] == "verdict"]
+    assert verdict["verdict"] == UNVERIFIED and verdict["failed"]
+    assert events[-1]["partial"] and events[-1]["failed_segments"] == 1 and events[-1]["failed_claims"] == 1
+
+def test_prefetch_context_respects_token_budget():
+    from knowledge_base_service import KnowledgeBaseService
+
+    kb = KnowledgeBaseService()
+    snippets = ["alpha " * 100, "beta " * 400, "gamma " * 10]  # ~150, ~500, ~15 tokens
+    selected = kb.fit_token_budget(snippets, max_tokens=300)
+
+    assert selected[0] == snippets[0]
+    assert selected[1].endswith(" ...") and len(selected) == 2
+    assert sum(kb.estimate_tokens(s) for s in selected) <= 300 + 1
+
+@pytest.mark.asyncio
+async def test_response_cache_normalizes_input_and_evicts_by_size(tmp_path):
+    from response_cache import ResponseCache
+
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    assert await cache.lookup("llama3.2", "grammar", "I has a pencil.") is None
+
+    await cache.store("llama3.2", "#task:summarize", "Summarize the war.", "A long war.")
+    assert await cache.lookup("llama3.2", "#task:summarize", "  Summarize the\nwar. ") == "A long war."
+
+    # Grammar replies are the input corrected: only the exact text may hit
+    await cache.store("llama3.2", "grammar", "I has a pencil.\n\nIt is red.", "I have a pencil.\n\nIt is red.")
+    assert await cache.lookup("llama3.2", "grammar", "I has a pencil.\n\nIt is red.") == "I have a pencil.\n\nIt is red."
+    assert await cache.lookup("llama3.2", "grammar", "I has a pencil. It is red.") is None
+    assert await cache.lookup("other-model", "grammar", "I has a pencil.\n\nIt is red.") is None
+
+    cache.max_bytes = 30
+    for idx in range(5):
+        cache.put("llama3.2", "grammar", f"text {idx}", "x" * 10)
+    assert cache.stats()["bytes"] <= 30
+
+def test_histogram_renders_cumulative_buckets():
+    from metrics import Registry
+
+    registry = Registry()
+    latency = registry.histogram("test_seconds", "Test latency.", ("route",), buckets=(0.1, 1))
+    latency.observe(0.05, route="/chat")
+    latency.observe(0.5, route="/chat")
+    latency.observe(5, route="/chat")
+    text = registry.render()
+
+    assert 'test_seconds_bucket{route="/chat",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{route="/chat",le="1"} 2' in text
+    assert 'test_seconds_bucket{route="/chat",le="+Inf"} 3' in text
+    assert 'test_seconds_count{route="/chat"} 3' in text
+
+@pytest.mark.asyncio
+async def test_tracer_builds_span_tree_across_tasks():
+    import asyncio
+    from tracing import Tracer
+
+    tracer = Tracer()
+
+    async def tool_call():
+        with tracer.span("tool.search_vault"):
+            await asyncio.sleep(0)
+
+    trace = tracer.start_trace("chat", "req-1")
+    with tracer.span("ollama.generate", step="initial") as generate:
+        await asyncio.create_task(tool_call())
+    tracer.finish_trace(trace)
+
+    summary = tracer.get("req-1").summary()
+    spans = {span["name"]: span for span in summary["spans"]}
+    assert spans["ollama.generate"]["parent"] == spans["chat"]["id"]
+    assert spans["tool.search_vault"]["parent"] == generate.span_id
+    assert set(summary["stages"]) == {"ollama.generate", "tool.search_vault"}
+
+@pytest.mark.asyncio
+async def test_index_and_search_against_fake_ollama(tmp_path, fake_ollama, mock_chroma):
+    from knowledge_base_service import kb_service
+
+    vault = tmp_path / "vault"
+    (vault / "World").mkdir(parents=True)
+    (vault / "World" / "Veyra.md").write_text("Veyra is the capital of the northern kingdom.")
+    (vault / "World" / "Tides.md").write_text("The tides of Duskfen rise twice a day.")
+
+    assert await kb_service.index_file(str(vault), "World/Veyra.md") == 1
+    assert await kb_service.index_file(str(vault), "World/Tides.md") == 1
+
+    results = await kb_service.search("capital of the northern kingdom", top_k=1, vault_path=str(vault))
+    assert results[0].startswith("Veyra")
+    assert any(path == "/api/embeddings" for path, _ in fake_ollama.requests)
+
+@pytest.mark.asyncio
+async def test_failed_embedding_keeps_previous_chunks_and_is_retried(tmp_path, fake_ollama, mock_chroma):
+    from unittest.mock import patch
+    from knowledge_base_service import kb_service
+    from indexing_service import IndexingService
+
+    vault = tmp_path / "vault"
+    (vault / "World").mkdir(parents=True)
+    (vault / "World" / "Veyra.md").write_text("Veyra is the capital of the northern kingdom.")
+    assert await kb_service.index_file(str(vault), "World/Veyra.md") == 1
+
+    async def no_embedding(text, lane="embedding"):
+        return None
+
+    (vault / "World" / "Veyra.md").write_text("Veyra was the capital until the flood.")
+    with patch.object(kb_service, "get_embedding", no_embedding):
+        with pytest.raises(RuntimeError):
+            await kb_service.index_file(str(vault), "World/Veyra.md")
+        service = IndexingService()
+        job = service.start_job(str(vault))
+        await job.task
+
+    results = await kb_service.search("capital of the northern kingdom", top_k=1, vault_path=str(vault))
+    assert results[0].startswith("Veyra is the capital")  # The old chunk is still indexed
+    assert job.errors and job.errors[0]["file"] == os.path.join("World", "Veyra.md")
+    assert job.done_files == []  # A resume indexes the note again
+
+@pytest.mark.asyncio
+async def test_indexing_job_is_claimed_by_one_worker(tmp_path):
+    import asyncio
+    from unittest.mock import patch
+    from indexing_service import IndexingService
+
+    release = asyncio.Event()
+
+    async def slow_sync(vault_path, skip_files=None):
+        yield {"status": "progress", "file": "World/a.md", "current": 1, "total": 2}
+        await release.wait()
+        yield {"status": "progress", "file": "World/b.md", "current": 2, "total": 2}
+        yield {"status": "done", "total": 2}
+
+    with patch("storage.STATE_DIR", str(tmp_path)), \
+         patch("indexing_service.kb_service.sync_vault", slow_sync):
+        owner, other = IndexingService(), IndexingService()  # Two workers sharing the state dir
+        job = owner.start_job("/vault")
+        await asyncio.sleep(0.05)
+
+        joined = other.start_job("/vault")
+        assert joined.id == job.id and joined.remote
+
+        release.set()
+        await job.task
+        assert other.get_job(job.id).status == "done"
+
+def test_session_vault_overrides_default(tmp_path, temp_workspace):
+    import contextvars
+    from session_service import SessionService
+
+    sessions = SessionService(str(tmp_path / "sessions.sqlite3"))
+    sessions.set("session-a", "/vaults/a", "A")
+    assert sessions.get("session-a") == {"vault_path": "/vaults/a", "project": "A"}
+    assert sessions.get("session-b") is None
+
+    vs = VaultService()
+    vs.config_file = str(temp_workspace / "config.json")
+    vs.set_vault_path("/vaults/default")
+
+    def in_request(session_id):
+        session = sessions.get(session_id)
+        sessions.activate(session["vault_path"] if session else None)
+        return vs.vault_path
+
+    assert contextvars.copy_context().run(in_request, "session-a") == "/vaults/a"
+    assert contextvars.copy_context().run(in_request, "session-b") == "/vaults/default"
+    assert vs.vault_path == "/vaults/default"
+
+def test_chunk_coalescer_batches_bursts_but_not_first_token():
+    import json
+    from ndjson import ChunkCoalescer
+
+    coalescer = ChunkCoalescer(window=60, max_bytes=10)
+    assert [json.loads(line) for line in coalescer.push({"type": "chunk", "content": "Hel"})] == \
+        [{"type": "chunk", "content": "Hel"}]
+
+    assert coalescer.push({"type": "chunk", "content": "lo"}) == []
+    assert coalescer.push({"type": "chunk", "content": ", "}) == []
+    assert coalescer.timeout() > 0
+
+    lines = coalescer.push({"type": "thought", "content": "Luna consultando search_vault..."})
+    assert [json.loads(line)["type"] for line in lines] == ["chunk", "thought"]
+    assert json.loads(lines[0])["content"] == "lo, "
+
+    coalescer.push({"type": "chunk", "content": "0123456789"})  # Hits max_bytes right away
+    assert not coalescer.pending
+
+@pytest.mark.asyncio
+async def test_streaming_mood_analyzer_rate_limits_and_reports_changes(monkeypatch):
+    import asyncio
+    import mood_service
+
+    windows = []
+    def fake_classify(text):
+        windows.append(text)
+        return "sadness" if "sorry" in text else "joy"
+    monkeypatch.setattr(mood_service, "classify_emotion", fake_classify)
+
+    moods = []
+    async def on_mood(mood):
+        moods.append(mood)
+
+    analyzer = mood_service.StreamingMoodAnalyzer(on_mood)
+    analyzer.window_chars, analyzer.min_new_chars, analyzer.interval = 50, 10, 60
+
+    analyzer.feed("Great news, it worked! ")
+    analyzer.feed("I'm so sorry, it broke again.")  # Within the interval: not classified yet
+    await asyncio.sleep(0.05)
+    assert len(windows) == 1 and moods == ["happy"]
+
+    await analyzer.finish()
+    assert len(windows) == 2 and len(windows[1]) <= 50
+    assert moods == ["happy", "sad"]
+
+def test_conversation_log_tail_follows_other_writers(tmp_path):
+    from unittest.mock import patch
+    from conversation_service import ConversationService
+
+    vault = str(tmp_path / "vault")
+    with patch("storage.STATE_DIR", str(tmp_path / "state")):
+        conversations = ConversationService()
+        conversations.tail_size = 3
+        conversation_id = conversations.new_id()
+
+        for i in range(5):
+            conversations.append(conversation_id, "user", f"message {i}", vault_path=vault)
+        assert [m["content"] for m in conversations.tail(conversation_id, vault_path=vault)] == \
+            ["message 2", "message 3", "message 4"]
+
+        # Another worker appends to the same log: the cached tail is refreshed
+        ConversationService().append(conversation_id, "assistant", "reply", vault_path=vault)
+        assert [m["content"] for m in conversations.tail(conversation_id, limit=2, vault_path=vault)] == \
+            ["message 4", "reply"]
+
+        assert len(list(conversations.iter_messages(conversation_id, vault_path=vault))) == 6
+        assert conversations.list_conversations(vault_path=vault)[0]["id"] == conversation_id
+
+@pytest.mark.asyncio
+async def test_generation_resumes_from_reply_offset():
+    from generation_store import GenerationStore
+
+    store = GenerationStore()
+    generation = store.create()
+    first = generation.subscribe()
+    await generation.put({"type": "chunk", "content": "Once upon"})
+    await generation.put({"type": "thought", "content": "Luna consultando search_vault..."})
+    await generation.put({"type": "chunk", "content": " a time"})
+    generation.unsubscribe(first)  # Client dropped after receiving "Once up"
+
+    await generation.put({"type": "done"})
+    resumed = store.get(generation.id).subscribe(offset=len("Once up"))
+    events = [resumed.get_nowait() for _ in range(resumed.qsize())]
+    assert events == [
+        {"type": "chunk", "content": "on"},
+        {"type": "thought", "content": "Luna consultando search_vault..."},
+        {"type": "chunk", "content": " a time"},
+        {"type": "done"},
+    ]
+
+@pytest.mark.asyncio
+async def test_generation_store_evicts_finished_detached_generations_first():
+    from generation_store import GenerationStore
+
+    store = GenerationStore()
+    store.max_chars = 10
+    finished = store.create()
+    await finished.put({"type": "chunk", "content": "0123456789"})
+    await finished.put({"type": "done"})
+    running = store.create()
+    await running.put({"type": "chunk", "content": "abc"})
+    attached = store.create()
+    attached.subscribe()
+    await attached.put({"type": "chunk", "content": "xyz"})
+
+    store.sweep()
+    assert finished.id not in store.generations
+    assert running.id in store.generations and attached.id in store.generations
+
+@pytest.mark.asyncio
+async def test_entity_index_is_incremental_and_resolves_aliases(tmp_path):
+    from unittest.mock import patch, AsyncMock
+    from entity_service import EntityService
+
+    replies = {
+        "Elara rules Varn.": {"entities": [
+            {"name": "Elara", "type": "character", "aliases": ["the Silver Queen"], "summary": "Queen of Varn."},
+            {"name": "Varn", "type": "place", "aliases": [], "summary": "A northern kingdom."},
+        ]},
+        "The Ashen Order hunts Elara.": {"entities": [
+            {"name": "Ashen Order", "type": "faction", "aliases": []},
+            {"name": "Elara", "type": "character", "aliases": []},
+            {"name": "Dragons", "type": "creature", "aliases": []},  # Unknown type: dropped
+        ]},
+    }
+    extract = AsyncMock(side_effect=lambda prompt, **kwargs: replies[prompt.split("\n", 1)[1]])
+
+    with patch("storage.STATE_DIR", str(tmp_path)), patch("entity_service.generate_json", extract):
+        entities = EntityService()
+        chunks = [("World/Elara.md_0", "Elara rules Varn."), ("World/Elara.md_1", "The Ashen Order hunts Elara.")]
+        assert await entities.update_file("vault", "World/Elara.md", "text v1", chunks)
+        assert not await entities.update_file("vault", "World/Elara.md", "text v1", chunks)  # Unchanged note
+        assert extract.await_count == 2
+
+        queen = entities.lookup("vault", "the silver queen")
+        assert queen["name"] == "Elara" and queen["chunks"] == ["World/Elara.md_0", "World/Elara.md_1"]
+        assert [e["name"] for e in entities.list_entities("vault")] == ["Ashen Order", "Elara", "Varn"]
+        assert EntityService().lookup("vault", "Varn")["type"] == "place"  # Persisted
+
+        entities.remove_file("vault", "World/Elara.md")
+        assert entities.lookup("vault", "Elara") is None
+
+@pytest.mark.asyncio
+async def test_entity_extraction_keeps_within_the_lane_and_gives_up_on_a_failing_chunk():
+    import time
+    import asyncio
+    from unittest.mock import patch
+    from ollama_scheduler import QueueFullError
+    from entity_service import EntityService
+
+    in_flight, peak, calls = 0, 0, []
+
+    async def extract(prompt, **kwargs):
+        nonlocal in_flight, peak
+        if in_flight >= 9:  # The summary lane: one running, eight queued
+            raise QueueFullError("summary")
+        text = prompt.split("\n", 1)[1]
+        calls.append(text)
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            in_flight -= 1
+        if text == "Chunk 5":
+            return None  # No usable reply, every time
+        return {"entities": [{"name": text.replace("Chunk", "Person"), "type": "character", "aliases": []}]}
+
+    chunks = [(f"World/Big.md_{i}", f"Chunk {i}") for i in range(12)]
+    with patch("entity_service.generate_json", extract):
+        entities = EntityService()
+        entities.max_attempts = 2
+        assert await entities.update_file("vault", "World/Big.md", "text", chunks)
+        assert peak <= 2 and len(calls) == 12
+        assert len(entities.list_entities("vault")) == 11  # What succeeded is kept
+        assert not await entities.update_file("vault", "World/Big.md", "text", chunks)  # Backing off
+
+        with patch("entity_service.time") as clock:
+            clock.time.return_value = time.time() + entities.RETRY_BACKOFF
+            assert await entities.update_file("vault", "World/Big.md", "text", chunks)
+            assert calls[12:] == ["Chunk 5"]  # Only the failed chunk is tried again
+            # Out of attempts: the note counts as done until its text changes
+            clock.time.return_value += 3600
+            assert not await entities.update_file("vault", "World/Big.md", "text", chunks)
+        assert len(calls) == 13 and len(entities.list_entities("vault")) == 11
+
+
+def test_link_graph_tracks_backlinks_and_unresolved_links(tmp_path):
+    from unittest.mock import patch
+    from link_service import LinkService, parse_links
+
+    assert parse_links("See [[Elara|the queen]], [[World/Varn#History]] and ![[map.png]]. [[Elara]]") == \
+        ["Elara", "World/Varn", "map.png"]
+
+    vault = tmp_path / "vault"
+    (vault / "World").mkdir(parents=True)
+    (vault / "World" / "Elara.md").write_text("Queen of [[Varn]], enemy of [[Ashen Order]].")
+    (vault / "World" / "Varn.md").write_text("Kingdom ruled by [[Elara]].")
+
+    with patch("storage.STATE_DIR", str(tmp_path / "state")):
+        links = LinkService()
+        vault_path = str(vault)
+        elara, varn, order = (os.path.join("World", n) for n in ("Elara.md", "Varn.md", "Ashen Order.md"))
+
+        assert links.backlinks(varn, vault_path) == [elara]
+        assert links.links(elara, vault_path)["unresolved"] == ["Ashen Order"]
+
+        # Creating the missing note resolves the waiting link; editing drops stale edges
+        links.update_file(vault_path, order, "Hunts [[Elara]].")
+        assert links.links(elara, vault_path)["links"] == [order, varn]
+        assert links.backlinks(elara, vault_path) == [order, varn]
+        links.update_file(vault_path, varn, "No links any more.")
+        assert links.backlinks(elara, vault_path) == [order]
+
+        assert links.neighborhood(varn, hops=2, vault_path=vault_path)["nodes"] == [varn, elara, order]
+
+        links.remove_file(vault_path, order)
+        assert links.links(elara, vault_path)["unresolved"] == ["Ashen Order"]
+        assert LinkService().backlinks(elara, vault_path) == []  # Persisted
+
+
+@pytest.mark.asyncio
+async def test_link_graph_is_built_off_the_event_loop(tmp_path):
+    import asyncio
+    import threading
+    from link_service import LinkService
+
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    (vault / "Elara.md").write_text("Queen of [[Varn]].")
+    (vault / "Varn.md").write_text("A kingdom.")
+    loop_thread = threading.get_ident()
+    scanned_in = []
+
+    links = LinkService()
+    scan = links._scan
+    def recording_scan(vault_path):
+        scanned_in.append(threading.get_ident())
+        return scan(vault_path)
+    links._scan = recording_scan
+
+    # A save before anything loaded the graph builds it in a thread, then applies the change
+    (vault / "Varn.md").write_text("A kingdom of [[Elara]].")
+    links.on_change(str(vault), "Varn.md")
+    assert scanned_in == []  # Not on the loop
+    graph = await links.load(str(vault))
+    assert scanned_in and loop_thread not in scanned_in
+    assert graph.backward["Elara.md"] == {"Varn.md"} and len(scanned_in) == 1
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_and_closes_after_probe():
+    import httpx
+    from circuit_breaker import CircuitBreaker, BreakerMonitor, CircuitOpenError
+
+    breaker = CircuitBreaker("ollama", failure_threshold=2, base_backoff=0.0)
+    healthy = False
+
+    async def probe():
+        return healthy
+    breaker.probe = probe
+
+    # Bad requests don't count; connection failures open the circuit at the threshold
+    breaker.record_error(ValueError("bad prompt"))
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            with breaker.guard():
+                raise httpx.ConnectError("refused")
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert error.value.to_event()["code"] == "dependency_unavailable"
+
+    monitor = BreakerMonitor({"ollama": breaker})
+    assert await monitor.run_probe(breaker) is False
+    assert breaker.state == "open" and breaker.trips == 2
+
+    healthy = True
+    assert await monitor.run_probe(breaker) is True
+    assert breaker.state == "closed" and breaker.allow()
+
+
+@pytest.mark.asyncio
+async def test_slow_probe_gets_its_own_timeout_and_doesnt_hold_back_others():
+    import asyncio
+    from circuit_breaker import CircuitBreaker, BreakerMonitor
+
+    async def cold_load():
+        await asyncio.sleep(0.3)
+        return True
+
+    async def ping():
+        return True
+
+    mood = CircuitBreaker("mood_model", probe_timeout=1.0)
+    mood.probe = cold_load
+    ollama = CircuitBreaker("ollama", base_backoff=0.0)
+    ollama.probe = ping
+    monitor = BreakerMonitor({"mood_model": mood, "ollama": ollama})
+    monitor.probe_timeout, monitor.TICK = 0.1, 0.01
+
+    ollama.trip()
+    monitor.start(check_now=True)
+    try:
+        await asyncio.sleep(0.1)
+        assert ollama.state == "closed"  # While the mood model is still loading
+        await asyncio.sleep(0.4)
+        assert mood.state == "closed" and mood.trips == 0
+    finally:
+        await monitor.stop()
+
+
+@pytest.mark.asyncio
+async def test_model_router_applies_project_overrides_and_falls_back():
+    from model_router import ModelRouter
+    from general_functions import MODEL
+
+    router = ModelRouter()
+    config = {"models": {"grammar": {"model": "tiny-editor", "fallbacks": ["qwen2.5:1.5b"], "num_ctx": 2048}}}
+
+    grammar = router.configured("grammar", project_config=config)
+    assert grammar["model"] == "tiny-editor" and grammar["options"]["num_ctx"] == 2048
+    assert grammar["options"]["temperature"] == 0  # Defaults not overridden are kept
+    assert router.configured("summary", project_config=config)["model"] == router.routes["summary"]["model"]
+
+    # Unpulled models fall back through the route's list, then to the chat model
+    assert router.pick("tiny-editor", ["qwen2.5:1.5b"], {"qwen2.5:1.5b", f"{MODEL}:latest"}) == "qwen2.5:1.5b"
+    assert router.pick("tiny-editor", ["qwen2.5:1.5b"], {f"{MODEL}:latest"}) == MODEL
+    assert router.pick("tiny-editor", [], None) == "tiny-editor"  # Ollama unreachable: as configured
+
+    router._available, router._listed_at = {"tiny-editor:latest"}, float("inf")
+    route = await router.route("grammar", project_config=config)
+    assert route == {"model": "tiny-editor", "options": grammar["options"], "keep_alive": grammar["keep_alive"]}
+
+
+@pytest.mark.asyncio
+async def test_project_bundle_round_trip_needs_no_embedding_calls(tmp_path, temp_workspace, fake_ollama, mock_chroma):
+    from unittest.mock import patch
+    from knowledge_base_service import kb_service
+    from project_service import project_service
+    from bundle_service import bundle_service
+
+    vault = tmp_path / "vault"
+    (vault / "World").mkdir(parents=True)
+    (vault / "World" / "Veyra.md").write_text("Veyra is the capital of the northern kingdom.")
+    (vault / "Novel").mkdir()
+    (vault / "Novel" / "Chapter 1.md").write_text("Mira rode north to Veyra.")
+
+    with patch("storage.STATE_DIR", str(tmp_path / "state")), patch.object(bundle_service, "page_size", 1):
+        await kb_service.index_file(str(vault), os.path.join("World", "Veyra.md"))
+        await kb_service.index_file(str(vault), os.path.join("Novel", "Chapter 1.md"))
+        project_service.store_project("Saga", str(vault), {"description": "A saga", "summary": "", "config": {"vault_path": str(vault)}})
+
+        bundle_path = str(tmp_path / "saga.zip")
+        manifest = await bundle_service.export_project("Saga", bundle_path)
+        assert manifest["chunks"] == {"world": 1, "novel": 1} and manifest["files"] == 2
+
+        embeddings_before = len(fake_ollama.requests)
+        restored = str(tmp_path / "restored")
+        result = await bundle_service.import_project(bundle_path, restored, name="Saga Copy")
+        assert len(fake_ollama.requests) == embeddings_before  # Nothing re-embedded
+        assert result["chunks"] == {"world": 1, "novel": 1}
+
+        assert (tmp_path / "restored" / "Novel" / "Chapter 1.md").read_text() == "Mira rode north to Veyra."
+        assert project_service.load_project("Saga Copy")["config"]["vault_path"] == restored
+        results = await kb_service.search("capital of the northern kingdom", top_k=1, vault_path=restored)
+        assert results[0].startswith("Veyra")
+
+        with pytest.raises(FileExistsError):
+            await bundle_service.import_project(bundle_path, restored, name="Another")
+
+
+@pytest.mark.asyncio
+async def test_failed_bundle_import_is_rolled_back(tmp_path, temp_workspace, fake_ollama, mock_chroma):
+    import zipfile
+    from unittest.mock import patch
+    from knowledge_base_service import kb_service
+    from project_service import project_service
+    from bundle_service import bundle_service
+
+    vault = tmp_path / "vault"
+    (vault / "World").mkdir(parents=True)
+    (vault / "World" / "Veyra.md").write_text("Veyra is the capital of the northern kingdom.")
+
+    with patch("storage.STATE_DIR", str(tmp_path / "state")):
+        await kb_service.index_file(str(vault), os.path.join("World", "Veyra.md"))
+        project_service.store_project("Saga", str(vault), {"description": "", "summary": "", "config": {"vault_path": str(vault)}})
+        bundle_path = str(tmp_path / "saga.zip")
+        await bundle_service.export_project("Saga", bundle_path)
+
+        # Same bundle with every embedding page cut short
+        broken_path = str(tmp_path / "broken.zip")
+        with zipfile.ZipFile(bundle_path) as src, zipfile.ZipFile(broken_path, "w") as dst:
+            for info in src.infolist():
+                data = src.read(info)
+                dst.writestr(info, data[:len(data) // 2] if info.filename.endswith(".f16") else data)
+
+        client = await kb_service.get_client()
+        restored = tmp_path / "restored"
+        for existed in (False, True):
+            with pytest.raises(ValueError, match="Truncated"):
+                await bundle_service.import_project(broken_path, str(restored), name="Saga Copy")
+            assert restored.is_dir() == existed and (not existed or os.listdir(restored) == [])
+            collections = [getattr(c, "name", c) for c in await client.list_collections()]
+            assert not set(kb_service.collection_names(str(restored))) & set(collections)
+            assert project_service.load_project("Saga Copy") is None
+            restored.mkdir(exist_ok=True)  # Second round: the folder was there, empty, before the import
+
+        result = await bundle_service.import_project(bundle_path, str(restored), name="Saga Copy")
+        assert result["chunks"] == {"world": 1, "novel": 0}
+        assert (restored / "World" / "Veyra.md").exists()
+
+
+@pytest.mark.asyncio
+async def test_reranker_orders_trims_and_caches_scores():
+    from unittest.mock import patch
+    from rerank_service import RerankService
+
+    scored = []
+
+    def fake_score(query, texts):
+        # Relevance is the number of query words a text contains
+        scored.append(len(texts))
+        words = set(query.lower().split())
+        return [float(sum(w.strip(".,") in words for w in text.lower().split())) * 10 for text in texts]
+
+    reranker = RerankService()
+    passages = [
+        "The tides of Duskfen rise twice a day.",
+        "Veyra has old walls. Veyra is the capital of the north. The walls are grey.",
+    ]
+    with patch.object(reranker, "_score_sync", fake_score):
+        ranked = await reranker.rerank("capital of the north", passages, top_n=1)
+        assert ranked == [(1, "Veyra is the capital of the north.")]
+        calls = len(scored)
+
+        # Same query again: every pair comes from the cache
+        assert await reranker.rerank("Capital of the north ", passages, top_n=1) == ranked
+        assert len(scored) == calls
+
+
+@pytest.mark.asyncio
+async def test_grammar_precheck_sends_only_flagged_paragraphs(tmp_path):
+    from unittest.mock import patch
+    from grammar_precheck import GrammarPrecheck
+    from grammar_review_service import GrammarReviewService
+
+    vault = tmp_path / "vault"
+    (vault / "World").mkdir(parents=True)
+    (vault / "World" / "Veyra.md").write_text("The city of the north.")
+    prose = "The rain fell on the city. She walked to the gate of the north."
+    # A misspelling used all over the vault is still a misspelling
+    (vault / "Notes.md").write_text(" ".join(["She walked to the gaet."] * 5))
+    words = tmp_path / "words"
+    words.write_text("\n".join(set(prose.lower().replace(".", "").split()) | {"she", "walked", "said", "has", "i"}))
+
+    with patch.dict(os.environ, {"GRAMMAR_DICTIONARY": str(words), "GRAMMAR_PRECHECK_LANG": "ENG"}):
+        precheck = GrammarPrecheck()
+    vocabulary = precheck.vocabulary(str(vault))
+
+    assert precheck.check("Veyra fell. " + prose, vocabulary) == []  # Note titles are known
+    assert precheck.check("She walked to the gaet.", vocabulary) == ["spelling: gaet"]
+    # Titles are cached until the vault watcher reports a change
+    (vault / "Orrin.md").write_text("")
+    assert precheck.check("Orrin fell.", precheck.vocabulary(str(vault))) == ["spelling: Orrin"]
+    precheck.on_change(str(vault), "Orrin.md")
+    assert precheck.check("Orrin fell.", precheck.vocabulary(str(vault))) == []
+    assert "space before punctuation" in precheck.check("The rain fell , she walked.", vocabulary)
+    assert "agreement" in precheck.check("She said I has the rain.", vocabulary)
+
+    text = f"{prose}\n\n{prose}\n\nShe walked to the gaet.\n\n{prose}"
+    reviewer = GrammarReviewService()
+    with patch("grammar_review_service.grammar_precheck", precheck):
+        segments, skipped = await reviewer.plan(text, vault_path=str(vault))
+    assert [text[start:end] for start, end in segments] == ["She walked to the gaet."]
+    assert 0.8 < skipped < 1
+
+
+@pytest.mark.asyncio
+async def test_grammar_precheck_turns_off_without_a_word_list_and_follows_the_language(tmp_path, caplog):
+    from unittest.mock import patch
+    from grammar_precheck import GrammarPrecheck
+    from grammar_review_service import GrammarReviewService
+
+    text = "The knight rode across the quiet valley before dawn.\n\nShe said I has a sword."
+    with patch.dict(os.environ, {"GRAMMAR_DICTIONARY": str(tmp_path / "missing"), "GRAMMAR_PRECHECK_LANG": "ENG"}):
+        precheck = GrammarPrecheck()
+    assert not precheck.enabled and "Grammar pre-check is off" in caplog.text
+    with patch("grammar_review_service.grammar_precheck", precheck):
+        segments, skipped = await GrammarReviewService().plan(text)
+    assert [text[start:end] for start, end in segments] == [text] and skipped == 0.0
+
+    # English-only rules don't flag a Spanish draft
+    words = tmp_path / "palabras"
+    words.write_text("\n".join(["dijo", "i", "has", "she", "said", "a", "sword"]))
+    with patch.dict(os.environ, {"GRAMMAR_DICTIONARY": str(words), "GRAMMAR_PRECHECK_LANG": "ESP"}):
+        spanish = GrammarPrecheck()
+    with patch.dict(os.environ, {"GRAMMAR_DICTIONARY": str(words), "GRAMMAR_PRECHECK_LANG": "ENG"}):
+        english = GrammarPrecheck()
+    assert spanish.enabled and spanish.check("She said I has a sword.", spanish.vocabulary()) == []
+    assert "agreement" in english.check("She said I has a sword.", english.vocabulary())
+    assert "double space" in spanish.check("She said  a sword.", spanish.vocabulary())
+
+@pytest.mark.asyncio
+async def test_loop_monitor_catches_blocking_callback_and_inflight_tasks_age():
+    import time
+    import asyncio
+    from diagnostics import LoopMonitor, InflightTasks, SamplingProfiler
+
+    def block_the_loop():
+        time.sleep(0.3)
+
+    monitor = LoopMonitor()
+    monitor.interval, monitor.slow_callback = 0.02, 0.1
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        block_the_loop()
+        await asyncio.sleep(0.1)
+    finally:
+        await monitor.stop()
+    stats = monitor.stats()
+    assert stats["lag_max"] >= 0.2
+    assert any("block_the_loop" in frame for stall in stats["blocked"] for frame in stall["stack"])
+
+    async def waiting():
+        await asyncio.sleep(10)
+
+    inflight = InflightTasks()
+    task = asyncio.create_task(waiting())
+    inflight.add(task, "chat", request_id="r1")
+    await asyncio.sleep(0)
+    [entry] = inflight.list()
+    assert entry["kind"] == "chat" and entry["request_id"] == "r1" and entry["age"] >= 0
+    assert "waiting" in entry["awaiting"] or "sleep" in entry["awaiting"]
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await asyncio.sleep(0)  # Done callbacks run on the next iteration
+    assert inflight.list() == []
+
+    folded = await asyncio.to_thread(SamplingProfiler().profile, 0.2, 50, True)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in folded.splitlines())